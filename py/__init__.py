@@ -1,12 +1,17 @@
-print "\n"
-print "    Autocal v.0.5"
-print ""
-print "    by Jonatan Selsing"
-print ""
-print "    Dark Cosmology Centre"
-print "    Copenhagen University"
-print "    January 2017"
-print ""
-print ""
-print ""
-from autocal import autocal
+"""
+    Autocal v.0.5
+
+    by Jonatan Selsing
+
+    Dark Cosmology Centre
+    Copenhagen University
+    January 2017
+"""
+
+
+def __getattr__(name):
+    # Load the pipeline on first use, so importing the package stays cheap
+    if name == "autocal":
+        from autocal import autocal
+        return autocal
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
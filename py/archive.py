@@ -0,0 +1,279 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Detection archive: every calibrated source of every frame in one SQLite database.
+Usage: archive.py options
+Options:
+    -d  <archive_db>            archive database (required)
+    -c  <ra>,<dec>              cone center in degrees
+    -r  <radius_in_arcsec>      cone radius (default 2)
+    -t  <mjd_start>,<mjd_end>   only frames observed in this MJD range
+    -l                          light curve: detections and the upper limits of the frames without one
+
+autocal(archive=...) appends each frame when it is done: one row of frame
+metadata (zero point, seeing, limiting magnitude, MJD, footprint) and one row
+per sextracted object with its calibrated magnitude, or its upper limit if it is
+fainter than the limiting magnitude. Sources are keyed by their nested HEALPix
+pixel at order 16 (about 3 arcsec), whose leading bits are the HEALPix tile, so
+the rows of a tile are stored together and a cone query reads a few contiguous
+key ranges. The night (MJD - 0.5, rounded down) is indexed for time-range
+queries. Light curves and source histories are queries, not rescans of the
+calibrated images.
+
+SQLite locks the whole database while a frame is appended, which is short. Do
+not put the archive on a network filesystem shared by several nodes; give each
+node its own archive and merge them, or use one writer.
+"""
+
+import getopt
+import sys
+import os
+import sqlite3
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+import healpix
+
+# Order of the source pixel index, and of the tiles the rows are grouped by
+index_order = 16
+tile_order = 6
+
+schema = """
+CREATE TABLE IF NOT EXISTS frames (
+    frame_id INTEGER PRIMARY KEY, filename TEXT, ext INTEGER, filter TEXT, catalog TEXT,
+    mjd REAL, night INTEGER, tile INTEGER, ra REAL, dec REAL, radius REAL,
+    zp REAL, zp_err REAL, fwhm REAL, seeing REAL, back_rms REAL, limmag REAL, n_calib INTEGER, n_obj INTEGER,
+    UNIQUE (filename, ext));
+CREATE INDEX IF NOT EXISTS frames_night ON frames (night);
+CREATE INDEX IF NOT EXISTS frames_tile ON frames (tile);
+CREATE TABLE IF NOT EXISTS sources (
+    hpx INTEGER, frame_id INTEGER, source INTEGER, night INTEGER, mjd REAL,
+    ra REAL, dec REAL, x REAL, y REAL, mag REAL, magerr REAL, upper_limit INTEGER, fwhm REAL, ellip REAL, flag INTEGER,
+    PRIMARY KEY (hpx, frame_id, source)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sources_night ON sources (night, hpx);
+CREATE INDEX IF NOT EXISTS sources_frame ON sources (frame_id);
+"""
+
+source_columns = ("hpx", "frame_id", "source", "night", "mjd", "ra", "dec", "x", "y", "mag", "magerr", "upper_limit", "fwhm", "ellip", "flag")
+
+
+def connect(db_name):
+    """
+    Open (and create if needed) the archive database.
+    """
+    connection = sqlite3.connect(db_name, timeout=60)
+    connection.executescript(schema)
+    return connection
+
+
+def night(mjd):
+    """
+    Night of an observation: the MJD at the preceding noon (UT).
+    """
+    return int(np.floor(mjd - 0.5))
+
+
+def header_mjd(header):
+    """
+    MJD of the observation from MJD-OBS, or from DATE-OBS. None if the header has neither.
+    """
+    if "MJD-OBS" in header:
+        return float(header["MJD-OBS"])
+    if "DATE-OBS" in header:
+        from astropy.time import Time
+        return Time(header["DATE-OBS"], format='isot', scale='utc').mjd
+    return None
+
+
+def add_frame(db_name, result, header, sexlist):
+    """
+    Append a calibrated frame: its autocal result dictionary, the header of the calibrated image, and the SourceList of
+    all its objects with the calibrated magnitudes (or upper limits, with error 9.99) in cat_mag and cat_magerr. A frame
+    that is already in the archive is replaced. Returns the frame id.
+    """
+    from astropy import wcs
+    from autocal import footprint_circle
+    mjd = header_mjd(header)
+    if mjd is None:
+        logger.warn("No MJD-OBS or DATE-OBS in the header of %s, archiving it at MJD 0", result["FILENAME"])
+        mjd = 0.
+    ra, dec, radius = footprint_circle(wcs.WCS(header).celestial.calc_footprint())
+    frame = (os.path.abspath(result["FILENAME"]), result.get("EXT", 0), result.get("FILTER"), result.get("CATALOG"),
+             mjd, night(mjd), int(healpix.ang2pix(tile_order, ra, dec)), ra, dec, radius / 60.,
+             result["ZP"], result["ZP_ERR"], result["FWHM"], result["SEEING"], result["BACK_RMS"], result["LIMMAG"],
+             result["N_CALIB"], result.get("N_OBJ", len(sexlist)))
+
+    hpx = healpix.ang2pix(index_order, sexlist.ra, sexlist.dec)
+    connection = connect(db_name)
+    with connection:
+        connection.execute("DELETE FROM sources WHERE frame_id IN (SELECT frame_id FROM frames WHERE filename = ? AND ext = ?)", frame[:2])
+        connection.execute("DELETE FROM frames WHERE filename = ? AND ext = ?", frame[:2])
+        frame_id = connection.execute("INSERT INTO frames (filename, ext, filter, catalog, mjd, night, tile, ra, dec, radius, zp, zp_err, fwhm, seeing, back_rms, limmag, n_calib, n_obj) VALUES (%s)" % ",".join("?" * len(frame)),
+                                      [float(x) if isinstance(x, np.floating) else x for x in frame]).lastrowid
+        n = len(sexlist)
+        rows = zip(hpx.tolist(), [frame_id] * n, range(n), [night(mjd)] * n, [mjd] * n,
+                   sexlist.ra.tolist(), sexlist.dec.tolist(), sexlist.x.tolist(), sexlist.y.tolist(),
+                   sexlist.cat_mag.astype(float).tolist(), sexlist.cat_magerr.astype(float).tolist(),
+                   (sexlist.cat_magerr >= 9.99).astype(int).tolist(),
+                   sexlist.fwhm.astype(float).tolist(), sexlist.ellip.astype(float).tolist(), sexlist.flag.astype(int).tolist())
+        connection.executemany("INSERT INTO sources VALUES (%s)" % ",".join("?" * len(source_columns)), rows)
+    connection.close()
+    logger.info("Archived %i objects of %s", n, result["FILENAME"])
+    return frame_id
+
+
+def time_clause(mjd_range, column = "mjd"):
+    if mjd_range is None:
+        return "", []
+    # The night bounds let the night index narrow the scan before the exact MJD cut
+    return " AND night BETWEEN ? AND ? AND %s BETWEEN ? AND ?" % column, [night(mjd_range[0]), night(mjd_range[1]), mjd_range[0], mjd_range[1]]
+
+
+def cone(db_name, ra, dec, radius = 2., mjd_range = None):
+    """
+    Archived sources within radius (arcsec) of ra, dec (degrees), optionally observed within mjd_range = (start, end),
+    as a dictionary of columns ordered by MJD, with the frame filter and the separation (arcsec) added.
+    """
+    from gr_cat import dist
+    radius_deg = radius / 3600.
+    # Pixels at an order about as large as the cone, as ranges of the source pixel index
+    order = int(np.clip(np.floor(np.log2(healpix.pixel_size(0) / max(radius_deg, 1e-6))), 0, index_order))
+    ranges = healpix.pixel_ranges(healpix.query_disc(order, ra, dec, radius_deg), order, index_order)
+    extra, extra_args = time_clause(mjd_range, "s.mjd")
+    extra = extra.replace("night", "s.night")
+
+    connection = connect(db_name)
+    query = "SELECT %s, f.filter FROM sources s JOIN frames f ON s.frame_id = f.frame_id WHERE s.hpx >= ? AND s.hpx < ?%s" % (", ".join("s." + x for x in source_columns), extra)
+    rows = []
+    for lo, hi in ranges.tolist():
+        rows.extend(connection.execute(query, [lo, hi] + extra_args).fetchall())
+    connection.close()
+
+    columns = dict((name, np.array([row[ii] for row in rows])) for ii, name in enumerate(source_columns + ("filter",)))
+    if len(rows) == 0:
+        columns["separation"] = np.zeros(0)
+        return columns
+    separation = dist(ra, dec, columns["ra"], columns["dec"]) * 3600
+    keep = separation <= radius
+    order = np.argsort(columns["mjd"][keep])
+    columns = dict((name, col[keep][order]) for name, col in columns.items())
+    columns["separation"] = separation[keep][order]
+    return columns
+
+
+def frames_covering(db_name, ra, dec, mjd_range = None):
+    """
+    Archived frames whose footprint circle contains ra, dec, as a list of dictionaries ordered by MJD.
+    """
+    from gr_cat import dist
+    extra, extra_args = time_clause(mjd_range)
+    connection = connect(db_name)
+    connection.row_factory = sqlite3.Row
+    # The frame footprints are at most a few degrees, so a declination band prefilters them
+    rows = connection.execute("SELECT * FROM frames WHERE dec - radius <= ? AND dec + radius >= ?%s ORDER BY mjd" % extra, [dec, dec] + extra_args).fetchall()
+    connection.close()
+    return [dict(row) for row in rows if dist(ra, dec, row["ra"], row["dec"]) <= row["radius"]]
+
+
+def frame_list(db_name, mjd_range = None, filter_name = None):
+    """
+    Archived frames, optionally observed within mjd_range = (start, end) and in one filter, as a list of dictionaries ordered by MJD.
+    """
+    extra, extra_args = time_clause(mjd_range)
+    if filter_name is not None:
+        extra, extra_args = extra + " AND filter = ?", extra_args + [filter_name]
+    connection = connect(db_name)
+    connection.row_factory = sqlite3.Row
+    rows = connection.execute("SELECT * FROM frames WHERE 1%s ORDER BY mjd" % extra, extra_args).fetchall()
+    connection.close()
+    return [dict(row) for row in rows]
+
+
+def frame_catalog(db_name, frame_id):
+    """
+    Detections of an archived frame (upper limits left out) as an (ra, dec, mag, magerr) array of instrumental
+    magnitudes: the zero point of the frame is taken off the calibrated magnitudes, and its error off their errors.
+    """
+    connection = connect(db_name)
+    zp, zp_err = connection.execute("SELECT zp, zp_err FROM frames WHERE frame_id = ?", [frame_id]).fetchone()
+    rows = connection.execute("SELECT ra, dec, mag, magerr FROM sources WHERE frame_id = ? AND upper_limit = 0 ORDER BY source", [frame_id]).fetchall()
+    connection.close()
+    cat = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    cat[:, 2] -= zp
+    cat[:, 3] = np.sqrt(np.maximum(cat[:, 3]**2 - zp_err**2, 0))
+    return cat
+
+
+def light_curve(db_name, ra, dec, radius = 2., mjd_range = None):
+    """
+    Light curve at ra, dec: for every frame covering the position, the nearest source within radius (arcsec), or the
+    limiting magnitude of the frame as an upper limit if it has none. Returns a list of (mjd, filter, mag, magerr,
+    upper_limit, filename) ordered by MJD.
+    """
+    sources = cone(db_name, ra, dec, radius, mjd_range)
+    nearest = {}
+    for ii in np.argsort(sources["separation"])[::-1]:
+        nearest[sources["frame_id"][ii]] = ii
+    curve = []
+    for frame in frames_covering(db_name, ra, dec, mjd_range):
+        ii = nearest.get(frame["frame_id"])
+        if ii is None:
+            curve.append((frame["mjd"], frame["filter"], frame["limmag"], 9.99, 1, frame["filename"]))
+        else:
+            curve.append((frame["mjd"], frame["filter"], float(sources["mag"][ii]), float(sources["magerr"][ii]), int(sources["upper_limit"][ii]), frame["filename"]))
+    return curve
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -d   <archive_db>            archive database (required)
+    -c   <ra>,<dec>              cone center in degrees
+    -r   <radius_in_arcsec>      cone radius (default 2)
+    -t   <mjd_start>,<mjd_end>   only frames observed in this MJD range
+    -l                           light curve: detections and the upper limits of the frames without one
+    """
+    db_name, position, radius, mjd_range, curve = None, None, 2., None, False
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'd:c:r:t:l')
+        for o, v in optlist:
+            if o == '-d':
+                db_name = v
+            elif o == '-c':
+                position = [float(x) for x in v.split(',')]
+            elif o == '-r':
+                radius = float(v)
+            elif o == '-t':
+                mjd_range = [float(x) for x in v.split(',')]
+            elif o == '-l':
+                curve = True
+        if db_name is None:
+            raise getopt.GetoptError('archive database must be specified.')
+        if position is None:
+            raise getopt.GetoptError('cone center must be specified.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return db_name, position, radius, mjd_range, curve
+
+
+def main():
+
+    db_name, position, radius, mjd_range, curve = get_options()
+    if curve:
+        print("mjd\tfilter\tmag\tmagerr\tupper_limit\tfilename")
+        for row in light_curve(db_name, position[0], position[1], radius, mjd_range):
+            print("%.5f\t%s\t%.3f\t%.3f\t%i\t%s" % row)
+    else:
+        sources = cone(db_name, position[0], position[1], radius, mjd_range)
+        print("mjd\tfilter\tra\tdec\tmag\tmagerr\tupper_limit\tseparation")
+        for ii in range(len(sources["mjd"])):
+            print("%.5f\t%s\t%.7f\t%.7f\t%.3f\t%.3f\t%i\t%.2f" % tuple(sources[x][ii] for x in ("mjd", "filter", "ra", "dec", "mag", "magerr", "upper_limit", "separation")))
+
+
+if __name__ == '__main__':
+    main()
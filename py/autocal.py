@@ -1,30 +1,17 @@
 #!/usr/local/anaconda3/envs/py36 python
 # -*- coding: utf-8 -*-
 
-# Plotting
-import matplotlib; matplotlib.use('TkAgg')
-import matplotlib.pyplot as pl
-# import seaborn; seaborn.set_style('ticks')
-
-# Imports
+# Imports - heavy dependencies (astropy, scipy, astroscrappy, astroquery) are imported in the stages that use them
 import numpy as np
-import scipy.stats
-import astroscrappy
-import math
 import subprocess
 import os
+import time
 import glob
 import sys
 import getopt
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-from astropy.io import fits
-from astropy import wcs
-from astropy.table import Table
-from scipy.spatial import cKDTree
-import pandas as pd
-from upper_limit import limiting_magnitude
 
 
 sexpath = ''  # if "sex" works in any directory, leave blank
@@ -37,8 +24,20 @@ defaultelliptol = 0.2
 fastmatch = 1
 showmatches = 0
 
+import tools
+import stages
+import refine
+from sources import SourceList
+
+# Warm state kept between frames when autocal() runs in a long-lived process (see watch.py)
+_reference_cache = []
+reference_cache_size = 16
+
 
 def writeparfile():
+    """
+    Path of the sextractor parameter file, written once per content (see tools.cached_file).
+    """
     params = '''X_IMAGE
     Y_IMAGE
     ALPHA_J2000
@@ -48,19 +47,30 @@ def writeparfile():
     ELLIPTICITY
     FWHM_IMAGE
     FLAGS'''
-    pf = open('temp.param','w')
-    pf.write(params)
-    pf.close()
+    return tools.cached_file(params, '.param')
 
 
 def writeconfigfile(satlevel=55000.):
+    """
+    Path of the sextractor config file, written once per content. Settings that change between calls are passed to
+    tools.run_sextractor as command-line overrides instead.
+    """
+    convol='''CONV NORM
+    # 3x3 ``all-ground'' convolution mask with FWHM = 2 pixels.
+    1 2 1
+    2 4 2
+    1 2 1
+    '''
+    paramfile = writeparfile()
+    convfile = tools.cached_file(convol, '.conv')
+
     configs='''
     #-------------------------------- Catalog ------------------------------------
 
     CATALOG_NAME     temp_sex.cat   # name of the output catalog
     CATALOG_TYPE     ASCII_HEAD     # NONE,ASCII,ASCII_HEAD, ASCII_SKYCAT,
                                     # ASCII_VOTABLE, FITS_1.0 or FITS_LDAC
-    PARAMETERS_NAME  temp.param     # name of the file containing catalog contents
+    PARAMETERS_NAME  %s     # name of the file containing catalog contents
 
     #------------------------------- Extraction ----------------------------------
 
@@ -70,7 +80,7 @@ def writeconfigfile(satlevel=55000.):
     ANALYSIS_THRESH  3              # <sigmas> or <threshold>,<ZP> in mag.arcsec-2
 
     FILTER           Y              # apply filter for detection (Y or N)?
-    FILTER_NAME      sex_temp.conv  # name of the file containing the filter
+    FILTER_NAME      %s  # name of the file containing the filter
 
     DEBLEND_NTHRESH  16             # Number of deblending sub-thresholds
     DEBLEND_MINCONT  0.02           # Minimum contrast parameter for deblending
@@ -126,109 +136,32 @@ def writeconfigfile(satlevel=55000.):
     VERBOSE_TYPE     QUIET          # can be QUIET, NORMAL or FULL
     WRITE_XML        N              # Write XML file (Y/N)?
     XML_NAME         sex.xml        # Filename for XML output
-    '''
+    ''' % (paramfile, convfile)
     #SATUR_LEVEL      '''+str(satlevel)+'''        # level (in ADUs) at which arises saturation
-    pf = open('sex_temp.config','w')
-    pf.write(configs)
-    pf.close()
-
-    convol='''CONV NORM
-    # 3x3 ``all-ground'' convolution mask with FWHM = 2 pixels.
-    1 2 1
-    2 4 2
-    1 2 1
-    '''
-    if not os.path.exists('sex_temp.conv'): 
-        cf = open('sex_temp.conv','w')
-        cf.write(convol)
-        cf.close()
-
-class Obj:
-    ra = 0.0
-    dec = 0.0
-    mag = 0.0
-
-    ra_rad = 0.0
-    dec_rad = 0.0
-
-    def __init__(self, inra, indec, inmag):
-        self.ra = inra
-        self.dec = indec
-        self.ra_rad = inra * math.pi/180
-        self.dec_rad = indec * math.pi/180
-        self.mag = inmag
-
-    def rotate(self, dpa_deg, ra0, dec0):
-        dpa_rad = dpa_deg * math.pi/180
-        sindpa = sin(dpa_rad)
-        cosdpa = cos(dpa_rad)
-        rascale = cos(dec0*math.pi/180)
-
-        #this is only valid for small fields away from the pole.
-        x = (self.ra  - ra0 ) * rascale
-        y = (self.dec - dec0)
-
-        xrot = cosdpa * x - sindpa * y
-        yrot = sindpa * x + cosdpa * y
-
-        self.ra   = (xrot / rascale) + ra0
-        self.dec  =  yrot + dec0
-        self.ra_rad  = self.ra  * math.pi/180
-        self.dec_rad =  self.dec * math.pi/180
-
-class SexObj(Obj):
-    x = 0.
-    y = 0.
-    mag = 0.0
-    magerr = 0.0
-    ellip = 0.0
-    fwhm = 0.0
-    flag = 0
-
-    def __init__(self, inline):
-        inlinearg = inline.split()
-
-        if len(inlinearg) < 8: return # maybe throw an error?
-        self.x = float(inlinearg[0])
-        self.y = float(inlinearg[1])
-        self.ra = float(inlinearg[2])
-        self.dec = float(inlinearg[3])
-        self.mag = float(inlinearg[4])
-        self.magerr = float(inlinearg[5])
-        self.ellip = float(inlinearg[6])
-        self.fwhm = float(inlinearg[7])
-        if len(inlinearg) >= 9: self.flag = int(inlinearg[8])
-
-        self.ra_rad = self.ra * math.pi/180
-        self.dec_rad = self.dec * math.pi/180
-
+    return tools.cached_file(configs, '.sex')
 
 def writetextfile(filename, objlist):
-    out = open(filename,'w')
-    for ob in objlist:
-      out.write("%11.7f %11.7f %5.2f %5.2f %5.2f %5.2f\n" % (ob.ra, ob.dec, ob.mag, ob.magerr, ob.cat_mag, ob.cat_magerr))
-    out.close()
+    np.savetxt(filename, np.array([objlist.ra, objlist.dec, objlist.mag, objlist.magerr, objlist.cat_mag, objlist.cat_magerr]).T,
+               fmt="%11.7f %11.7f %5.2f %5.2f %5.2f %5.2f")
 
 
 def writeregionfile(filename, objlist, color="green",sys=''):
     if sys == '': sys = 'wcs'
     out = open(filename,'w')
-    i = -1
     out.write('# Region file format: DS9 version 4.0\nglobal color='+color+' font="helvetica 10 normal" select=1 highlite=1 edit=1 move=1 delete=1 include=1 fixed=0 source\n')
     if sys == 'wcs':
       out.write('fk5\n')
-      for ob in objlist:
-        i += 1
-        out.write("point(%.7f,%.7f) # point=boxcircle text={%.2f +- %0.2f}\n" % (ob.ra, ob.dec, ob.cat_mag, ob.cat_magerr))
+      if len(objlist) > 0:
+        np.savetxt(out, np.array([objlist.ra, objlist.dec, objlist.cat_mag, objlist.cat_magerr]).T, fmt="point(%.7f,%.7f) # point=boxcircle text={%.2f +- %0.2f}")
     if sys == 'img':
       out.write('image\n')
-      for ob in objlist:
-        i += 1
-        out.write("point(%.3f,%.3f) # point=boxcircle text={%.2f +- %0.2f}\n" % (ob.x, ob.y, ob.cat_mag, ob.cat_magerr))
+      if len(objlist) > 0:
+        np.savetxt(out, np.array([objlist.x, objlist.y, objlist.cat_mag, objlist.cat_magerr]).T, fmt="point(%.3f,%.3f) # point=boxcircle text={%.2f +- %0.2f}")
     out.close()
 
 
-def sextract(sexfilename, nxpix, nypix, border=3, corner=12, minfwhm=1.5, maxfwhm=25, maxellip=0.5, saturation=-1, zeropoint=0):
+def sextract(sexfilename, nxpix, nypix, border=3, corner=12, minfwhm=1.5, maxfwhm=25, maxellip=0.5, saturation=-1, zeropoint=0, catname='temp_sex.cat', config=None):
+    import scipy.stats
 
     if maxellip == -1: maxellip = 0.5
     if saturation > 0:
@@ -236,23 +169,20 @@ def sextract(sexfilename, nxpix, nypix, border=3, corner=12, minfwhm=1.5, maxfwh
     else:
        sexsaturation = 1e10
 
-    try:
-       # Sextract the image !
-       subprocess.run(['sex', '%s'%sexfilename, '-c', 'sex_temp.config', '-SATUR_LEVEL', '%s'%sexsaturation, '-MAG_ZEROPOINT', '%s'%zeropoint])
-    except (OSError, IOError):
-       logger.warn("Sextractor failed to be executed.", exc_info=1)
-       sys.exit(1)
+    if config is None:
+       config = writeconfigfile()
+
+    # Sextract the image !
+    tools.run_sextractor(sexfilename, config, catname, SATUR_LEVEL=sexsaturation, MAG_ZEROPOINT=zeropoint)
 
     # Read in the sextractor catalog
     try:
-       cat = open("temp_sex.cat",'r')
-       catlines = cat.readlines()
-       cat.close()
+       sexlist = SourceList.from_sextractor(catname)
     except:
         logger.warn("Cannot load sextractor output file!", exc_info=1)
         sys.exit(1)
 
-    if len(catlines) == 0:
+    if len(sexlist) == 0:
         logger.warn("Sextractor catalog is empty: try a different catalog?", exc_info=1)
         sys.exit(1)
 
@@ -261,49 +191,19 @@ def sextract(sexfilename, nxpix, nypix, border=3, corner=12, minfwhm=1.5, maxfwh
     maxx = nxpix - border    # This should be generalized
     maxy = nypix - border
 
+    nsexinit = len(sexlist)
 
-    l = -1
-    nsexinit = 0
-    nsexpass = 0
-    xlist = []
-    ylist = []
-    sexlist = []
-    fwhmlist = []
-    elliplist = []
-    flaglist = []
-    while l < len(catlines)-1:
-        l += 1
-        if (len(catlines[l]) <= 1 or catlines[l][0] == '#'):
-            continue
-
-        iobj = SexObj(catlines[l]) #process the line into an object
-        nsexinit += 1
-
-        #Initial filtering
-        if iobj.ellip > maxellip : continue
-        if iobj.fwhm < minfwhm: continue
-        if iobj.fwhm > maxfwhm: continue
-        if iobj.x < minx: continue
-        if iobj.y < miny: continue
-        if iobj.x > maxx: continue
-        if iobj.y > maxy: continue
-        if iobj.x + iobj.y < corner: continue
-        if iobj.x + (nypix-iobj.y) < corner: continue
-        if (nxpix-iobj.x) < corner: continue
-        if (nxpix-iobj.x) + (nypix-iobj.y) < corner: continue
-        if saturation > 0:
-           if iobj.flag > 0: continue  # this will likely overdo it for very deep fields.
-
-        sexlist.append(iobj)
-        xlist.append(iobj.x)
-        ylist.append(iobj.y)
-        fwhmlist.append(iobj.fwhm)
-        elliplist.append(iobj.ellip)
-        flaglist.append(iobj.flag)
-        nsexpass += 1
+    #Initial filtering
+    x, y = sexlist.x, sexlist.y
+    keep = (sexlist.ellip <= maxellip) & (sexlist.fwhm >= minfwhm) & (sexlist.fwhm <= maxfwhm)
+    keep &= (x >= minx) & (y >= miny) & (x <= maxx) & (y <= maxy)
+    keep &= (x + y >= corner) & (x + (nypix-y) >= corner) & ((nxpix-x) >= corner) & ((nxpix-x) + (nypix-y) >= corner)
+    if saturation > 0:
+       keep &= sexlist.flag <= 0  # this will likely overdo it for very deep fields.
+    sexlist = sexlist[keep]
 
     print(nsexinit, 'raw sextractor detections')
-    print(nsexpass, 'pass initial critiera')
+    print(len(sexlist), 'pass initial critiera')
 
      # Remove detections along bad columns
     threshprob = 0.0001
@@ -314,52 +214,29 @@ def sextract(sexfilename, nxpix, nypix, border=3, corner=12, minfwhm=1.5, maxfwh
         while txp > threshprob:
           txp *= min((len(sexlist)*1.0/nxpix),0.8) # some strange way of estimating the threshold.
           xthresh += 1                          #what I really want is a general analytic expression for
-        removelist = []                         #the 99.99% prob. threshold for value of n for >=n out 
-        modex = scipy.stats.mode(xlist)[0]                 #of N total sources to land in the same bin (of NX total bins)
-        for j in range(len(sexlist)):
-           if (sexlist[j].x > modex-1) and (sexlist[j].x < modex+1):
-             removelist.append(j)
-        removelist.reverse()
-        if len(removelist) > xthresh:
-         #print removelist
-         for k in removelist:
-           del xlist[k]
-           del ylist[k]
-           del sexlist[k]
-           del fwhmlist[k]
-           del elliplist[k]
-           del flaglist[k]
-           ctbadcol += 1
+                                                #the 99.99% prob. threshold for value of n for >=n out
+        modex = scipy.stats.mode(sexlist.x)[0]  #of N total sources to land in the same bin (of NX total bins)
+        remove = (sexlist.x > modex-1) & (sexlist.x < modex+1)
+        if remove.sum() > xthresh:
+         sexlist = sexlist[~remove]
+         ctbadcol += remove.sum()
 
         typ = 1.0
         ythresh = 1
         while typ > threshprob:
           typ *= min((len(sexlist)*1.0/nypix),0.8)
           ythresh += 1
-        removelist = []
-        modey = scipy.stats.mode(ylist)[0]
-        for j in range(len(sexlist)):
-           if (sexlist[j].y > modey-1) and (sexlist[j].y < modey+1):
-             removelist.append(j)
-        removelist.reverse()
-        if len(removelist) > ythresh:
-         for k in removelist:
-           del xlist[k]
-           del ylist[k]
-           del sexlist[k]
-           del fwhmlist[k]
-           del elliplist[k]
-           del flaglist[k]
-           ctbadcol += 1
+        modey = scipy.stats.mode(sexlist.y)[0]
+        remove = (sexlist.y > modey-1) & (sexlist.y < modey+1)
+        if remove.sum() > ythresh:
+         sexlist = sexlist[~remove]
+         ctbadcol += remove.sum()
     if ctbadcol > 0: print(' Removed ', ctbadcol, ' detections along bad columns.')
 
     # Remove galaxies and cosmic rays
+    fwhmlist = sexlist.fwhm.astype(float)
     if len(fwhmlist) > 5:
-       # fwhmlist.sort()
        fwhm20 = np.percentile(fwhmlist, 0.2)
-       fwhm25 = np.percentile(fwhmlist, 0.25)
-       fwhm50 = np.percentile(fwhmlist, 0.50)     #percentile values
-       fwhm75 = np.percentile(fwhmlist, 0.75)
        fwhmmode = scipy.stats.mode(fwhmlist)[0]
     else:
        fwhmmode = minfwhm
@@ -371,38 +248,86 @@ def sextract(sexfilename, nxpix, nypix, border=3, corner=12, minfwhm=1.5, maxfwh
     #refinedmaxfwhm = 35
 
 
-    ngood = 0
-    goodsexlist = []
-    for sex in sexlist:
-       if sex.fwhm > refinedminfwhm and sex.ellip < maxellip:
-          goodsexlist.append(sex)
-          ngood += 1
+    goodsexlist = sexlist[(sexlist.fwhm > refinedminfwhm) & (sexlist.ellip < maxellip)]
 
     print(len(sexlist), 'objects detected in image ('+ str(len(sexlist)-len(goodsexlist)) +' discarded)')
 
     return goodsexlist
 
 
-def get_catalog(img_ra, img_dec, img_filt, radius = 5, catalog = "PS"):
+def get_catalog(img_ra, img_dec, img_filt, radius = 5, catalog = "PS", maglim = None):
 
-  gr_cat_arg = [sys.executable, 'gr_cat.py', '-c', '%s%s'%(img_ra, img_dec), '-r', '%s'%radius, '-s', '%s'%catalog, '-b', '%s'%img_filt, '-f', 'temp_cat.dat', '-d', 'temp_cat.reg']
-
-  # Run gr_cat_arg to get catalog around ra and dec
+  # Query the catalog in-process - spawning gr_cat.py would pay the interpreter and import start-up on every call
+  from gr_cat import query_catalog
   try:
-      subprocess.run(gr_cat_arg)
+      lines = query_catalog(img_ra, img_dec, radius, catalog, img_filt, maglim = maglim)
   except (OSError, IOError):
-      logger.warn("gr_cat.py failed to be executed.", exc_info=1)
+      logger.warn("Catalog query failed.", exc_info=1)
+      lines = []
 
-  # Read in the catalog
-  try:
-      cat = pd.read_csv("temp_cat.dat").values
-  except (OSError, IOError):
-      logger.warn("Cannot load catalog file!", exc_info=1)
   # Check for exsistence of targets
-  if cat.shape[0] == 0:
+  if len(lines) == 0:
       logger.warn("Catalog is empty: try a different catalog?", exc_info=1)
       sys.exit(1)
-  return cat
+  from refcat import ReferenceCatalog
+  return ReferenceCatalog.from_table(lines, img_filt)
+
+
+def get_reference_catalog(img_ra, img_dec, img_filt, radius = 5, catalog = "PS", maglim = None):
+    """
+    ReferenceCatalog with the image filter as a band, together with a k-d tree on its ra, dec. Filters with a transformation in refcat.transforms are transformed from the catalog bands. maglim = (bright, faint) limits the magnitude range of the query; the bands used in a transformation are queried with a 1 mag wider range to allow for the colour terms. The last few catalogs are kept in memory, and a request that lies inside a cached query circle is served from the cache.
+    """
+    from scipy.spatial import cKDTree
+    from gr_cat import dist
+    from refcat import transforms
+
+    if maglim is not None:
+      maglim = tuple(maglim)
+
+    for ii, (key, cat, tree) in enumerate(_reference_cache):
+        cached_ra, cached_dec, cached_radius, cached_filt, cached_catalog, cached_maglim = key
+        if cached_filt == img_filt and cached_catalog == catalog and cached_maglim == maglim and dist(img_ra, img_dec, cached_ra, cached_dec)*60 + radius <= cached_radius:
+            _reference_cache.append(_reference_cache.pop(ii))
+            return cat, tree
+
+    transform = transforms.get(img_filt)
+    if transform is None:
+      cat = get_catalog(img_ra, img_dec, img_filt, catalog=catalog, radius = radius, maglim = maglim)
+    else:
+      # Get the catalog bands of the transformation, join them and transform all rows at once
+      band_maglim = (maglim[0] - 1, maglim[1] + 1) if maglim else None
+      cat = get_catalog(img_ra, img_dec, transform.bands[0], catalog=catalog, radius = radius, maglim = band_maglim)
+      for band in transform.bands[1:]:
+        cat = cat.join(get_catalog(img_ra, img_dec, band, catalog=catalog, radius = radius, maglim = band_maglim))
+      transform.apply(cat)
+
+    tree = cKDTree(cat.coords())
+    # A catalog that fell back from a failed query is used for this frame only, so the next frame tries the service again
+    if not cat.meta.get('degraded'):
+      _reference_cache.append(((img_ra, img_dec, radius, img_filt, catalog, maglim), cat, tree))
+      del _reference_cache[:-reference_cache_size]
+    return cat, tree
+
+
+def reference_cacheable(reference):
+    """
+    Whether a (ReferenceCatalog, k-d tree) result of the catalog stage may be cached: not if it fell back from a failed query (see gr_cat.query_catalog).
+    """
+    return not reference[0].meta.get('degraded')
+
+
+def clip_to_footprint(cat, tree, w):
+    """
+    Keep the catalog rows that fall on the image described by the WCS w. The k-d tree is only rebuilt if rows were removed.
+    """
+    from astropy.coordinates import SkyCoord
+    from scipy.spatial import cKDTree
+    inside = w.footprint_contains(SkyCoord(cat.ra, cat.dec, unit='deg'))
+    if np.all(inside):
+      return cat, tree
+    logger.info("%i of %i catalog stars on the image footprint", np.sum(inside), len(cat))
+    cat = cat[inside]
+    return cat, cKDTree(cat.coords())
 
 
 def run_astrometry_net(img_name, img_ra, img_dec):
@@ -411,13 +336,16 @@ def run_astrometry_net(img_name, img_ra, img_dec):
 
     # Run astrometry-net on field
     try:
-       subprocess.run(astrometry_args)
+       tools.run(astrometry_args, tools.solve_timeout)
     except (OSError, IOError):
       logger.warn("astrometry-net failed to be executed.", exc_info=1)
+    except subprocess.TimeoutExpired:
+      logger.warn("astrometry-net did not finish within %i s.", tools.solve_timeout)
 
     # Read in the calibrated image
+    from astropy.io import fits
     try:
-        calib_img_name = img_name.replace("temp", "new")
+        calib_img_name = os.path.join(os.path.dirname(img_name), os.path.basename(img_name).replace("temp", "new"))
         calib_img = fits.open(calib_img_name)
         img_name = calib_img_name
     except (OSError, IOError):
@@ -427,189 +355,229 @@ def run_astrometry_net(img_name, img_ra, img_dec):
     return img_name
 
 
-def joint_catalog(cat_1, cat_2):
+def chip_header(fitsfile, ext = 0):
+    """
+    Header of extension ext, completed with the keywords of the primary header (filter, gain, ...) that the extension does not set itself.
     """
-    Small function to match to arrays based on the first two columns, which is assumed to be ra and dec
+    header = fitsfile[ext].header.copy()
+    if ext != 0:
+      structural = ('SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'NEXTEND', 'XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME', 'EXTVER', 'CHECKSUM', 'DATASUM')
+      primary = fitsfile[0].header.copy()
+      for key in list(primary.keys()):
+        if key.startswith(structural):
+          del primary[key]
+      header.extend(primary, unique=True)
+    return header
+
+
+def get_gain_ron(header):
     """
-    # Grow the tree
-    tree_data = np.array([cat_1[:, 0], cat_1[:, 1]]).T
-    tree = cKDTree(tree_data)
+    Gain and readnoise from the first header keywords containing GAIN and RON or RDNOISE, and the names of these keywords. Defaults are returned (with None as keyword names) if they are not found.
+    """
+    try:
+      gain_key = [x for x in header.keys() if "GAIN" in x][0]
+      ron_key = [x for x in header.keys() if "RON" in x or "RDNOISE" in x][0]
+      return header[gain_key], header[ron_key], gain_key, ron_key
+    except:
+      logger.warn("Gain and RON keys not understood. Setting to default values")
+      return 2, 3.3, None, None
 
-    # Find mapping indices
-    idx_map_cat2, idx_map_cat1 = [], []
-    tol = 1e-2 # Distance in degrees - This could change depending on the accuracy of the astrometric solution
-    for ii, kk in enumerate(cat_2):
-        # find the k nearest neighbours
-        distance, indice = tree.query(kk[0:2], k=1)
-        if distance < tol:
-            # Store
-            idx_map_cat1.append(indice)
-            idx_map_cat2.append(ii)
 
-    cat_1 = cat_1[np.array(idx_map_cat1)]
-    cat_2 = cat_2[np.array(idx_map_cat2)]
-    # Return joint lists
-    return cat_1, cat_2
+def get_filter(header):
+    """
+    Filter name from the header, as the first letter of the filter keyword.
+    """
+    try:
+      img_filt = header["HIERARCH ESO INS FILT1 NAME"][0] # image filter name
+    except KeyError:
+      try:
+        img_filt = header["FILTER"][0]
+      except KeyError:
+        try:
+          img_filt = header["NCFLTNM2"][0]
+        except KeyError:
+          logger.warn("Filter keyword not recognized.", exc_info=1)
+          sys.exit(1)
+    return img_filt
+
 
+def expected_mag_limits(zp, rms, seeing_pix, saturation, sigma_limit = 5):
+    """
+    Magnitude range of useful calibration stars. Brighter than mag_bright a point source with the given seeing FWHM (in pixels) saturates its central pixel, fainter than mag_faint it is detected at less than sigma_limit in an aperture of radius FWHM.
+    """
+    sigma = seeing_pix / 2.35
+    mag_bright = zp - 2.5*np.log10(saturation * 2*np.pi*sigma**2)
+    mag_faint = zp - 2.5*np.log10(sigma_limit * rms * np.sqrt(np.pi) * seeing_pix)
+    return mag_bright, mag_faint
 
-def autocal(filename = "../test_data/FORS_R_OB_ana.fits", catalog = "SDSS", sigclip = 50, objlim = 75, filter = None, cosmic_rejection = True, astrometry = True):
 
+def auto_mag_limits(header, data, saturation):
     """
-    Rutine to automatically do astrometric calibration and photometry of detected sources. Uses astrometry.net to correct the astrometric solution of the image. Input images need to be larger than ~10 arcmin for this to work. This correction includes image distortions. Queries  Pan-STARRS, SDSS and USNO in that order for coverage for reference photometry against which to do the calibration. This is achieved with gr_cat.py developed by Thomas Krühler which can be consulted for additional documentation. Sextractor is run on the astrometrically calibrated image using the function sextract, heavily inspired by autoastrometry.py by Daniel Perley and available at http://www.dark-cosmology.dk/~dperley/code/code.html. Handling of the entire sextractor interfacing is heavily based on autoastrometry.py. The two lists of images are then matched with a k-d tree algorithm and sextracted magntiudes can be calibrated against the chosen catalog.
+    Magnitude range of useful calibration stars (see expected_mag_limits) from the zero point and seeing keywords of the header and the noise of a subsample of the pixels of data (an array or an HDU section). None if the header has no zero point.
+    """
+    from astropy import wcs
+    zp_keys = [x for x in ["MAGZPT", "PHOTZP", "MAGZERO", "ZEROPT"] if x in header]
+    if len(zp_keys) == 0:
+      logger.warn("No zero point keyword in header, querying catalog without magnitude limits")
+      return None
+    # Robust image noise from a subsample of the pixels - cosmic rays do not move the median
+    # Every fourth row is read whole: a section strided along the rows too would be read pixel by pixel
+    sub = np.asarray(data[::4, :], dtype=float)[:, ::4]
+    rms = 1.4826 * np.nanmedian(np.abs(sub - np.nanmedian(sub)))
+    seeing_pix = header.get("SEEING", 1.0) / (wcs.utils.proj_plane_pixel_scales(wcs.WCS(header).celestial)[0] * 3600)
+    mag_limits = expected_mag_limits(header[zp_keys[0]], rms, seeing_pix, saturation)
+    logger.info("Querying catalog stars between %.2f and %.2f mag", mag_limits[0], mag_limits[1])
+    return mag_limits
+
+
+def prefetch_reference_catalog(header, img_filt, catalog = "PS", maglim = None, margin = 1.2, timings = None, cache = True):
+    """
+    Start the catalog stage in a background thread from the header WCS, so that the download overlaps cleaning and solving. The query circle around the header footprint is widened by margin for the astrometric correction. Returns a future of the (ReferenceCatalog, k-d tree) pair and the query circle (ra, dec, radius in arcmin), or None if the header has no celestial WCS.
+    """
+    from astropy import wcs
+    from concurrent.futures import ThreadPoolExecutor
+    w = wcs.WCS(header)
+    if not w.has_celestial:
+      logger.warn("No WCS in the header, querying the catalog after the astrometric solution")
+      return None
+    img_ra, img_dec, img_radius = footprint_circle(w.celestial.calc_footprint())
+    img_radius *= margin
+    catalog_key = stages.stage_key('catalog', img_ra, img_dec, img_radius, img_filt, catalog, maglim)
+    executor = ThreadPoolExecutor(max_workers=1)
+    # No memory tracing for this stage: it runs alongside the stages of the main thread
+    future = executor.submit(stages.run, catalog_key, get_reference_catalog, img_ra, img_dec, img_filt, radius = img_radius, catalog = catalog, maglim = maglim, timings = timings, cache = cache, keep = reference_cacheable)
+    executor.shutdown(wait=False)
+    return future, (img_ra, img_dec, img_radius)
+
+
+def wait_for_catalog(future, timings = None):
+    """
+    Result of a catalog query started by prefetch_reference_catalog. The time spent waiting for it is added to timings["catalog_wait"].
     """
+    t0 = time.time()
+    reference = future.result()
+    if timings is not None:
+      timings["catalog_wait"] = timings.get("catalog_wait", 0.) + time.time() - t0
+    return reference
 
-    fitsfile = fits.open(filename)
-    header = fitsfile[0].header
 
-    img_ra, img_dec = header["CRVAL1"], header["CRVAL2"]
+def clean_frame(filename, ext = 0, cosmic_rejection = True, sigclip = 50, objlim = 75, clean_name = None, memory_budget = None):
+    """
+    Clean stage: data and header (see chip_header) of extension ext of filename, cleaned for cosmic rays with astroscrappy if cosmic_rejection is set. Returns data, header, gain and readnoise.
 
-    # temp_filename = filename
-    temp_filename = filename.replace("fits", "")+"temp"
+    With a memory_budget (in MB) the image is instead streamed through the cleaning in row strips (see strips.py) and written to clean_name, and the returned data is None.
+    """
+    from astropy.io import fits
+    # No memmap: it cannot scale BZERO/BSCALE integer raw frames, and section access (streaming mode) still only reads
+    # the rows it is asked for
+    fitsfile = fits.open(filename, memmap = False)
+    header = chip_header(fitsfile, ext)
 
     # Get gain and readnoise
-    try:
-      gain_key = [x for x in header.keys() if "GAIN" in x][0]
-      ron_key = [x for x in header.keys() if "RON" in x or "RDNOISE" in x][0]
-      gain = header[gain_key]
-      ron = header[ron_key]
-    except:
-      logger.warn("Gain and RON keys not understood. Setting to default values")
-      gain = 2
-      ron = 3.3
+    gain, ron = get_gain_ron(header)[:2]
 
+    if memory_budget is not None:
+      import strips
+      strips.clean_image(fitsfile[ext], clean_name, header, gain, ron, cosmic_rejection, sigclip, objlim, memory_budget)
+      return None, header, gain, ron
+
+    data = fitsfile[ext].data
     if cosmic_rejection:
       # Clean for cosmics
-      crmask, clean_arr = astroscrappy.detect_cosmics(fitsfile[0].data, gain=gain, readnoise=ron, sigclip=sigclip, objlim=objlim, cleantype='medmask', sepmed=True, verbose=True)
+      import astroscrappy
+      crmask, clean_arr = astroscrappy.detect_cosmics(data, gain=gain, readnoise=ron, sigclip=sigclip, objlim=objlim, cleantype='medmask', sepmed=True, verbose=True)
 
       # Replace data array with cleaned image
-      fitsfile[0].data = clean_arr/gain
+      data = clean_arr/gain
 
-    # Save cosmicced file to temp
-    fitsfile.writeto(temp_filename, output_verify='fix', clobber=True)
+    return data, header, gain, ron
 
-    # Attempt astrometric calibration
-    if astrometry:
-      temp_filename = run_astrometry_net(temp_filename, img_ra, img_dec)
-
-    # Read in cosmic-ray rejected, possibly astrometrically calibrated image
-    fitsfile = fits.open(temp_filename)
-    header = fitsfile[0].header
-
-    # Get header keyword for catalog matching
-    if filter is None:
-      try:
-        img_filt = header["HIERARCH ESO INS FILT1 NAME"][0] # image filter name
-      except KeyError:
-        try:
-          img_filt = header["FILTER"][0]
-        except KeyError:
-          try:
-            img_filt = header["NCFLTNM2"][0]
-          except KeyError:
-            logger.warn("Filter keyword not recognized.", exc_info=1)
-            sys.exit(1)
-
-    img_ra, img_dec = header["CRVAL1"], header["CRVAL2"] # ra and dec
-    # Ensure sign convention for gr_cat
-    if not img_dec < 0:
-        img_dec = "+"+str(img_dec)
-
-    w = wcs.WCS(header)
-    pixscale = wcs.utils.proj_plane_pixel_scales(w)
-    nxpix = header['NAXIS1']
-    nypix = header['NAXIS2']
 
-    img_radius = np.sqrt((pixscale[0]*nxpix*60)**2 + (pixscale[1]*nypix*60)**2) # Largest image dimension to use as catalog query radius in arcmin
-
-    # Get the catalog sources
-    if img_filt == "I":
-      # Get sdss filters for Lupton (2005) tranformations - http://www.sdss3.org/dr8/algorithms/sdssUBVRITransform.php
-      cat_i = get_catalog(img_ra, img_dec, "i", catalog=catalog, radius = img_radius)
-      cat_z = get_catalog(img_ra, img_dec, "z", catalog=catalog, radius = img_radius)
-      cat_i, cat_z = joint_catalog(cat_i, cat_z) # Get joint catalog
-      # Do filter transformation
-      cat_i[:, 2] = cat_i[:, 2] - 0.3780*(cat_i[:, 2] - cat_z[:, 2]) - 0.3974
-      # Account for transformation scatter
-      cat_i[:, 3] = np.sqrt(cat_i[:, 3]**2 + 0.0063**2)
-      cat = cat_i.copy()
-    elif img_filt == "R":
-      # Get sdss filters for Lupton (2005) tranformations - http://www.sdss3.org/dr8/algorithms/sdssUBVRITransform.php
-      cat_r = get_catalog(img_ra, img_dec, "r", catalog=catalog, radius = img_radius)
-      cat_i = get_catalog(img_ra, img_dec, "i", catalog=catalog, radius = img_radius)
-      cat_r, cat_i = joint_catalog(cat_r, cat_i) # Get joint catalog
-      # Do filter transformation
-      cat_r[:, 2] = cat_r[:, 2] - 0.2936*(cat_r[:, 2] - cat_i[:, 2]) - 0.1439
-      # Account for transformation scatter
-      cat_r[:, 3] = np.sqrt(cat_r[:, 3]**2 + 0.0072**2)
-      cat = cat_r.copy()
-    else:
-      cat = get_catalog(img_ra, img_dec, img_filt, catalog=catalog, radius = img_radius)
+def clean_to_file(clean, clean_name, *args):
+    """
+    Clean stage (clean_frame or sequence.clean_in_sequence with args) that writes the cleaned image to clean_name instead of returning it, so the stage cache keeps the image as a FITS file rather than in the pickled result. Returns None, header, gain and readnoise.
+    """
+    import strips
+    data, header, gain, ron = clean(*args)
+    strips.write_strips(clean_name, header, [data], np.float64 if data.dtype == np.float64 else np.float32)
+    return None, header, gain, ron
 
-    print(cat)
-    # Prepare sextractor
-    writeparfile()
-    saturation = 30000
-    writeconfigfile(saturation)
 
-    # Sextract stars to produce image star catalog
-    goodsexlist = sextract(temp_filename, nxpix, nypix, border = 3, corner = 12, saturation=saturation)
+def refine_frame(image_name, header, catalog = "PS", img_filt = None, config = None, saturation = 30000, reference = None):
+    """
+    Header of image_name with the WCS refined for a small offset and rotation (see refine.py), from a quick sextractor run and the reference catalog of the header footprint, or the given (ReferenceCatalog, k-d tree) reference. Returns None if the refinement fails.
+    """
+    from astropy import wcs
+    if reference is None:
+      img_ra, img_dec, img_radius = footprint_circle(wcs.WCS(header).calc_footprint())
+      # Some margin, so the catalog stage finds the query of the refined footprint in the reference catalog cache
+      reference = get_reference_catalog(img_ra, img_dec, img_filt, radius = 1.2*img_radius, catalog = catalog)
+    cat = reference[0]
+    sexlist = sextract(image_name, header['NAXIS1'], header['NAXIS2'], border = 3, corner = 12, saturation=saturation, catname = image_name+'_refine.cat', config = config)
+    sexlist = sexlist[np.argsort(sexlist.mag)]
+    order = np.argsort(cat.mag[img_filt])
+    return refine.refine_wcs(header, sexlist.x, sexlist.y, cat.ra[order], cat.dec[order])
+
+
+def solve_frame(temp_filename, data, header, astrometry = True, catalog = "PS", img_filt = None, config = None, reference = None):
+    """
+    Solve stage: header of the cleaned image with the astrometry.net solution (the input header if astrometry is off or the field did not solve), and the base name of the solved image, which names the products. With astrometry = "refine" the header WCS is only refined for a small offset and rotation against the catalog (refine_frame, with the given reference catalog if any), and astrometry.net runs only if that fails.
+    """
+    from astropy.io import fits
+    img_ra, img_dec = header["CRVAL1"], header["CRVAL2"]
 
-    # Get sextracted ra, dec list for k-d Tree algoritm
-    ra_sex, dec_sex = [], []
-    for ii in goodsexlist:
-        ra_sex.append(ii.ra)
-        dec_sex.append(ii.dec)
+    # Save cosmicced file (of this extension only) to temp
+    fits.PrimaryHDU(data, header).writeto(temp_filename, output_verify='fix', overwrite=True)
 
-    # Grow the tree
-    tree_data = np.array([ra_sex, dec_sex]).T
-    tree = cKDTree(tree_data)
+    if astrometry == "refine":
+      refined = refine_frame(temp_filename, header, catalog, img_filt, config, reference = reference)
+      if refined is not None:
+        fits.PrimaryHDU(data, refined).writeto(temp_filename, output_verify='fix', overwrite=True)
+        return refined, os.path.basename(temp_filename)
+      logger.warn("WCS refinement failed, solving with astrometry.net")
 
-    # Find mapping indices
-    idx_map_sex, idx_map_cat = [], []
-    tol = 1e-3 # Distance in degrees - This could change depending on the accuracy of the astrometric solution
-    for ii, kk in enumerate(cat):
-        # find the k nearest neighbours
-        distance, indice = tree.query(kk[0:2], k=1)
-        # print(distance, indice)
-        if distance < tol:
-            # Store
-            idx_map_sex.append(indice)
-            idx_map_cat.append(ii)
+    # Attempt astrometric calibration
+    if astrometry:
+      temp_filename = run_astrometry_net(temp_filename, img_ra, img_dec)
 
-    # Add catalog photometry to sextractor object
-    for ii, kk in enumerate(idx_map_sex):
-        goodsexlist[kk].cat_mag = cat[idx_map_cat[ii]][2]
-        goodsexlist[kk].cat_magerr = cat[idx_map_cat[ii]][3]
+    return fits.getheader(temp_filename), os.path.basename(temp_filename)
 
-    # Bad matches from sextracted star catalog
-    idx_bad = [ii for ii in np.arange(len(goodsexlist)) if ii not in idx_map_sex]
 
-    # Remove mismatches
-    for ii, kk in enumerate(idx_bad[::-1]):
-        goodsexlist.pop(kk)
+def match_catalog(goodsexlist, cat, cat_tree, img_filt, tol = 1e-3):
+    """
+    Match stage: the sextracted stars with a catalog star within tol (degrees), with the catalog photometry added as cat_mag and cat_magerr.
+    """
+    # Match each sextracted star to its nearest catalog star with the cached catalog k-d tree
+    distance, indice = cat_tree.query(goodsexlist.coords(), k=1, distance_upper_bound=tol)
+    idx_map_sex = np.where(distance < tol)[0]
+    idx_map_cat = indice[idx_map_sex]
+
+    # Remove mismatches and add catalog photometry
+    goodsexlist = goodsexlist[idx_map_sex]
+    goodsexlist.cat_mag = cat.mag[img_filt][idx_map_cat]
+    goodsexlist.cat_magerr = cat.magerr[img_filt][idx_map_cat]
+    return goodsexlist
 
-    # writetextfile('det.init.txt', goodsexlist)
-    writeregionfile(temp_filename+'.det.im.reg', goodsexlist, 'red', 'img')
 
+def fit_zeropoint(goodsexlist, sigma_mask = 3):
+    """
+    Fit stage: zero point of the matched stars by orthogonal distance regression, after removing sigma_mask-sigma outliers. Returns the zero point and its error, and the magnitudes, catalog magnitudes, their errors and the mask of the stars used.
+    """
     # Get sextracted magnitudes and equivalent catalog magnitudes
-    n_good = len(goodsexlist)
-    mag, magerr, cat_mag, cat_magerr = np.zeros(n_good), np.zeros(n_good), np.zeros(n_good), np.zeros(n_good)
-    for ii, kk in enumerate(goodsexlist):
-        mag[ii] = kk.mag #+ 2.5*np.log10(exptime) # Correct for exposure time
-        magerr[ii] = kk.magerr
-        cat_mag[ii] = kk.cat_mag
-        cat_magerr[ii] = kk.cat_magerr
+    mag = goodsexlist.mag.astype(float) #+ 2.5*np.log10(exptime) # Correct for exposure time
+    magerr = goodsexlist.magerr.astype(float)
+    cat_mag = goodsexlist.cat_mag.astype(float)
+    cat_magerr = goodsexlist.cat_magerr.astype(float)
 
     # Filter away 5-sigma outliers in the zero point
     zp = cat_mag - mag
-    print (zp)
-    print (mag), 'hugo'
+    logger.debug("Zero points of the matched stars: %s", zp)
+    logger.debug("Instrumental magnitudes of the matched stars: %s", mag)
     zp_l, zp_m, zp_h = np.percentile(zp, [16, 50, 84])
 
     sig_l = zp_m - zp_l
     sig_h = zp_h - zp_m
     # Filter zp's
-    sigma_mask = 3
     mask = (zp > zp_m - sigma_mask * sig_l) & (zp < zp_m + sigma_mask * sig_h)
     zp = zp[mask]
     zp_m, zp_std = np.mean(zp), np.std(zp)
@@ -644,33 +612,44 @@ def autocal(filename = "../test_data/FORS_R_OB_ana.fits", catalog = "SDSS", sigc
     for i in range(len(popt)):
       print(str(popt[i])+' +- '+str(perr[i]))
     zp_m, zp_std = popt[0], perr[0]
-    # prepare confidence level curves
-    nstd = 5. # to draw 5-sigma intervals
-    popt_up = popt + nstd * perr
-    popt_dw = popt - nstd * perr
-
-    x_fit = np.linspace(min(mag[mask]), max(mag[mask]), 100)
-    fit = func(popt, x_fit)
-    fit_up = func(popt_up, x_fit)
-    fit_dw= func(popt_dw, x_fit)
-
-    #plot
-    pl.errorbar(mag[mask], cat_mag[mask], xerr=magerr[mask], yerr=cat_magerr[mask], fmt = 'k.', label = str(zp_m)+' +- '+str(zp_std))
-    pl.plot(x_fit, fit, lw=2, label='best fit curve')
-    pl.fill_between(x_fit, fit_up, fit_dw, alpha=.25, label='5-sigma interval')
-    pl.legend()
-    pl.savefig(filename+".pdf")
-    pl.close()
-    # Add catalog photometry to sextractor object
-    for ii, kk in enumerate(goodsexlist):
-        kk.cat_mag = mag[ii] + zp_m
-        kk.cat_magerr = np.sqrt(magerr[ii]**2 + zp_std**2)
-    writeregionfile(temp_filename+'.cal.im.reg', goodsexlist, 'red', 'img')
+
+    return zp_m, zp_std, mag, magerr, cat_mag, cat_magerr, mask
+
+
+def mesh_header(w, mesh_size):
+    """
+    Header with the celestial WCS of w for a map with one pixel per mesh_size x mesh_size cell of the image (distortions dropped).
+    """
+    mesh_w = w.celestial.deepcopy()
+    mesh_w.sip = None
+    mesh_w.wcs.crpix = (mesh_w.wcs.crpix - 0.5) / mesh_size + 0.5
+    if mesh_w.wcs.has_cd():
+      mesh_w.wcs.cd = mesh_w.wcs.cd * mesh_size
+    else:
+      mesh_w.wcs.cdelt = mesh_w.wcs.cdelt * mesh_size
+    return mesh_w.to_header()
+
+
+def interpolate_mesh(mesh, x, y, mesh_size):
+    """
+    Bilinear interpolation of a map with one pixel per mesh_size x mesh_size image cell at the (1-based) image positions x, y.
+    """
+    from scipy.ndimage import map_coordinates
+    return map_coordinates(mesh, [(np.asarray(y) - 0.5) / mesh_size - 0.5, (np.asarray(x) - 0.5) / mesh_size - 0.5], order=1, mode='nearest')
+
+
+def measure_limits(image_name, product_name, scratch_name, goodsexlist, zp_m, zp_std, pixscale, saturation, gain, config, limmag_map = False, memory_budget = None):
+    """
+    Limits stage: seeing of the calibration stars, background rms and limiting magnitude of the image, from a second sextractor run with the fitted zero point. Writes the calibrated image <product_name>_calibrated.fits and the region file of all objects. Returns fwhm, seeing_fwhm, rms, lim_mag and the SourceList of all objects, with their calibrated magnitudes or upper limits (error 9.99) in cat_mag and cat_magerr.
+
+    With limmag_map = True the background rms and limiting magnitude come from sextractor's low-resolution background RMS mesh instead of the full-resolution RMS image. The limiting magnitude of every mesh cell is stored as the LIMMAG image extension of the calibrated image, and the upper limits of the objects are interpolated from it.
+
+    With a memory_budget (in MB) the background rms statistics are accumulated in a histogram and the calibrated image is written strip by strip.
+    """
+    from astropy.io import fits
 
     # Get seeing fwhm for catalog object
-    fwhm = np.zeros(len(goodsexlist))
-    for ii, kk in enumerate(goodsexlist):
-        fwhm[ii] = kk.fwhm
+    fwhm = goodsexlist.fwhm.astype(float)
 
     # Filtered mean and std seeing FWHM in pixels
     l_fwhm, m_fwhm, h_fwhm = np.percentile(fwhm, [16, 50, 84])
@@ -684,81 +663,343 @@ def autocal(filename = "../test_data/FORS_R_OB_ana.fits", catalog = "SDSS", sigc
     # Median seeing in arcsec for sextractor
     seeing_fwhm = fwhm*pixscale[0] * 3600 # Seeing in arcsec
     # gain = 1e4
-    try:
-       # Sextract the image using the derived zero-point and fwhm!
-       subprocess.run(['sex', '%s'%temp_filename, '-c', 'sex_temp.config', '-SEEING_FWHM', '%s'%seeing_fwhm, '-SATUR_LEVEL', '%s'%saturation, '-MAG_ZEROPOINT', '%s'%zp_m, '-CATALOG_NAME', 'temp_sex_obj.cat', '-GAIN', '%s'%gain, '-CHECKIMAGE_NAME', '%s_objfree.fits, %s_backrms.fits, %s_aper.fits'%(temp_filename, temp_filename, temp_filename), '-CHECKIMAGE_TYPE', '-OBJECTS, BACKGROUND_RMS, APERTURES', '-DETECT_THRESH', '3', '-BACK_SIZE', '64', '-BACK_FILTERSIZE', '3', '-DEBLEND_NTHRESH', '64', '-DEBLEND_MINCONT', '0.0001'])
-    except (OSError, IOError):
-       logger.warn("Sextractor failed to be executed.", exc_info=1)
-       sys.exit(1)
-
-
-
-    # From sextractors background rms image, get variance
-    back_rms_image = fits.open("%s_backrms.fits"%temp_filename)
-    l_rms, m_rms, h_rms = np.percentile(back_rms_image[0].data, [16, 50, 84])
-    sig_l = m_rms - l_rms
-    sig_h = h_rms - m_rms
-    sigma_mask = 3
-    mask = (back_rms_image[0].data > m_rms - sigma_mask * sig_l) & (back_rms_image[0].data < m_rms + sigma_mask * sig_h)
-    back_rms_image[0].data = back_rms_image[0].data[mask]
-    rms, rms_std = np.mean(back_rms_image[0].data), np.std(back_rms_image[0].data)
+    # Sextract the image using the derived zero-point and fwhm! With a limiting magnitude map only the background mesh is needed
+    back_size = 64
+    back_rms_type = 'MINIBACK_RMS' if limmag_map else 'BACKGROUND_RMS'
+    tools.run_sextractor(image_name, config, scratch_name+'_sex_obj.cat', SEEING_FWHM=seeing_fwhm, SATUR_LEVEL=saturation, MAG_ZEROPOINT=zp_m, GAIN=gain,
+                         CHECKIMAGE_NAME=['%s_objfree.fits'%scratch_name, '%s_backrms.fits'%scratch_name, '%s_aper.fits'%scratch_name],
+                         CHECKIMAGE_TYPE=['-OBJECTS', back_rms_type, 'APERTURES'], DETECT_THRESH=3, BACK_SIZE=back_size, BACK_FILTERSIZE=3, DEBLEND_NTHRESH=64, DEBLEND_MINCONT=0.0001)
+
+
+
+    # From sextractors background rms image (or mesh), get variance
+    if memory_budget is not None and not limmag_map:
+      import strips
+      rms_hist = strips.image_histogram("%s_backrms.fits"%scratch_name, memory_budget)
+      l_rms, m_rms, h_rms = rms_hist.percentile([16, 50, 84])
+      sigma_mask = 3
+      rms, rms_std = rms_hist.clipped_mean(m_rms - sigma_mask * (m_rms - l_rms), m_rms + sigma_mask * (h_rms - m_rms))
+    else:
+      back_rms_image = fits.open("%s_backrms.fits"%scratch_name)
+      rms_mesh = back_rms_image[0].data
+      l_rms, m_rms, h_rms = np.percentile(back_rms_image[0].data, [16, 50, 84])
+      sig_l = m_rms - l_rms
+      sig_h = h_rms - m_rms
+      sigma_mask = 3
+      mask = (back_rms_image[0].data > m_rms - sigma_mask * sig_l) & (back_rms_image[0].data < m_rms + sigma_mask * sig_h)
+      back_rms_image[0].data = back_rms_image[0].data[mask]
+      rms, rms_std = np.mean(back_rms_image[0].data), np.std(back_rms_image[0].data)
 
 
 
+    from upper_limit import limiting_magnitude
     lim_mag = limiting_magnitude(img_rms = rms, img_fwhm = fwhm, img_zp = zp_m, sigma_limit = 5)
     print("Limiting magnitude")
     print(lim_mag)
 
-    fin_img = fits.open('%s_aper.fits'%temp_filename)
+    fin_img = fits.open('%s_aper.fits'%scratch_name, memmap = memory_budget is not None)
     fin_img[0].header["LIMMAG"] = lim_mag[0]
-    fin_img.writeto('%s_calibrated.fits'%temp_filename, clobber = True)
+    if limmag_map:
+      # Limiting magnitude per background mesh cell, vectorized over the cells
+      from upper_limit import limiting_magnitude_map
+      from astropy import wcs
+      lim_map = limiting_magnitude_map(rms_mesh, img_fwhm = fwhm, img_zp = zp_m, sigma_limit = 5)
+      lim_map[~np.isfinite(lim_map)] = lim_mag[0]
+      fin_img.append(fits.ImageHDU(lim_map.astype('float32'), mesh_header(wcs.WCS(fin_img[0].header), back_size), name='LIMMAG'))
+    if memory_budget is not None:
+      import strips
+      strips.copy_image('%s_aper.fits'%scratch_name, '%s_calibrated.fits'%product_name, fin_img[0].header, memory_budget)
+      for hdu in fin_img[1:]:
+        fits.append('%s_calibrated.fits'%product_name, hdu.data, hdu.header)
+    else:
+      fin_img.writeto('%s_calibrated.fits'%product_name, overwrite = True)
 
     # Read in the sextractor catalog
     try:
-       cat = open("temp_sex_obj.cat",'r')
-       catlines = cat.readlines()
-       cat.close()
+       sexlist = SourceList.from_sextractor(scratch_name+'_sex_obj.cat')
     except:
         logger.warn("Cannot load sextractor output file!", exc_info=1)
         sys.exit(1)
 
-    if len(catlines) == 0:
+    if len(sexlist) == 0:
         logger.warn("Sextractor catalog is empty: try a different catalog?", exc_info=1)
         sys.exit(1)
 
-    l = -1
-    sexlist = []
-    while l < len(catlines)-1:
-        l += 1
-        if (len(catlines[l]) <= 1 or catlines[l][0] == '#'):
-            continue
-        iobj = SexObj(catlines[l]) #process the line into an object
-        sexlist.append(iobj)
-
-    for ii, kk in enumerate(sexlist):
-        if kk.mag <= lim_mag:
-          kk.cat_mag = kk.mag
-          kk.cat_magerr = np.sqrt(kk.magerr**2 + zp_std**2)
-        elif kk.mag > lim_mag:
-          kk.cat_mag = lim_mag
-          kk.cat_magerr = 9.99
-        else:
-          sys.exit(1)
-    writeregionfile(temp_filename+'.obj.im.reg', sexlist, 'red', 'img')
+    # Upper limits at the position of each object, or the global limit
+    if limmag_map:
+      obj_lim = interpolate_mesh(lim_map, sexlist.x, sexlist.y, back_size)
+    else:
+      obj_lim = np.full(len(sexlist), lim_mag[0])
 
-    try:
-        for fl in glob.glob("*temp*"):
-            os.remove(fl)
-    except:
-       print('Could not remove temp files for some reason')
+    if np.any(np.isnan(sexlist.mag)):
+      sys.exit(1)
+    detected = sexlist.mag <= obj_lim
+    sexlist.cat_mag = np.where(detected, sexlist.mag, obj_lim)
+    sexlist.cat_magerr = np.where(detected, np.sqrt(sexlist.magerr**2 + zp_std**2), 9.99)
+    writeregionfile(product_name+'.obj.im.reg', sexlist, 'red', 'img')
+
+    return fwhm, seeing_fwhm, rms, lim_mag, sexlist
+
+
+def autocal(filename = "../test_data/FORS_R_OB_ana.fits", catalog = "SDSS", sigclip = 50, objlim = 75, filter = None, cosmic_rejection = True, astrometry = True, diagnostics = False, ext = 0, reference = None, mag_limits = None, sigma_mask = 3, cache = True, limmag_map = False, memory_budget = None, archive = None, sequence = None, sequence_nsigma = 5, trace_memory = False):
+
+    """
+    Rutine to automatically do astrometric calibration and photometry of detected sources. Uses astrometry.net to correct the astrometric solution of the image. Input images need to be larger than ~10 arcmin for this to work. This correction includes image distortions. Queries  Pan-STARRS, SDSS and USNO in that order for coverage for reference photometry against which to do the calibration. This is achieved with gr_cat.py developed by Thomas Krühler which can be consulted for additional documentation. Sextractor is run on the astrometrically calibrated image using the function sextract, heavily inspired by autoastrometry.py by Daniel Perley and available at http://www.dark-cosmology.dk/~dperley/code/code.html. Handling of the entire sextractor interfacing is heavily based on autoastrometry.py. The two lists of images are then matched with a k-d tree algorithm and sextracted magntiudes can be calibrated against the chosen catalog.
+
+    The calibration runs as the stages clean, solve, extract, catalog, match, fit and limits. With cache = True the result of each stage is kept in the stage cache (stages.py) under a hash of its inputs and parameters, so a re-run with e.g. a new sigma_mask (the outlier clipping of the zero-point fit) or catalog only recomputes the stages that depend on it.
+
+    Diagnostic plots are opt-in: diagnostics="store" saves the zero-point fit to <filename>.zp.npz for a later render-diagnostics step (diagnostics.py), diagnostics="render" (or True) additionally renders <filename>.pdf in a background worker. Plotting never blocks the calibration.
+
+    mag_limits = (bright, faint) restricts the reference catalog query to the useful magnitude range. With mag_limits="auto" the range is estimated from the saturation level, the image noise and a zero point and seeing guess from the header (MAGZPT/PHOTZP/MAGZERO and SEEING keywords).
+
+    With limmag_map = True the limiting magnitude is mapped over the image from the background RMS mesh and stored as the LIMMAG extension of the calibrated image, and the upper limits of undetected objects are position dependent (see measure_limits).
+
+    astrometry = "refine" only refines the header WCS for a small offset and rotation against the reference catalog, which is much faster than a blind astrometry.net solve when the telescope pointing is good; astrometry.net runs only if the refinement fails.
 
+    memory_budget (in MB) turns on the streaming mode for images larger than memory: the image is cleaned and written in row strips sized to the budget, and whole-image statistics are accumulated strip by strip (see strips.py).
 
+    sequence lists the exposures of a sequence of the same field that filename belongs to (see sequence.py). With cosmic_rejection and at least three exposures, cosmic rays are found by comparing the frame with the median of the sequence, at sequence_nsigma times the expected noise, instead of with astroscrappy. This is much cheaper, and the work is shared by the exposures of the sequence.
+
+    archive names a detection archive database (see archive.py) to which the frame and all its calibrated objects and upper limits are appended.
+
+    Unless a reference is given, the catalog query starts in a background thread as soon as the header is read, for the header footprint with a 20% margin, so the download overlaps cleaning and solving; it is only repeated if the solved footprint falls outside that circle. The external tools run with the timeouts of tools.py.
+
+    ext selects the image extension to calibrate (see autocal_mef for whole mosaics), and reference can pass an already retrieved (ReferenceCatalog, k-d tree) pair from get_reference_catalog.
+
+    With trace_memory = True the memory use of each stage is recorded (see stages.py): peak RSS, peak traced allocations and the top allocating source lines. This slows the calibration down, while the stages run only. The allocations of the background catalog download are counted in the stage that runs meanwhile.
+
+    catalog can also be a comma-separated priority list, e.g. "PS,SDSS,APASS,USNO", whose catalogs are queried concurrently (see gr_cat.race_catalogs); CATALOG in the result is the catalog actually used and CATALOG_REASON why it was chosen.
+
+    Returns a dictionary with the zero point, seeing and limiting magnitude of the frame, the wall time of each stage in TIMINGS and, with trace_memory, the memory use of each stage in MEMORY.
+    """
+
+    from astropy.io import fits
+    timings = {}
+    memory = {} if trace_memory else None
+
+    # temp_filename = filename
+    if ext == 0:
+      frame_name = filename
+      temp_filename = filename.replace("fits", "")+"temp"
+    else:
+      frame_name = "%s.ext%i" % (filename, ext)
+      temp_filename = filename.replace("fits", "")+"ext%i.temp" % ext
+    # Scratch files of this frame go to the tmpfs scratch directory and all start with scratch_name; they are removed at
+    # the end. The products (calibrated image and region files) are written next to the input file. In streaming mode
+    # the full-size scratch images would take up memory on tmpfs, so they go to disk.
+    scratch = tools.scratch_dir(on_disk = memory_budget is not None)
+    scratch_name = os.path.join(scratch, os.path.basename(temp_filename))
+    temp_filename = scratch_name
+
+    # Filter and magnitude range from the raw frame, to start the catalog query before cleaning and solving
+    raw = fits.open(filename, memmap=False)
+    raw_header = chip_header(raw, ext)
+    if filter is None:
+      img_filt = get_filter(raw_header)
+    else:
+      img_filt = filter
+    saturation = 30000
+    if mag_limits == "auto":
+      # Section access, so only the subsampled rows are read (memmap cannot scale BZERO/BSCALE integer raw frames)
+      mag_limits = auto_mag_limits(raw_header, raw[ext].section, saturation)
+    raw.close()
+    prefetched = None
+    if reference is None:
+      prefetched = prefetch_reference_catalog(raw_header, img_filt, catalog, mag_limits, timings = timings, cache = cache)
+
+    # Clean for cosmics - raw data is read again rather than cached. A cached cleaned image is kept as a FITS file in the
+    # stage cache, next to the pickled header, gain and readnoise, and read back through a memmap
+    clean_key = stages.stage_key('clean', stages.file_key(filename), ext, cosmic_rejection, sigclip, objlim, memory_budget is not None)
+    clean_cache = cache and cosmic_rejection
+    if cosmic_rejection and memory_budget is None and sequence is not None and len(sequence) >= 3:
+      import sequence as crsequence
+      clean_key = stages.stage_key('clean', stages.file_key(filename), ext, 'sequence', [stages.file_key(x) for x in sequence], sequence_nsigma)
+      clean, clean_args = crsequence.clean_in_sequence, (filename, sequence, ext, sequence_nsigma)
+    else:
+      clean, clean_args = clean_frame, (filename, ext, cosmic_rejection, sigclip, objlim)
+    clean_name = os.path.join(stages.cache_dir if clean_cache else scratch, clean_key + '.fits')
+    if memory_budget is None and not clean_cache:
+      data, header, gain, ron = stages.run(clean_key, clean, *clean_args, timings=timings, memory=memory, cache=False)
+    else:
+      if not os.path.exists(os.path.dirname(clean_name)):
+        os.makedirs(os.path.dirname(clean_name), exist_ok=True)
+      if memory_budget is None:
+        header, gain, ron = stages.run(clean_key, clean_to_file, clean, clean_name, *clean_args, timings=timings, memory=memory, cache=cache, products=[clean_name])[1:]
+      else:
+        # Streaming mode: the cleaned image is written strip by strip
+        header, gain, ron = stages.run(clean_key, clean_frame, filename, ext, cosmic_rejection, sigclip, objlim, clean_name, memory_budget, timings=timings, memory=memory, cache=clean_cache, products=[clean_name])[1:]
+      data = fits.open(clean_name, memmap=True)[0].data
+
+    # Prepare sextractor
+    sexconfig = writeconfigfile(saturation)
+
+    # Attempt astrometric calibration - the refinement also depends on the catalog, and waits for it
+    solve_key = stages.stage_key('solve', clean_key, astrometry, *((catalog, img_filt, sexconfig, mag_limits) if astrometry == "refine" else ()))
+    solve_reference = reference
+    if astrometry == "refine" and prefetched is not None:
+      solve_reference = wait_for_catalog(prefetched[0], timings)
+    header, solved_name = stages.run(solve_key, solve_frame, temp_filename, data, header, astrometry, catalog, img_filt, sexconfig, solve_reference, timings=timings, memory=memory, cache=cache)
+    image_name = os.path.join(scratch, solved_name)
+    product_name = os.path.join(os.path.dirname(filename), solved_name)
+
+    def write_image():
+      # Cosmic-ray rejected, possibly astrometrically calibrated image for sextractor, unless the solve stage just wrote it
+      if not os.path.exists(image_name):
+        fits.PrimaryHDU(data, header).writeto(image_name, output_verify='fix')
+      return image_name
+
+    from astropy import wcs
+    w = wcs.WCS(header)
+    pixscale = wcs.utils.proj_plane_pixel_scales(w)
+    nxpix = header['NAXIS1']
+    nypix = header['NAXIS2']
+
+    # Query the circumscribing circle of the image footprint - radius in arcmin
+    img_ra, img_dec, img_radius = footprint_circle(w.calc_footprint())
+
+    # Get the catalog sources, from the background query if it covers the solved footprint
+    if reference is None and prefetched is not None:
+      from gr_cat import dist
+      reference = wait_for_catalog(prefetched[0], timings)
+      query_ra, query_dec, query_radius = prefetched[1]
+      if dist(img_ra, img_dec, query_ra, query_dec)*60 + img_radius > query_radius:
+        logger.warn("Solved footprint outside of the catalog query circle, querying the catalog again")
+        reference = None
+    if reference is None:
+      catalog_key = stages.stage_key('catalog', img_ra, img_dec, img_radius, img_filt, catalog, mag_limits)
+      reference = stages.run(catalog_key, get_reference_catalog, img_ra, img_dec, img_filt, radius = img_radius, catalog = catalog, maglim = mag_limits, timings=timings, memory=memory, cache=cache, keep=reference_cacheable)
+    cat, cat_tree = clip_to_footprint(reference[0], reference[1], w)
+    cat_key = stages.array_key(cat.ra, cat.dec, cat.mag[img_filt], cat.magerr[img_filt])
+    logger.debug("Reference catalog: %s", cat)
+
+    # Sextract stars to produce image star catalog
+    def extract():
+      return sextract(write_image(), nxpix, nypix, border = 3, corner = 12, saturation=saturation, catname = scratch_name+'_sex.cat', config = sexconfig)
+    extract_key = stages.stage_key('extract', solve_key, saturation, sexconfig)
+    goodsexlist = stages.run(extract_key, extract, timings=timings, memory=memory, cache=cache)
+
+    # Match to the catalog
+    tol = 1e-3 # Distance in degrees - This could change depending on the accuracy of the astrometric solution
+    if "ASTRMS" in header:
+      # A refined WCS comes with its accuracy, so match within a few times its rms (at least 1 arcsec)
+      tol = min(tol, max(5 * header["ASTRMS"], 1.) / 3600)
+    match_key = stages.stage_key('match', extract_key, cat_key, img_filt, tol)
+    goodsexlist = stages.run(match_key, match_catalog, goodsexlist, cat, cat_tree, img_filt, tol, timings=timings, memory=memory, cache=cache)
+
+    # writetextfile('det.init.txt', goodsexlist)
+    writeregionfile(product_name+'.det.im.reg', goodsexlist, 'red', 'img')
+
+    # Fit for zero point
+    fit_key = stages.stage_key('fit', match_key, sigma_mask)
+    zp_m, zp_std, mag, magerr, cat_mag, cat_magerr, mask = stages.run(fit_key, fit_zeropoint, goodsexlist, sigma_mask, timings=timings, memory=memory, cache=cache)
+
+    # Store the fit and, if asked for, render it off the calibration path
+    if diagnostics:
+      from diagnostics import save_zp_diagnostics, submit_zp_diagnostics
+      result_name = save_zp_diagnostics(frame_name, mag[mask], magerr[mask], cat_mag[mask], cat_magerr[mask], zp_m, zp_std)
+      if diagnostics in (True, "render"):
+        submit_zp_diagnostics(result_name)
+
+    # Add catalog photometry to sextractor object
+    goodsexlist.cat_mag = mag + zp_m
+    goodsexlist.cat_magerr = np.sqrt(magerr**2 + zp_std**2)
+    writeregionfile(product_name+'.cal.im.reg', goodsexlist, 'red', 'img')
+
+    # Seeing, background and limiting magnitude from a second sextractor run
+    def limits():
+      return measure_limits(write_image(), product_name, scratch_name, goodsexlist, zp_m, zp_std, pixscale, saturation, gain, sexconfig, limmag_map, memory_budget)
+    limits_key = stages.stage_key('limits', fit_key, saturation, gain, sexconfig, limmag_map)
+    fwhm, seeing_fwhm, rms, lim_mag, objects = stages.run(limits_key, limits, timings=timings, memory=memory, cache=cache, products=[product_name+'_calibrated.fits', product_name+'.obj.im.reg'])
+
+    # Remove the temporary files of this frame only, so frames processed in parallel do not delete each others' files
     try:
-        for fl in glob.glob("*temp*"):
-            os.remove(fl)
+        # The scratch names of this frame, including the astrometry.net output, all start with scratch_name up to "temp"
+        for fl in glob.glob(glob.escape(scratch_name[:-len("temp")])+"*"):
+            if not fl.endswith(('_calibrated.fits', '.reg')):
+                os.remove(fl)
+        if os.path.dirname(clean_name) == scratch and os.path.exists(clean_name):
+            os.remove(clean_name)
     except:
        print('Could not remove temp files for some reason')
 
+    result = {"FILENAME": filename, "EXT": ext, "FILTER": img_filt, "CATALOG": cat.meta.get("catalog", catalog), "CATALOG_REASON": cat.meta.get("reason"), "ZP": zp_m, "ZP_ERR": zp_std, "FWHM": fwhm, "SEEING": seeing_fwhm, "BACK_RMS": rms, "LIMMAG": lim_mag[0], "N_CALIB": len(goodsexlist), "N_OBJ": len(objects), "TIMINGS": timings}
+    if trace_memory:
+      result["MEMORY"] = memory
+
+    # Append the calibrated objects to the detection archive
+    if archive is not None:
+      import archive as detection_archive
+      detection_archive.add_frame(archive, result, header, objects)
+
+    logger.info("Stage timings: %s", ", ".join("%s %.2f s" % (name, t) for name, t in timings.items()))
+    return result
+
+
+def footprint_circle(corners):
+    """
+    Smallest circle around the mean direction of a set of (ra, dec) corner positions in degrees that contains all of them. Returns ra, dec in degrees and the radius in arcmin.
+    """
+    ra_rad, dec_rad = np.radians(corners[:, 0]), np.radians(corners[:, 1])
+    xyz = np.array([np.cos(dec_rad)*np.cos(ra_rad), np.cos(dec_rad)*np.sin(ra_rad), np.sin(dec_rad)]).T
+    center = np.mean(xyz, axis=0)
+    center /= np.linalg.norm(center)
+    center_ra = np.degrees(np.arctan2(center[1], center[0])) % 360
+    center_dec = np.degrees(np.arcsin(center[2]))
+    radius = np.degrees(np.max(np.arccos(np.clip(xyz @ center, -1, 1)))) * 60
+    return center_ra, center_dec, radius
+
+
+def autocal_mef(filename, catalog = "SDSS", filter = None, nworkers = None, **kwargs):
+    """
+    Calibrate every image extension (chip) of a multi-extension FITS file. The reference catalog is retrieved once for the footprint of the whole mosaic, the chips are calibrated in parallel in a pool of nworkers processes with autocal(ext=...), and the per-chip results are written to one combined file, <filename>.chips.dat. Additional keyword arguments are passed on to autocal. Returns the list of per-chip result dictionaries.
+    """
+    from astropy.io import fits
+    from astropy import wcs
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Image extensions and the sky positions of their corners
+    fitsfile = fits.open(filename)
+    exts, corners = [], []
+    for ext, hdu in enumerate(fitsfile):
+      if hdu.header.get('NAXIS', 0) != 2:
+        continue
+      header = chip_header(fitsfile, ext)
+      corners.append(wcs.WCS(header).calc_footprint())
+      exts.append(ext)
+    if filter is None:
+      filter = get_filter(header)
+    fitsfile.close()
+
+    # Circle around the whole mosaic, with some margin for the uncalibrated header WCS
+    mosaic_ra, mosaic_dec, mosaic_radius = footprint_circle(np.concatenate(corners))
+    mosaic_radius *= 1.1
+    mag_limits = kwargs.get("mag_limits")
+    if isinstance(mag_limits, str):
+      mag_limits = None
+    reference = get_reference_catalog(mosaic_ra, mosaic_dec, filter, radius = mosaic_radius, catalog = catalog, maglim = mag_limits)
+    logger.info("%i chips, one %.1f arcmin %s catalog query for the mosaic", len(exts), mosaic_radius, catalog)
+
+    # Calibrate the chips in parallel, sharing the scratch directory of this process
+    tools.scratch_dir(on_disk = kwargs.get("memory_budget") is not None)
+    with ProcessPoolExecutor(max_workers=nworkers) as pool:
+      futures = [pool.submit(autocal, filename = filename, catalog = catalog, filter = filter, ext = ext, reference = reference, **kwargs) for ext in exts]
+      results = []
+      for ext, future in zip(exts, futures):
+        try:
+          results.append(future.result())
+        except (Exception, SystemExit) as e:
+          logger.warn("Calibration of extension %i failed", ext, exc_info=1)
+          results.append({"FILENAME": filename, "EXT": ext, "ERROR": repr(e)})
+
+    # One combined result file for all chips
+    keys = ["EXT", "ZP", "ZP_ERR", "FWHM", "SEEING", "LIMMAG", "N_CALIB"]
+    out = open(filename+'.chips.dat', 'w')
+    out.write('\t'.join(keys)+'\n')
+    for res in results:
+      out.write('\t'.join(str(res.get(key, 'nan')) for key in keys)+'\n')
+    out.close()
+    return results
+
 
 def main():
 
@@ -0,0 +1,300 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Batch mode: calibrate an archive with any number of workers on any number of
+nodes, coordinated through a work queue on a shared filesystem.
+Usage: batch.py options [files]
+Options:
+    -q  <queue_dir>             queue directory on the shared filesystem (required)
+    -a                          add the files given as arguments to the queue
+    -w                          work: claim and calibrate frames until the queue is empty
+    -l                          list the number of jobs in each state
+    -s  <catalog>               reference catalog passed to autocal (default PS)
+    -t  <timeout_in_s>          claims without a heartbeat for this long are recovered (default 600)
+    -n  <max_attempts>          jobs that stalled this many times are moved to failed (default 3)
+    -d  <archive_db>            append the calibrated objects to this detection archive (see archive.py)
+    -m                          record the peak memory and top allocations of each stage in MEMORY (slower)
+
+The queue directory holds one small job file per frame, which moves between the
+subdirectories todo, claimed, done and failed. A worker claims a job by renaming
+it from todo to claimed; rename is atomic, so exactly one worker wins each job.
+While it works, the worker touches the claimed file every few seconds as a
+heartbeat. Any worker recovers claims whose heartbeat is older than the timeout
+(their worker died or the node went away) by renaming them back to todo. A
+worker that only stalled may find its job claimed again by another worker when
+it finishes: it then discards its result and leaves the claim to the new owner.
+The result dictionary of a frame is stored as json in done (or failed, with an ERROR
+entry), so a queue can be inspected and resumed at any time.
+
+The timeout compares modification times written by other nodes with the local
+clock, so it must be generous compared to the clock skew between the nodes.
+
+With a detection archive (-d), give the workers of each node their own archive on a
+local disk: SQLite locking is not reliable on network filesystems.
+
+The MEMORY entries (-m) of the done jobs give the peak resident memory of each
+stage on real frames, to size the memory limits of the workers from.
+"""
+
+import getopt
+import sys
+import os
+import json
+import time
+import random
+import socket
+import hashlib
+import threading
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from autocal import autocal
+
+states = ('todo', 'claimed', 'done', 'failed')
+
+
+def write_json(filename, content):
+    """
+    Write content as json to filename atomically.
+    """
+    part = '%s.%s.%i.part' % (filename, socket.gethostname(), os.getpid())
+    with open(part, 'w') as fp:
+        fp.write(json.dumps(content, default=float) + '\n')
+    os.replace(part, filename)
+
+
+def read_json(filename):
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+def init_queue(queue_dir):
+    for state in states:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+
+def job_name(filename):
+    """
+    Name of the job file of a frame, from a hash of its absolute path.
+    """
+    return hashlib.sha1(os.path.abspath(filename).encode('utf8')).hexdigest()[:16] + '.job'
+
+
+def enqueue(queue_dir, filenames):
+    """
+    Add frames to the queue. Frames that are already queued, claimed, done or failed are skipped. Returns the number of jobs added.
+    """
+    init_queue(queue_dir)
+    added = 0
+    for filename in filenames:
+        name = job_name(filename)
+        if any(os.path.exists(os.path.join(queue_dir, state, name)) for state in states[:2]) or \
+           any(os.path.exists(os.path.join(queue_dir, state, name + '.json')) for state in states[2:]):
+            continue
+        write_json(os.path.join(queue_dir, 'todo', name), {"FILENAME": os.path.abspath(filename), "ATTEMPTS": 0})
+        added += 1
+    return added
+
+
+def claim(queue_dir, worker_id):
+    """
+    Claim a job from the queue. Returns the path of the claimed job file, or None if there is nothing left to claim.
+    """
+    todo = os.listdir(os.path.join(queue_dir, 'todo'))
+    # Random order, so that workers starting together do not all race for the same job
+    random.shuffle(todo)
+    for name in todo:
+        if not name.endswith('.job'):
+            continue
+        claimed = os.path.join(queue_dir, 'claimed', name)
+        try:
+            os.rename(os.path.join(queue_dir, 'todo', name), claimed)
+            # rename keeps the old modification time, so start the heartbeat at once
+            os.utime(claimed)
+            job = read_json(claimed)
+        except (OSError, ValueError):
+            continue  # another worker was faster
+        job["WORKER"] = worker_id
+        job["ATTEMPTS"] = job.get("ATTEMPTS", 0) + 1
+        write_json(claimed, job)
+        return claimed
+    return None
+
+
+def holds_claim(claimed, worker_id):
+    """
+    Whether the claimed job file is still claimed by worker_id. A claim whose heartbeat stalled may have been recovered
+    and claimed again by another worker under the same name.
+    """
+    try:
+        return read_json(claimed).get("WORKER") == worker_id
+    except (OSError, ValueError):
+        return False
+
+
+def heartbeat(claimed, worker_id, stop, interval):
+    """
+    Touch the claimed job file every interval seconds until stop is set or the claim was taken away.
+    """
+    while not stop.wait(interval):
+        try:
+            if not holds_claim(claimed, worker_id):
+                raise OSError
+            os.utime(claimed)
+        except OSError:
+            logger.warn("Claim %s was recovered by another worker", claimed)
+            return
+
+
+def recover(queue_dir, timeout = 600, max_attempts = 3):
+    """
+    Move claims without a heartbeat for timeout seconds back to todo, or to failed once they stalled max_attempts times. Returns the number of recovered jobs.
+    """
+    recovered = 0
+    claimed_dir = os.path.join(queue_dir, 'claimed')
+    for name in os.listdir(claimed_dir):
+        claimed = os.path.join(claimed_dir, name)
+        try:
+            if not name.endswith('.job') or time.time() - os.path.getmtime(claimed) < timeout:
+                continue
+            job = read_json(claimed)
+        except (OSError, ValueError):
+            continue
+        if job.get("ATTEMPTS", 0) >= max_attempts:
+            job["ERROR"] = "Stalled %i times, last on %s" % (job["ATTEMPTS"], job.get("WORKER"))
+            write_json(os.path.join(queue_dir, 'failed', name + '.json'), job)
+            try:
+                os.remove(claimed)
+            except OSError:
+                pass
+            continue
+        try:
+            os.rename(claimed, os.path.join(queue_dir, 'todo', name))
+            logger.info("Recovered stalled job of %s from %s", job["FILENAME"], job.get("WORKER"))
+            recovered += 1
+        except OSError:
+            pass  # recovered by another worker
+    return recovered
+
+
+def work(queue_dir, worker_id = None, interval = 30, timeout = 600, max_attempts = 3, cache = False, **kwargs):
+    """
+    Claim and calibrate frames with autocal(filename, **kwargs) until the queue is empty, recording the results. Returns the number of frames processed by this worker. Every frame is calibrated once, so the stage cache (see stages.py) is off unless cache is set.
+    """
+    init_queue(queue_dir)
+    if worker_id is None:
+        worker_id = "%s:%i" % (socket.gethostname(), os.getpid())
+    nframes = 0
+    while True:
+        recover(queue_dir, timeout, max_attempts)
+        claimed = claim(queue_dir, worker_id)
+        if claimed is None:
+            if len(os.listdir(os.path.join(queue_dir, 'claimed'))) == 0:
+                return nframes
+            # Wait for the claims of other workers to finish or to become stale
+            time.sleep(min(interval, timeout))
+            continue
+
+        job = read_json(claimed)
+        name = os.path.basename(claimed)
+        stop = threading.Event()
+        thread = threading.Thread(target=heartbeat, args=(claimed, worker_id, stop, interval))
+        thread.daemon = True
+        thread.start()
+
+        t0 = time.time()
+        try:
+            result = autocal(filename=job["FILENAME"], cache=cache, **kwargs)
+            state = 'done'
+        except (Exception, SystemExit) as e:
+            logger.warn("Calibration of %s failed", job["FILENAME"], exc_info=1)
+            result = {"FILENAME": job["FILENAME"], "ERROR": repr(e)}
+            state = 'failed'
+        finally:
+            stop.set()
+            thread.join()
+        result["WALLTIME"] = time.time() - t0
+        result["WORKER"] = worker_id
+        if not holds_claim(claimed, worker_id):
+            # Recovered while this worker stalled: the job is another worker's now, which records its own result
+            logger.warn("Claim of %s was recovered by another worker, discarding the result", job["FILENAME"])
+            continue
+        write_json(os.path.join(queue_dir, state, name + '.json'), result)
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
+        nframes += 1
+
+
+def status(queue_dir):
+    """
+    Number of jobs in each state of the queue.
+    """
+    return dict((state, len([x for x in os.listdir(os.path.join(queue_dir, state)) if x.endswith(('.job', '.job.json'))])) for state in states)
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -q   <queue_dir>             queue directory on the shared filesystem (required)
+    -a                           add the files given as arguments to the queue
+    -w                           work: claim and calibrate frames until the queue is empty
+    -l                           list the number of jobs in each state
+    -s   <catalog>               reference catalog passed to autocal (default PS)
+    -t   <timeout_in_s>          claims without a heartbeat for this long are recovered (default 600)
+    -n   <max_attempts>          jobs that stalled this many times are moved to failed (default 3)
+    -d   <archive_db>            append the calibrated objects to this detection archive (see archive.py)
+    -m                           record the peak memory and top allocations of each stage in MEMORY (slower)
+    """
+    queue_dir = archive = None
+    add, work, show, trace_memory = False, False, False, False
+    catalog, timeout, max_attempts = "PS", 600., 3
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'q:awls:t:n:d:m')
+        for o, v in optlist:
+            if o == '-q':
+                queue_dir = v
+            elif o == '-a':
+                add = True
+            elif o == '-w':
+                work = True
+            elif o == '-l':
+                show = True
+            elif o == '-s':
+                catalog = v.upper()
+            elif o == '-t':
+                timeout = float(v)
+            elif o == '-n':
+                max_attempts = int(v)
+            elif o == '-d':
+                archive = v
+            elif o == '-m':
+                trace_memory = True
+        if queue_dir is None:
+            raise getopt.GetoptError('queue directory must be specified.')
+        if not (add or work or show):
+            raise getopt.GetoptError('one of -a, -w or -l must be given.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return queue_dir, add, work, show, catalog, timeout, max_attempts, archive, trace_memory, args
+
+
+def main():
+
+    queue_dir, add, do_work, show, catalog, timeout, max_attempts, archive, trace_memory, args = get_options()
+    if add:
+        print("Added %i frames to %s" % (enqueue(queue_dir, args), queue_dir))
+    if do_work:
+        print("Calibrated %i frames" % work(queue_dir, timeout=timeout, max_attempts=max_attempts, catalog=catalog, archive=archive, trace_memory=trace_memory))
+    if show:
+        print(status(queue_dir))
+
+
+if __name__ == '__main__':
+    main()
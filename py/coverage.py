@@ -0,0 +1,255 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Coverage maps of the reference catalogs as HEALPix MOCs, so gr_cat.py can decide locally which catalog covers a field.
+Usage: coverage.py options
+Options:
+    -o  <output_file>           MOC file to write (required)
+    -a                          all-sky map
+    -d  <dec_min>,<dec_max>     declination band in degrees
+    -f  <field_file>            union of the cones in a text file with ra, dec (degrees) and radius (arcmin) per line
+    -s  <stripe_file>           union of SDSS stripes in a text file with stripe number, mu_min, mu_max (degrees) per line
+    -n  <order>                 HEALPix order of the map (default 7, about 0.5 degree pixels)
+
+A MOC (multi-order coverage map) is a set of nested HEALPix pixels of any
+order. Here it is held as sorted ranges of pixels at its highest order (see
+healpix.pixel_ranges), so testing a position is one ang2pix and a binary
+search. Maps are read from and written to the ASCII serialization of the IVOA
+MOC standard ("3/12-15 4/70 ..."), so maps exported by other tools (e.g. the
+survey MOCs of the CDS) can be used as they are.
+
+The maps of the catalogs are the files <CATALOG>.moc in AUTOCAL_MOC_DIR
+(default: the moc directory next to this file). Pan-STARRS (dec > -30), 2MASS,
+Gaia and APASS are bundled, built with this script (-d -30,90 and -a); pixels
+on the edge of a declination band count as covered. The bundled SDSS map is
+built from the stripe layout of the survey in moc/SDSS.stripes (-s): the Legacy
+stripes within the northern survey ellipse and the southern stripes 76, 82 and
+86. It is conservative, leaving out the later southern imaging and the SEGUE
+stripes, so SDSS is never queried where it has no stars. For the full footprint,
+replace it with the SDSS MOC of the CDS, or build it from the SDSS field centres
+(-f, with the field radius of 7 arcmin; e.g. "select ra, dec, 7 from Field" on
+SkyServer). Without an SDSS map, gr_cat.py asks the SDSS server whether a field
+is covered.
+
+An SDSS stripe is a great circle 2.5 degrees wide, with its node at RA 95
+degrees and inclination 2.5 * (stripe - 10) (less 180 in the south, stripes 46
+and up), so that stripe 10 and stripe 82 are on the celestial equator. mu is the
+great circle longitude along the stripe, equal to RA on the equator.
+"""
+
+import getopt
+import sys
+import os
+import numpy as np
+
+import healpix
+
+moc_dir = os.environ.get("AUTOCAL_MOC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "moc"))
+
+# Maps read so far, by catalog (None if the catalog has no map)
+_maps = {}
+
+
+class MOC:
+    """
+    Sky coverage as half-open ranges [lo, hi) of nested HEALPix pixels at order.
+    """
+
+    def __init__(self, ranges, order):
+        self.ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        self.order = order
+
+    @classmethod
+    def from_pixels(cls, pixels, order):
+        return cls(healpix.pixel_ranges(pixels, order, order), order)
+
+    @classmethod
+    def all_sky(cls):
+        return cls([(0, healpix.npix(0))], 0)
+
+    @classmethod
+    def dec_band(cls, dec_min, dec_max, order = 7):
+        """
+        Pixels at order with any part between dec_min and dec_max, found by sampling the band more densely than the pixel size.
+        """
+        step = healpix.pixel_size(order) / 4.
+        pixels = []
+        for dec in np.append(np.arange(dec_min, dec_max, step), dec_max):
+            n = int(np.ceil(360. * max(np.cos(np.radians(dec)), step / 360.) / step))
+            pixels.append(np.unique(healpix.ang2pix(order, np.linspace(0., 360., n, endpoint=False), dec)))
+        return cls.from_pixels(np.concatenate(pixels), order)
+
+    @classmethod
+    def from_cones(cls, ra, dec, radius, order = 7):
+        """
+        Union of the cones of radius (arcmin) around ra, dec (degrees, arrays), e.g. the fields of a survey.
+        """
+        ra, dec, radius = np.broadcast_arrays(np.atleast_1d(ra), np.atleast_1d(dec), np.atleast_1d(radius))
+        return cls.from_pixels(np.concatenate([healpix.query_disc(order, x, y, r / 60.) for x, y, r in zip(ra, dec, radius)]), order)
+
+    @classmethod
+    def from_stripes(cls, stripes, mu_min, mu_max, order = 7):
+        """
+        Union of SDSS stripes (arrays of stripe numbers and their mu ranges in degrees), found by sampling the stripes
+        more densely than the pixel size.
+        """
+        step = healpix.pixel_size(order) / 4.
+        pixels = []
+        for stripe, lo, hi in zip(np.atleast_1d(stripes), np.atleast_1d(mu_min), np.atleast_1d(mu_max)):
+            incl = np.radians(2.5 * (stripe - 10) - (180. if stripe > 45 else 0.))
+            mu, nu = [np.radians(x.ravel()) for x in np.meshgrid(np.append(np.arange(lo, hi, step), hi) - 95.,
+                                                                 np.append(np.arange(-1.25, 1.25, step), 1.25))]
+            # Great circle coordinates to equatorial: rotate by the inclination about the axis through the node
+            x, y, z = np.cos(mu) * np.cos(nu), np.sin(mu) * np.cos(nu), np.sin(nu)
+            y, z = y * np.cos(incl) - z * np.sin(incl), y * np.sin(incl) + z * np.cos(incl)
+            pixels.append(np.unique(healpix.ang2pix(order, np.degrees(np.arctan2(y, x)) + 95., np.degrees(np.arcsin(z)))))
+        return cls.from_pixels(np.concatenate(pixels), order)
+
+    @classmethod
+    def from_ascii(cls, text):
+        """
+        MOC from the IVOA ASCII serialization, e.g. "3/12-15 4/70".
+        """
+        cells = []
+        order = 0
+        for token in text.replace(',', ' ').split():
+            if '/' in token:
+                order, token = token.split('/')
+                order = int(order)
+            if token == '':
+                continue
+            lo, _, hi = token.partition('-')
+            cells.append((order, int(lo), int(hi or lo) + 1))
+        max_order = max([x[0] for x in cells] + [0])
+        ranges = np.array([(lo << 2*(max_order - o), hi << 2*(max_order - o)) for o, lo, hi in cells], dtype=np.int64).reshape(-1, 2)
+        return cls(merge_ranges(ranges), max_order)
+
+    def to_ascii(self):
+        """
+        IVOA ASCII serialization, with every range split into the largest pixels that fit.
+        """
+        cells = {}
+        for lo, hi in self.ranges.tolist():
+            while lo < hi:
+                depth = 0
+                while depth < self.order and lo % 4**(depth + 1) == 0 and lo + 4**(depth + 1) <= hi:
+                    depth += 1
+                cells.setdefault(self.order - depth, []).append(lo >> 2*depth)
+                lo += 4**depth
+        tokens = []
+        for order in sorted(cells):
+            pixels = np.array(cells[order])
+            runs = healpix.pixel_ranges(pixels, order, order)
+            tokens.append("%i/%s" % (order, " ".join("%i" % lo if hi == lo + 1 else "%i-%i" % (lo, hi - 1) for lo, hi in runs.tolist())))
+        return "\n".join(tokens) + "\n"
+
+    def contains(self, ra, dec):
+        """
+        Whether ra, dec (degrees, scalars or arrays) are covered.
+        """
+        pixels = healpix.ang2pix(self.order, ra, dec)
+        idx = np.searchsorted(self.ranges[:, 0], pixels, side='right') - 1
+        return (idx >= 0) & (pixels < self.ranges[np.clip(idx, 0, None), 1])
+
+    @property
+    def sky_fraction(self):
+        return float(np.sum(self.ranges[:, 1] - self.ranges[:, 0])) / healpix.npix(self.order)
+
+
+def merge_ranges(ranges):
+    """
+    Sorted ranges with overlapping and adjacent ranges merged.
+    """
+    if len(ranges) == 0:
+        return ranges
+    ranges = ranges[np.argsort(ranges[:, 0])]
+    # A range starts a new block if it begins after all earlier ranges end
+    ends = np.maximum.accumulate(ranges[:, 1])
+    starts = np.concatenate([[True], ranges[1:, 0] > ends[:-1]])
+    return np.array([ranges[starts, 0], np.maximum.reduceat(ranges[:, 1], np.where(starts)[0])]).T.reshape(-1, 2)
+
+
+def read_moc(filename):
+    with open(filename) as fp:
+        return MOC.from_ascii(fp.read())
+
+
+def catalog_map(catalog):
+    """
+    Coverage map of a catalog from moc_dir, or None if there is none.
+    """
+    if catalog not in _maps:
+        filename = os.path.join(moc_dir, catalog + ".moc")
+        _maps[catalog] = read_moc(filename) if os.path.exists(filename) else None
+    return _maps[catalog]
+
+
+def covers(catalog, ra, dec):
+    """
+    Whether catalog covers ra, dec (degrees), from its coverage map; None if it has no map.
+    """
+    moc = catalog_map(catalog)
+    if moc is None:
+        return None
+    return bool(moc.contains(ra, dec))
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -o   <output_file>           MOC file to write (required)
+    -a                           all-sky map
+    -d   <dec_min>,<dec_max>     declination band in degrees
+    -f   <field_file>            union of the cones in a text file with ra, dec (degrees) and radius (arcmin) per line
+    -s   <stripe_file>           union of SDSS stripes in a text file with stripe number, mu_min, mu_max (degrees) per line
+    -n   <order>                 HEALPix order of the map (default 7, about 0.5 degree pixels)
+    """
+    output, all_sky, band, field_file, stripe_file, order = None, False, None, None, None, 7
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'o:ad:f:s:n:')
+        for o, v in optlist:
+            if o == '-o':
+                output = v
+            elif o == '-a':
+                all_sky = True
+            elif o == '-d':
+                band = [float(x) for x in v.split(',')]
+            elif o == '-f':
+                field_file = v
+            elif o == '-s':
+                stripe_file = v
+            elif o == '-n':
+                order = int(v)
+        if output is None:
+            raise getopt.GetoptError('output file must be specified.')
+        if [all_sky, band is not None, field_file is not None, stripe_file is not None].count(True) != 1:
+            raise getopt.GetoptError('exactly one of -a, -d, -f or -s must be given.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return output, all_sky, band, field_file, stripe_file, order
+
+
+def main():
+
+    output, all_sky, band, field_file, stripe_file, order = get_options()
+    if all_sky:
+        moc = MOC.all_sky()
+    elif band is not None:
+        moc = MOC.dec_band(band[0], band[1], order)
+    elif field_file is not None:
+        fields = np.loadtxt(field_file, ndmin=2)
+        moc = MOC.from_cones(fields[:, 0], fields[:, 1], fields[:, 2], order)
+    else:
+        stripes = np.loadtxt(stripe_file, ndmin=2)
+        moc = MOC.from_stripes(stripes[:, 0], stripes[:, 1], stripes[:, 2], order)
+    with open(output, 'w') as fp:
+        fp.write(moc.to_ascii())
+    print("%s: %.1f%% of the sky" % (output, 100 * moc.sky_fraction))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Zero-point diagnostic plots, kept off the calibration path.
+Usage: diagnostics.py <result_file> [<result_file> ...]
+
+autocal() stores the matched magnitudes and the fitted zero point of each frame
+in <filename>.zp.npz when run with diagnostics="store" or diagnostics="render".
+This script is the separate render-diagnostics step: it reads the stored results
+and writes the errorbar plot to <filename>.pdf. With diagnostics="render" the
+same rendering is instead done in a background worker while calibration continues.
+"""
+
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+import numpy as np
+
+_executor = None
+
+
+def save_zp_diagnostics(filename, mag, magerr, cat_mag, cat_magerr, zp_m, zp_std):
+    """
+    Store what is needed to draw the zero-point plot of filename. Returns the name of the result file.
+    """
+    result_name = filename + ".zp.npz"
+    np.savez(result_name, filename=filename, mag=mag, magerr=magerr, cat_mag=cat_mag, cat_magerr=cat_magerr, zp_m=zp_m, zp_std=zp_std)
+    return result_name
+
+
+def render_zp_diagnostics(result_name, nstd=5.):
+    """
+    Draw the zero-point errorbar plot from a stored result file. Uses the Agg canvas directly, so no
+    interactive backend or display is needed and the pyplot state machine is never touched.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    res = np.load(result_name)
+    mag, magerr, cat_mag, cat_magerr = res["mag"], res["magerr"], res["cat_mag"], res["cat_magerr"]
+    zp_m, zp_std = float(res["zp_m"]), float(res["zp_std"])
+
+    # prepare confidence level curves
+    x_fit = np.linspace(min(mag), max(mag), 100)
+    fit = x_fit + zp_m
+    fit_up = x_fit + zp_m + nstd * zp_std
+    fit_dw = x_fit + zp_m - nstd * zp_std
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.errorbar(mag, cat_mag, xerr=magerr, yerr=cat_magerr, fmt='k.', label=str(zp_m)+' +- '+str(zp_std))
+    ax.plot(x_fit, fit, lw=2, label='best fit curve')
+    ax.fill_between(x_fit, fit_up, fit_dw, alpha=.25, label='%i-sigma interval' % nstd)
+    ax.legend()
+    fig.savefig(str(res["filename"])+".pdf")
+    return str(res["filename"])+".pdf"
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.warn("Rendering of diagnostics failed: %s", future.exception())
+
+
+def submit_zp_diagnostics(result_name):
+    """
+    Render a stored result file in a single background worker thread. Pending plots are finished
+    when the interpreter exits.
+    """
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(max_workers=1)
+    future = _executor.submit(render_zp_diagnostics, result_name)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def render_diagnostics(result_names):
+    """
+    Render-diagnostics step: draw the plots for a list of stored result files.
+    """
+    for result_name in result_names:
+        try:
+            logger.info("Wrote %s", render_zp_diagnostics(result_name))
+        except (OSError, IOError, KeyError):
+            logger.warn("Could not render %s", result_name, exc_info=1)
+
+
+def main():
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    render_diagnostics(sys.argv[1:])
+
+
+if __name__ == '__main__':
+    main()
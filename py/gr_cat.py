@@ -23,9 +23,12 @@ Usage: grb_cat.py options
 Options:
     -c  <ra_in_deg><dec_in_deg> ra and dec coordinates in degrees
     -r  <rad_in_arcmin>         radius in arcminutes
-    -s  <catalog>               desired catalog (SDSS, USNOB1, 2MASS, DENIS, PS)
+    -s  <catalog>               desired catalog (SDSS, USNOB1, 2MASS, DENIS, PS), or a
+                                comma-separated priority list (e.g. PS,SDSS,APASS,USNO)
+                                to query concurrently (see race_catalogs)
     -b  <band>                  desired band (must exist in requested catalog)
     -f  <output_file>           output file (default is standard output)
+    -m  <bright>,<faint>        only retrieve stars in this magnitude range
 
 There cannot be any white space between coordinates (use + or - to separate).
 Output is sorted by distance to the center in following format:
@@ -43,12 +46,14 @@ import signal
 import numpy as np
 import subprocess
 from socket import setdefaulttimeout
-from astroquery.vizier import Vizier
-from astroquery.sdss import SDSS
-from astropy import coordinates as coords
-import astropy.units as u
-from astropy.table import Table
-setdefaulttimeout(30)
+import transport
+from transport import recorded
+import coverage
+
+
+# Bands of each catalog, and the USNO band used in place of a missing one
+catalog_bands = {'PS': 'grizy', 'SDSS': 'ugriz', 'APASS': 'BVgri', 'GAIA': 'G', 'USNO': 'BRI', '2MASS': 'JHK', 'DENIS': 'IJK'}
+bandmatch = {'g': 'B', 'r':'R', 'i': 'I', 'z': 'I', 'u':'B', 'G':'R'}
 
 
 class Alarm(Exception):
@@ -65,15 +70,17 @@ def get_options():
     -c   <ra_in_deg><dec_in_deg> ra and dec coordinates in degrees
     -r   <rad_in_arcmin>         radius in arcminutes
     -s   <catalog>               desired catalog (SDSS, USNO, DENIS, 2MASS,
-                                                 APASS, GAIA, PS)
+                                                 APASS, GAIA, PS), or a comma-separated
+                                                 priority list to query concurrently
     -b   <band>                  desired band (must exist in requested catalog)
     -f   <output_file>           output file (default is standard output)
     -d   <ds9 region_file>       prodice region file (default is none)
+    -m   <bright>,<faint>        only retrieve stars in this magnitude range
 
     """
-    rad = filename = cat = band = hawki = regionname = None
+    rad = filename = cat = band = hawki = regionname = maglim = None
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'c:r:f:s:b:h:d:')
+        optlist, args = getopt.getopt(sys.argv[1:], 'c:r:f:s:b:h:d:m:')
         for o, v in optlist:
             if o == '-c':
                 if len(v.split('+')) == 2:
@@ -101,6 +108,8 @@ def get_options():
                 band = v
             elif o == '-h':
                 hawki = 1
+            elif o == '-m':
+                maglim = [float(x) for x in v.split(',')]
 
         if hawki == 1:
             rad = '3.9'
@@ -110,32 +119,14 @@ def get_options():
             raise ValueError('radius must be specified.')
 #        print(cat
 
-        if cat not in ['GAIA', 'SDSS','USNO','2MASS', 'DENIS', 'APASS', 'PS']:
+        if cat is None or any(x not in catalog_bands for x in cat.split(',')):
             raise ValueError("""catalog must be specified and one of Gaia,
             SDSS, USNO, 2MASS, DENIS, APASS, PS""")
 
-        DENISbands = 'IJK'
-        SDSSbands = 'ugriz'
-        USNObands = 'BRI'
-        twoMASSbands = 'JHK'
-        APASSbands = 'BVgri'
-        GaiaBands = 'G'
-        PSbands = 'grizy'
-
-        if cat == "PS" and band not in set(PSbands):
-            raise ValueError('For -s PS band needs to be one of '+PSbands)
-        if cat == "SDSS" and band not in set(SDSSbands):
-            raise ValueError('For -s SDSS band needs to be one of '+SDSSbands)
-        if cat == "USNO" and band not in set(USNObands):
-            raise ValueError('For -s USNO band needs to be one of '+USNObands)
-        if cat == "2MASS" and band not in set(twoMASSbands):
-            raise ValueError('For -s 2MASS band needs to be one of '+twoMASSbands)
-        if cat == "DENIS" and band not in set(DENISbands):
-            raise ValueError('For -s DENIS band needs to be one of '+DENISbands)
-        if cat == "APASS" and band not in set(APASSbands):
-            raise ValueError('For -s APASS band needs to be one of '+APASSbands)
-        if cat == "GAIA" and band not in set(GaiaBands):
-            raise ValueError('For -s Gaia band needs to be one of '+GaiaBands)
+        # In a priority list the band must exist in the first catalog; the others may substitute it
+        first = cat.split(',')[0]
+        if band is None or band not in set(catalog_bands[first]):
+            raise ValueError('For -s %s band needs to be one of %s' % (first.replace('GAIA', 'Gaia'), catalog_bands[first]))
 
         if filename is None:
             # No filename is specified, we will write to stdout.
@@ -147,7 +138,7 @@ def get_options():
         sys.stderr.write('ERROR: %s: %s\n' % (t, v))
         sys.exit(2)
 
-    return ra, dec, rad, filename, cat, band, hawki, regionname
+    return ra, dec, rad, filename, cat, band, hawki, regionname, maglim
 
 
 #==============================================================================
@@ -164,65 +155,60 @@ def isnumber(num):
 
 
 def addzero(val, n):
-    if isnumber(val):
-        val = float(val)
-        if n == 1: valr = '%.0f' %val
-        if n == 2: valr = '%.2f' %val
-        if n == 3: valr = '%.3f' %val
-        if float(val) < 10:
-            if n == 1: valr = '0%.0f' %val
-            if n == 2: valr = '0%.2f' %val
-            if n == 3: valr = '0%.3f' %val
-    return valr
+    """Format val with n = 1, 2 or 3 decimals (none for n = 1), zero-padded to two integer digits. val can be a scalar or an array, which gives an array of strings."""
+    fmt = {1: '%02.0f', 2: '%05.2f', 3: '%06.3f'}[n]
+    valr = np.char.mod(fmt, np.asarray(val, dtype=float))
+    return str(valr) if valr.ndim == 0 else valr
+
+
+def sexa_column(values, scale = 1.):
+    """Float array of a scalar or column of numbers, numeric strings or sexagesimal (d:m:s) strings. Sexagesimal values are converted to decimal units and multiplied by scale (15 for hours to degrees)."""
+    values = np.atleast_1d(np.asarray(values))
+    if values.dtype.kind in 'iuf':
+        return values.astype(float)
+    values = np.char.strip(values.astype(str))
+    out = np.empty(values.shape)
+    sexa = np.char.find(values, ':') >= 0
+    out[~sexa] = values[~sexa].astype(float)
+    if sexa.any():
+        parts = np.array(np.char.split(values[sexa], ':').tolist(), dtype=float)
+        sign = np.where(np.char.startswith(values[sexa], '-'), -1., 1.)
+        out[sexa] = sign * (np.abs(parts[:, 0]) + parts[:, 1]/60. + parts[:, 2]/3600.) * scale
+    return out
 
 
 def sexa2deg(ra, dec):
-    if isnumber(ra):
-        retra = ra
-    else:
-        ra = ra.split(':')
-        retra = (float(ra[0])+float(ra[1])/60.+float(ra[2])/3600.)*15
-
-    if isnumber(dec):
-        retdec = dec
-    else:
-        dec = dec.split(':')
-        if dec[0][0] == '-':
-            retdec = float(dec[0])-float(dec[1])/60.-float(dec[2])/3600.
-        else:
-            retdec = float(dec[0])+float(dec[1])/60.+float(dec[2])/3600.
-    return round(float(retra), 6), round(float(retdec), 6)
+    """ra, dec in degrees from degrees or sexagesimal (h:m:s, d:m:s) strings, rounded to 1e-6 degrees. Scalars give floats, columns give arrays."""
+    retra, retdec = np.round(sexa_column(ra, 15.), 6), np.round(sexa_column(dec), 6)
+    if np.ndim(ra) == 0 and np.ndim(dec) == 0:
+        return float(retra[0]), float(retdec[0])
+    return retra, retdec
 
 
 def deg2sexa(ra, dec):
-    retra = ra
-    if isnumber(ra):
-        ra = float(ra)
-        hours = int(ra/15)
-        minu = int((ra/15.-hours)*60)
-        seco = float((((ra/15.-hours)*60)-minu)*60)
-        retra = '%s:%s:%s' % (addzero(hours, 1),
-                              addzero(minu, 1), addzero(seco, 3))
-    retdec = dec
-    if isnumber(dec):
-        dec = float(dec)
-        degree = int(dec)
-        minutes = int((dec-degree)*60)
-        seconds = float((((dec-degree)*60)-minutes)*60)
-        if dec < 0:
-            retdec = '-%s:%s:%s' % (addzero(-1*degree, 1),
-                                    addzero(-1*minutes, 1),
-                                    addzero(-1*seconds, 2))
-        else:
-            retdec = '+%s:%s:%s' % (addzero(degree, 1),
-                                    addzero(minutes, 1),
-                                    addzero(seconds, 2))
+    """Sexagesimal strings (h:m:s, +d:m:s) of ra, dec in degrees. Scalars give strings, columns give arrays of strings."""
+    scalar = np.ndim(ra) == 0 and np.ndim(dec) == 0
+    ra, dec = np.atleast_1d(sexa_column(ra, 15.)), np.atleast_1d(sexa_column(dec))
+    hours = np.trunc(ra/15.)
+    minu = np.trunc((ra/15.-hours)*60)
+    seco = (((ra/15.-hours)*60)-minu)*60
+    retra = np.char.add(np.char.add(np.char.add(np.char.add(addzero(hours, 1), ':'), addzero(minu, 1)), ':'), addzero(seco, 3))
+
+    absdec = np.abs(dec)
+    degree = np.trunc(absdec)
+    minutes = np.trunc((absdec-degree)*60)
+    seconds = (((absdec-degree)*60)-minutes)*60
+    retdec = np.char.add(np.where(dec < 0, '-', '+'), addzero(degree, 1))
+    retdec = np.char.add(np.char.add(np.char.add(np.char.add(retdec, ':'), addzero(minutes, 1)), ':'), addzero(seconds, 2))
+    if scalar:
+        return str(retra[0]), str(retdec[0])
     return retra, retdec
 
 
 def dist(ra1, dec1, ra2, dec2):
-    ra1, dec1 = np.radians(float(ra1)), np.radians(float(dec1))
-    ra2, dec2 = np.radians(float(ra2)), np.radians(float(dec2))
+    """Haversine separation in degrees between ra1, dec1 and ra2, dec2 (degrees). Scalars or arrays, which broadcast against each other, so one position against a column gives all separations at once."""
+    ra1, dec1 = np.radians(np.asarray(ra1, dtype=float)), np.radians(np.asarray(dec1, dtype=float))
+    ra2, dec2 = np.radians(np.asarray(ra2, dtype=float)), np.radians(np.asarray(dec2, dtype=float))
     dra, ddec = (ra2 - ra1), abs(dec2 - dec1)
     d1 = 2.*np.arcsin(np.sqrt((np.sin(ddec/2.))**2 +
             np.cos(dec1)*np.cos(dec2)*(np.sin(dra/2.))**2))
@@ -230,9 +216,19 @@ def dist(ra1, dec1, ra2, dec2):
     return d2
 
 
+@recorded('SDSS_fields')
 def get_SDSS_runcamfield(ra, dec, radius, release=14):
     """Retrieve run, camcol, field from SDSS."""
     ra, dec = sexa2deg(ra, dec)
+    if transport.server:
+        xid = transport.get_table('/sdss/fields', [('ra', ra), ('dec', dec), ('radius', radius)])
+        if len(xid) == 0:
+            return '', '', ''
+        return xid["run"], xid["camcol"], xid["field"]
+
+    from astroquery.sdss import SDSS
+    from astropy import coordinates as coords
+    import astropy.units as u
     pos = coords.SkyCoord(ra * u.deg, dec * u.deg, frame='fk5')
     xid = SDSS.query_region(pos, radius = (float(radius)/60)*u.deg, data_release=release)
     run, camcol, field = xid["run"], xid["camcol"], xid["field"]
@@ -240,7 +236,9 @@ def get_SDSS_runcamfield(ra, dec, radius, release=14):
     return run, camcol, field
 
 
-def get_Vizier(ra, dec, radius, band, catalog):
+@recorded('Vizier')
+def get_Vizier(ra, dec, radius, band, catalog, maglim=None):
+    """Retrieve all sources within radius (arcmin) from a Vizier catalog, optionally limited to the magnitude range maglim = (bright, faint). Returns an astropy Table, or [] if nothing was found."""
 
     # Pick catalog according to band
     if (band == 'G') and (catalog == 'GAIA'):
@@ -273,126 +271,204 @@ def get_Vizier(ra, dec, radius, band, catalog):
         banderr = 'e_'+bandstr
         columns = [bandstr, banderr]
 
+    if transport.server:
+        params = [('ra', ra), ('dec', dec), ('radius', radius), ('catalog', catalog), ('columns', ','.join(columns))]
+        if maglim is not None:
+            params += [('bright', maglim[0]), ('faint', maglim[1])]
+        return transport.get_table('/vizier', params)
+
+    from astroquery.vizier import Vizier
+    from astropy import coordinates as coords
+    import astropy.units as u
     pos = coords.SkyCoord(ra * u.deg, dec * u.deg, frame='fk5')
-    v = Vizier(columns=['_RAJ2000', '_DEJ2000'] + columns)
+    column_filters = {}
+    if maglim is not None:
+        column_filters[columns[0].strip('<>')] = '%.2f..%.2f' %tuple(maglim)
+    # row_limit=-1 returns all rows instead of the default first 50
+    v = Vizier(columns=['_RAJ2000', '_DEJ2000'] + columns, column_filters=column_filters, row_limit=-1)
     result = v.query_region(pos, radius=(float(radius)/60)*u.deg, catalog=catalog)
+    if len(result) == 0:
+        return []
     return result[result.keys()[0]]
 
 
-def get_SDSS(ra, dec, radius, band, release="dr14"):
-    """Retrieve object list from SDSS. Radius is in arcminutes."""
+@recorded('SDSS')
+def get_SDSS(ra, dec, radius, band, release="dr14", maglim=None):
+    """Retrieve object list from SDSS. Radius is in arcminutes, maglim = (bright, faint) optionally limits the magnitude range."""
+    if transport.server:
+        params = [('ra', ra), ('dec', dec), ('radius', radius), ('band', band)]
+        if maglim is not None:
+            params += [('bright', maglim[0]), ('faint', maglim[1])]
+        return transport.get_table('/sdss', params)
+
+    from astroquery.sdss import SDSS
     query_template = "select p.ra, p.dec, p.%s, p.Err_%s from STAR as p inner join dbo.fGetNearbyObjEq(%s,%s,%s) as N on p.objid = N.objid where ((p.flags & 0x10000000) != 0) AND ((p.flags & 0x8100000c00a4) = 0) AND (((p.flags & 0x400000000000) = 0) AND (p.psfmagerr_%s <= 0.18)) AND (((p.flags & 0x100000000000) = 0) or (p.flags & 0x1000) = 0)"
     query = query_template % (band, band, ra, dec, radius, band)
-    result = SDSS.query_sql(query)
-
+    if maglim is not None:
+        query += " AND (p.%s BETWEEN %.2f AND %.2f)" % (band, maglim[0], maglim[1])
     try:
         result = SDSS.query_sql(query)
-    except:
-        raise RuntimeError("Could not run SDSS.query_sql")
+    except Exception as e:
+        # An IOError, so query_catalog falls back to another catalog when SDSS is down
+        raise IOError("Could not run SDSS.query_sql: %s" % e)
     return result
 
 
-def get_PS(ra, dec, radius, band, ndet=10):
-    # MAST mirrors
-    mirrors = ['http://archive.stsci.edu/panstarrs/search.php',
-               'http://archive.stsci.edu/panstarrs/search.php']
+def covered(catalog, ra, dec, radius):
+    """Whether catalog covers ra, dec (degrees), from its coverage map (see coverage.py). Without a map, SDSS is asked for its fields within radius (arcmin) and other catalogs are assumed to cover the position."""
+    known = coverage.covers(catalog, ra, dec)
+    if known is not None:
+        return known
+    if catalog == 'SDSS':
+        return len(get_SDSS_runcamfield(ra, dec, radius)[0]) > 0
+    return True
+
+
+@recorded('PS')
+def get_PS_cone(ra, dec, radius, band, ndet=10, maglim=None, max_records=50000):
+    """One cone search on the MAST Pan-STARRS service. Returns the ra, dec, mag and e_mag columns, and whether the result was truncated at max_records."""
+    # The MAST search has a single endpoint, so there is nothing to hedge over; a second url only helps if it is a
+    # distinct mirror
+    mirrors = ['http://archive.stsci.edu/panstarrs/search.php']
+    if transport.server:
+        mirrors = [transport.server.rstrip('/') + '/panstarrs/search.php']
 
     params = [('RA', '%.4f' %ra),
               ('DEC', '%.4f' %dec),
-              ('max_records', 1000),
+              ('max_records', max_records),
               ('radius', '%s' %(float(radius))),
               ('outputformat', 'TSV'),
               ('selectedColumnsCsv',
                    'raMean,decMean,%sMeanApMag,%sMeanApMagErr' %(band, band)),
               ('nDetections', '>%i' %ndet),
               ('action', 'Search'),]
+    if maglim is not None:
+        # Server-side magnitude range, so unusable stars are never transferred
+        params.append(('%sMeanApMag' %band, '%.2f..%.2f' %tuple(maglim)))
 
-    data = urllib.parse.urlencode(params, 1).encode("utf-8")
-    i = 0
-    saved_timeout = socket.setdefaulttimeout(45)
-
+    # Hedged over the mirrors through the pooled client; raises IOError if no mirror answers
+    lines = transport.post(mirrors, params, timeout=45).splitlines()
 
-    while i < len(mirrors):
-        try:
-            url = mirrors[i]
-            try:
-                fp = urllib.request.urlopen(url, data)
-                lines = [x.decode('utf8').strip() for x in fp.readlines()]
-                fp.close()
-            except (OSError, IOError):
-                t, v = sys.exc_info()[:2]
-                if i + 1 == (len(mirrors)):
-                    sys.stderr.write('ERROR: %s: %s\n' % (t, v))
-#                    sys.exit(1)
-                else:
-                    sys.stderr.write('WARNING: %s: %s\n' % (t, v))
-            i += 1
-        finally:
-            socket.setdefaulttimeout(saved_timeout)
-
-    output = []
+    # Parse the rows straight into columns, skipping header lines and sources without a measurement
+    columns = [[], [], [], []]
+    nrows = 0
     for p in lines:
         p = p.split('\t')
-        if len(p) == 4 and p[0] != '' and float(p[2]) > 0:
-            output.append(p)
-    result = ['\t'.join(x) for x in output]
-    # Convert output to astropy table
-    result = Table.read(result, format='ascii.tab')
-    return result
+        if len(p) != 4 or p[0] == '':
+            continue
+        try:
+            values = [float(x) for x in p]
+        except ValueError:
+            continue
+        nrows += 1
+        if values[2] > 0:
+            for column, value in zip(columns, values):
+                column.append(value)
+    return [np.array(column) for column in columns], nrows >= max_records
+
+
+def get_PS(ra, dec, radius, band, ndet=10, maglim=None, max_records=50000, max_depth=4):
+    """Retrieve Pan-STARRS sources within radius (arcmin), optionally limited to the magnitude range maglim = (bright, faint). A cone that comes back truncated at max_records is split into seven cones of half the radius (one central and six on a ring at sqrt(3)/2 of the radius, which together cover the full cone), down to max_depth levels, so crowded fields are retrieved completely. Returns an astropy Table, or [] if nothing was found."""
+    from astropy.table import Table
+    pages = []
+    cones = [(ra, dec, float(radius), 0)]
+    while len(cones) > 0:
+        cone_ra, cone_dec, cone_radius, depth = cones.pop()
+        columns, truncated = get_PS_cone(cone_ra, cone_dec, cone_radius, band, ndet=ndet, maglim=maglim, max_records=max_records)
+        if truncated and depth < max_depth:
+            offset = np.sqrt(3)/2 * cone_radius / 60
+            for pa in np.radians(np.arange(0, 360, 60)):
+                cones.append((cone_ra + offset*np.sin(pa)/np.cos(np.radians(cone_dec)), cone_dec + offset*np.cos(pa), cone_radius/2, depth + 1))
+            cones.append((cone_ra, cone_dec, cone_radius/2, depth + 1))
+            continue
+        if truncated:
+            sys.stderr.write('WARNING: Pan-STARRS result still truncated at %i rows\n' % max_records)
+        pages.append(columns)
+
+    ra_col, dec_col, mag_col, err_col = [np.concatenate([page[i] for page in pages]) for i in range(4)]
+    if len(pages) > 1:
+        # Remove sources returned by overlapping cones, and sources outside the requested cone
+        _, unique = np.unique(np.array([ra_col, dec_col]).T, axis=0, return_index=True)
+        ra1, dec1, ra2, dec2 = np.radians(ra), np.radians(dec), np.radians(ra_col[unique]), np.radians(dec_col[unique])
+        sep = 2*np.arcsin(np.sqrt(np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2))
+        keep = unique[np.degrees(sep)*60 <= float(radius)]
+        ra_col, dec_col, mag_col, err_col = ra_col[keep], dec_col[keep], mag_col[keep], err_col[keep]
+    if len(ra_col) == 0:
+        return []
+    return Table([ra_col, dec_col, mag_col, err_col], names=['raMean', 'decMean', '%sMeanApMag' %band, '%sMeanApMagErr' %band])
 
 
 #==============================================================================
 # Main driver method
 #==============================================================================
 
-def main():
+def try_Vizier(ra, dec, radius, band, catalog, maglim=None):
+    """get_Vizier for the fallback chain of query_catalog: a failed query (including a replay without a recording) returns [] like an empty result, so the next catalog is tried. Returns the result and whether the query failed."""
+    try:
+        return get_Vizier(ra, dec, radius, band, catalog, maglim=maglim), False
+    except IOError as e:
+        sys.stderr.write('WARNING: %s\n' % e)
+        return [], True
 
-    """Driver routine that calls the correct subroutine depending on catalog"""
-    ra, dec, radius, filename, catalog, band, hawki, regionname = get_options()
+
+def query_catalog(ra, dec, radius, catalog, band, maglim=None):
+
+    """Query the requested catalog, falling back to other catalogs if it has no coverage. Returns an astropy Table with ra, dec, mag and e_mag columns. maglim = (bright, faint) limits the magnitude range server-side. A comma-separated list of catalogs is queried concurrently instead (race_catalogs). The catalog used and the reason are stored in the meta of the Table, and degraded is set in the meta if a catalog was skipped because its query failed, so the result depends on the services being up and should not be cached. Used in-process by autocal.get_catalog and by the command line driver."""
     ra, dec = sexa2deg(ra, dec)
+    if ',' in catalog:
+        return race_catalogs(ra, dec, radius, catalog.split(','), band, maglim=maglim)
     lines = []
-    bandmatch = {'g': 'B', 'r':'R', 'i': 'I', 'z': 'I', 'u':'B', 'G':'R'}
+    requested = catalog
+    degraded = False
 
     if catalog == 'PS':
-        if ra < -30:
-            print("Couldn't query Pan-Starrs, falling back to SDSS")
-            catalog, band = 'SDSS', bandmatch[band]
+        if not covered('PS', ra, dec, radius):
+            print("Not Pan-STARRS covered, falling back to SDSS")
+            catalog = 'SDSS'
         else:
-            lines = get_PS(ra, dec, radius, band)
-            if lines == []:
+            try:
+                lines = get_PS(ra, dec, radius, band, maglim=maglim)
+            except IOError as e:
+                sys.stderr.write('WARNING: %s\n' % e)
+                lines = []
+            if len(lines) == 0:
                 print("Couldn't query Pan-STARRS, falling back to USNO")
                 catalog, band = 'USNO', bandmatch[band]
+                degraded = True
 
     if catalog == 'SDSS':
-        run, camcol, field = get_SDSS_runcamfield(ra, dec, radius)
-        if [run, camcol, field] == ['', '', '']:
+        if not covered('SDSS', ra, dec, radius):
             if band in 'gri':
                 print("Not SDSS covered, trying APASS for GROND "+band)
                 catalog = 'APASS'
         else:
             print("SDSS covered, querying SDSS")
             try:
-                lines = get_SDSS(ra, dec, radius, band)
+                lines = get_SDSS(ra, dec, radius, band, maglim=maglim)
                 print("SDSS query successfull, using SDSS")
             except IOError:
                 print("Couldn't query SDSS, falling back to USNO")
                 catalog, band = 'USNO', bandmatch[band]
+                degraded = True
 
     if catalog == 'APASS':
-        lines = get_Vizier(ra, dec, radius, band, catalog)
+        lines, failed = try_Vizier(ra, dec, radius, band, catalog, maglim=maglim)
         if isinstance(lines, list):
             print("Couldn't query APASS, falling back to USNO")
             catalog, band = 'USNO', bandmatch[band]
+            degraded = True
 
     if catalog == 'GAIA':
-        lines = get_Vizier(ra, dec, radius, band, catalog)
+        lines, failed = try_Vizier(ra, dec, radius, band, catalog, maglim=maglim)
         if isinstance(lines, list):
             print("Couldn't query Gaia, falling back to USNO")
             catalog, band = 'USNO', bandmatch[band]
+            degraded = True
 
     if catalog == 'DENIS':
-        lines = get_Vizier(ra, dec, radius, band, catalog)
+        lines, failed = try_Vizier(ra, dec, radius, band, catalog, maglim=maglim)
         if isinstance(lines, list):
+             degraded = degraded or failed
              if band == 'I':
                  print("DENIS did not return anything, trying USNO for "+band)
                  catalog = 'USNO'
@@ -402,21 +478,87 @@ def main():
                  catalog = '2MASS'
 
     if catalog in ['USNO', '2MASS']:
-        lines = get_Vizier(ra, dec, radius, band, catalog)
+        lines, failed = try_Vizier(ra, dec, radius, band, catalog, maglim=maglim)
         if isinstance(lines, list):
             raise IOError('Could not retrieve Vizier catalog')
-        if hawki == 1:
-            maxmag = 20
-            for line in lines:
-                if float(line.split()[2]) < maxmag:
-                    maxra, maxdec = float(line.split()[0]), float(line.split()[1])
-                    maxmag = float(line.split()[2])
+    if not isinstance(lines, list):
+        lines.meta['catalog'] = catalog
+        lines.meta['reason'] = 'requested' if catalog == requested else 'fallback from %s' % requested
+        if degraded:
+            lines.meta['degraded'] = True
+    return lines
+
+
+def query_single(ra, dec, radius, catalog, band, maglim=None):
+    """Query one catalog, without falling back to others. Returns an astropy Table, or [] if the catalog does not cover the position or has no stars there. Raises IOError (or the error of the service) if the query fails."""
+    if not covered(catalog, ra, dec, radius):
+        return []
+    if catalog == 'PS':
+        return get_PS(ra, dec, radius, band, maglim=maglim)
+    if catalog == 'SDSS':
+        return get_SDSS(ra, dec, radius, band, maglim=maglim)
+    return get_Vizier(ra, dec, radius, band, catalog, maglim=maglim)
+
+
+def race_catalogs(ra, dec, radius, catalogs, band, maglim=None):
+    """Query the catalogs concurrently and return the result of the first one in the priority order of catalogs that has stars, without waiting for the lower-priority ones; queries still pending are cancelled and the results of those still running are discarded. Catalogs whose coverage map (coverage.py) excludes the position are not queried. A catalog without band is queried in the matching USNO band if it is USNO, and skipped otherwise. The chosen catalog and the reason it was chosen (the failures of the catalogs before it) are stored as catalog and reason in the meta of the returned Table. Raises IOError if no catalog has stars."""
+    from concurrent.futures import ThreadPoolExecutor
+    candidates = []
+    reasons = []
+    for catalog in catalogs:
+        if coverage.covers(catalog, ra, dec) is False:
+            reasons.append('%s does not cover the field' % catalog)
+        elif band in catalog_bands[catalog]:
+            candidates.append((catalog, band))
+        elif catalog == 'USNO' and band in bandmatch:
+            candidates.append((catalog, bandmatch[band]))
+
+    degraded = False
+    executor = ThreadPoolExecutor(max_workers=max(len(candidates), 1))
+    futures = [executor.submit(query_single, ra, dec, radius, catalog, cat_band, maglim) for catalog, cat_band in candidates]
+    executor.shutdown(wait=False)
+    try:
+        for (catalog, cat_band), future in zip(candidates, futures):
+            try:
+                lines = future.result()
+            except Exception as e:
+                reasons.append('%s failed: %s' % (catalog, e))
+                degraded = True
+                continue
+            if len(lines) == 0:
+                reasons.append('%s has no stars here' % catalog)
+                continue
+            lines.meta['catalog'] = catalog
+            lines.meta['reason'] = '; '.join(reasons) if len(reasons) > 0 else 'first choice'
+            if degraded:
+                lines.meta['degraded'] = True
+            print("Using %s %s (%s)" % (catalog, cat_band, lines.meta['reason']))
+            return lines
+    finally:
+        for future in futures:
+            future.cancel()
+    raise IOError('No catalog has stars here: %s' % '; '.join(reasons))
+
+
+def main():
+
+    """Driver routine that calls the correct subroutine depending on catalog"""
+    setdefaulttimeout(30)
+    ra, dec, radius, filename, catalog, band, hawki, regionname, maglim = get_options()
+    ra, dec = sexa2deg(ra, dec)
+    lines = query_catalog(ra, dec, radius, catalog, band, maglim=maglim)
+
+    # ra, dec and magnitude columns of the table
+    cat_ra, cat_dec, cat_mag = [np.asarray(lines.columns[ii], dtype=float) for ii in range(3)]
+    if hawki == 1:
+        # Brightest source brighter than 20 mag
+        bright = np.where(cat_mag < 20)[0]
+        if len(bright) > 0:
+            imax = bright[np.argmin(cat_mag[bright])]
+            maxra, maxdec, maxmag = cat_ra[imax], cat_dec[imax], cat_mag[imax]
     if regionname != None:
         regionname.write('global color=green\n')
-        for line in lines:
-            # line = line.split()
-            regionname.write("fk5; circle(%.6f,%.6f,4p)\n" \
-            %(float(line[0]), float(line[1])))
+        regionname.write(''.join("fk5; circle(%.6f,%.6f,4p)\n" % x for x in zip(cat_ra, cat_dec)))
         regionname.close()
 
 
@@ -427,8 +569,11 @@ def main():
 
 
     if hawki == 1:
-        print('Brightest source at %s with %.2f mag' %(deg2sexa(maxra, maxdec), maxmag))
-        print('Distance = %.1f arcmin' %(dist(ra, dec, maxra, maxdec)*60))
+        if len(bright) == 0:
+            print('No source brighter than 20 mag')
+        else:
+            print('Brightest source at %s with %.2f mag' %(deg2sexa(maxra, maxdec), maxmag))
+            print('Distance = %.1f arcmin' %(dist(ra, dec, maxra, maxdec)*60))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,108 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Minimal HEALPix support in the nested scheme, vectorized with NumPy.
+
+Only what the detection archive and the coverage maps need: the pixel index of
+sky positions (ang2pix, following Gorski et al. 2005 and the reference
+implementation) and the pixels covering a cone. In the nested scheme the pixel
+of a position at order k - 1 is its pixel at order k shifted right by two bits,
+so a pixel at a low order is a contiguous range of pixels at any higher order.
+"""
+
+import numpy as np
+
+
+def nside(order):
+    return 2**order
+
+
+def npix(order):
+    return 12 * 4**order
+
+
+def pixel_size(order):
+    """
+    Approximate pixel size (square root of the pixel area) in degrees.
+    """
+    return np.degrees(np.sqrt(np.pi / 3)) / 2**order
+
+
+def spread_bits(v, order):
+    """
+    Bits of v moved to the even bit positions (bit b to bit 2b) of the result.
+    """
+    v = np.asarray(v, dtype=np.int64)
+    out = np.zeros_like(v)
+    for b in range(order):
+        out |= ((v >> b) & 1) << (2*b)
+    return out
+
+
+def ang2pix(order, ra, dec):
+    """
+    Nested pixel index at order of ra, dec (degrees, scalars or arrays).
+    """
+    ns = nside(order)
+    z = np.sin(np.radians(np.asarray(dec, dtype=float)))
+    tt = np.mod(np.asarray(ra, dtype=float) / 90., 4.)
+    za = np.abs(z)
+
+    # Equatorial region
+    temp1 = ns * (0.5 + tt)
+    temp2 = ns * (z * 0.75)
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp, ifm = jp >> order, jm >> order
+    face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix = jm & (ns - 1)
+    iy = ns - (jp & (ns - 1)) - 1
+
+    # Polar caps
+    polar = za > 2./3
+    if np.any(polar):
+        ntt = np.minimum(tt.astype(np.int64), 3)
+        tp = tt - ntt
+        tmp = ns * np.sqrt(3 * (1 - za))
+        pjp = np.minimum((tp * tmp).astype(np.int64), ns - 1)
+        pjm = np.minimum(((1. - tp) * tmp).astype(np.int64), ns - 1)
+        north = z >= 0
+        face = np.where(polar, np.where(north, ntt, ntt + 8), face)
+        ix = np.where(polar, np.where(north, ns - pjm - 1, pjp), ix)
+        iy = np.where(polar, np.where(north, ns - pjp - 1, pjm), iy)
+
+    return (face.astype(np.int64) << (2*order)) + spread_bits(ix, order) + (spread_bits(iy, order) << 1)
+
+
+def query_disc(order, ra, dec, radius):
+    """
+    Sorted nested pixels at order that overlap the cone of radius (degrees) around ra, dec, found by sampling the cone,
+    padded by one pixel, more densely than the pixel size. May include a few pixels just outside the cone.
+    """
+    step = pixel_size(order) / 4.
+    reach = radius + pixel_size(order)
+    offsets = np.arange(-reach, reach + step, step)
+    xi, eta = np.meshgrid(offsets, offsets)
+    inside = np.hypot(xi, eta) <= reach
+    xi, eta = np.radians(xi[inside]), np.radians(eta[inside])
+    # Gnomonic deprojection of the sample grid around the cone center
+    ra0, dec0 = np.radians(ra), np.radians(dec)
+    denom = np.cos(dec0) - eta * np.sin(dec0)
+    sample_ra = ra0 + np.arctan2(xi, denom)
+    sample_dec = np.arctan2(np.sin(dec0) + eta * np.cos(dec0), np.hypot(xi, denom))
+    return np.unique(ang2pix(order, np.degrees(sample_ra), np.degrees(sample_dec)))
+
+
+def pixel_ranges(pixels, order, to_order):
+    """
+    Half-open ranges [lo, hi) at the higher order to_order covered by nested pixels at order, with adjacent ranges merged.
+    """
+    shift = 2 * (to_order - order)
+    pixels = np.unique(np.asarray(pixels, dtype=np.int64))
+    if len(pixels) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    # Start a new range wherever the pixels are not consecutive
+    starts = np.concatenate([[True], np.diff(pixels) > 1])
+    ends = np.concatenate([starts[1:], [True]])
+    return np.array([pixels[starts] << shift, (pixels[ends] + 1) << shift]).T
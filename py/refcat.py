@@ -0,0 +1,124 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Reference catalogs with named columns, and the registry of photometric
+transformations from the catalog bands to the image filters.
+"""
+
+import numpy as np
+
+
+class ReferenceCatalog:
+    """
+    Reference stars as columns: ra and dec in degrees, and per-band magnitudes and errors in the dictionaries mag and magerr.
+    meta holds the catalog that was queried, the reason it was chosen and whether it is degraded (see
+    gr_cat.query_catalog), if known. Indexing with a mask or index array
+    returns a new catalog with the selected rows.
+    """
+
+    def __init__(self, ra, dec, mag=None, magerr=None, meta=None):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.mag = dict(mag or {})
+        self.magerr = dict(magerr or {})
+        self.meta = dict(meta or {})
+
+    @classmethod
+    def from_table(cls, table, band):
+        """
+        Catalog from a gr_cat.py query result, whose columns are ra, dec, mag and (if available) the magnitude error in band.
+        The catalog, reason and degraded entries of the table meta are kept.
+        """
+        columns = [np.asarray(np.ma.filled(np.ma.asarray(table[col], dtype=float), np.nan)) for col in table.colnames[:4]]
+        magerr = columns[3] if len(columns) > 3 else np.full(len(columns[0]), np.nan)
+        meta = dict((key, table.meta[key]) for key in ('catalog', 'reason', 'degraded') if key in table.meta)
+        return cls(columns[0], columns[1], {band: columns[2]}, {band: magerr}, meta)
+
+    def __len__(self):
+        return len(self.ra)
+
+    def __getitem__(self, idx):
+        return ReferenceCatalog(self.ra[idx], self.dec[idx],
+                                dict((band, mag[idx]) for band, mag in self.mag.items()),
+                                dict((band, magerr[idx]) for band, magerr in self.magerr.items()), self.meta)
+
+    def __repr__(self):
+        return "<ReferenceCatalog: %i stars, bands %s>" % (len(self), ", ".join(self.bands))
+
+    @property
+    def bands(self):
+        return list(self.mag.keys())
+
+    def coords(self):
+        """
+        (N, 2) array of ra, dec for k-d trees.
+        """
+        return np.array([self.ra, self.dec]).T
+
+    def join(self, other, tol=1e-2):
+        """
+        Stars of this catalog that have a counterpart within tol (degrees) in other, with the bands of other added. The
+        result is degraded if either catalog is.
+        """
+        from scipy.spatial import cKDTree
+        distance, indice = cKDTree(other.coords()).query(self.coords(), k=1, distance_upper_bound=tol)
+        matched = np.where(distance < tol)[0]
+        joint = self[matched]
+        joint.meta = dict(self.meta)
+        if other.meta.get('degraded'):
+            joint.meta['degraded'] = True
+        for band in other.bands:
+            joint.mag[band] = other.mag[band][indice[matched]]
+            joint.magerr[band] = other.magerr[band][indice[matched]]
+        return joint
+
+    def to_array(self, band):
+        """
+        Legacy (N, 4) array of ra, dec, mag, magerr in band.
+        """
+        return np.array([self.ra, self.dec, self.mag[band], self.magerr[band]]).T
+
+
+class Transform:
+    """
+    Linear colour-term transformation target = base + slope*(base - color) + offset, applied to all rows at once. The
+    transformation scatter is added in quadrature to the error of the base band.
+    """
+
+    def __init__(self, target, base, color, slope, offset, scatter, reference=''):
+        self.target = target
+        self.base = base
+        self.color = color
+        self.slope = slope
+        self.offset = offset
+        self.scatter = scatter
+        self.reference = reference
+
+    @property
+    def bands(self):
+        return [self.base, self.color]
+
+    def apply(self, cat):
+        """
+        Add the target band to cat (which must hold the base and color bands), in place. Returns cat.
+        """
+        base, color = cat.mag[self.base], cat.mag[self.color]
+        cat.mag[self.target] = base + self.slope*(base - color) + self.offset
+        cat.magerr[self.target] = np.sqrt(cat.magerr[self.base]**2 + self.scatter**2)
+        return cat
+
+
+transforms = {}
+
+
+def register_transform(target, base, color, slope, offset, scatter, reference=''):
+    """
+    Register the transformation used for images in filter target. Adding a filter only needs a call to this function.
+    """
+    transforms[target] = Transform(target, base, color, slope, offset, scatter, reference)
+
+
+# Lupton (2005) transformations from the SDSS bands - http://www.sdss3.org/dr8/algorithms/sdssUBVRITransform.php
+register_transform('R', 'r', 'i', -0.2936, -0.1439, 0.0072, 'Lupton (2005)')
+register_transform('I', 'i', 'z', -0.3780, -0.3974, 0.0063, 'Lupton (2005)')
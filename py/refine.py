@@ -0,0 +1,143 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Fast refinement of a header WCS that is only off by a small shift and rotation.
+
+The offset between the detections and the reference stars projected with the
+header WCS is found by voting: all detection - star pair offsets within the
+maximum shift are histogrammed, for a small grid of trial rotations about the
+image center, and the most populated bin wins. Starting from there, matches
+within a shrinking tolerance are fitted with a rotation, scale and shift
+(a similarity transform) by linear least squares. The fitted transform is
+then folded into CRPIX and the CD matrix of the header. Everything is
+vectorized over the stars; no blind solve is attempted, so it fails (returns
+None) when the header is too far off, and astrometry.net can take over.
+"""
+
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+
+def rotate_coords(ra, dec, dpa_deg, ra0, dec0):
+    """
+    Rotate ra, dec (degrees, scalars or arrays) by dpa_deg about ra0, dec0. This is only valid for small fields away from the pole.
+    """
+    dpa_rad = np.radians(dpa_deg)
+    sindpa = np.sin(dpa_rad)
+    cosdpa = np.cos(dpa_rad)
+    rascale = np.cos(np.radians(dec0))
+
+    x = (np.asarray(ra) - ra0) * rascale
+    y = (np.asarray(dec) - dec0)
+
+    xrot = cosdpa * x - sindpa * y
+    yrot = sindpa * x + cosdpa * y
+    return (xrot / rascale) + ra0, yrot + dec0
+
+
+def similarity_fit(src, dst):
+    """
+    Least-squares rotation, scale and shift taking the (N, 2) positions src to dst. Returns the 2x2 matrix A and the shift t with dst = src @ A.T + t.
+    """
+    n = len(src)
+    design = np.zeros((2*n, 4))
+    design[:n, 0], design[:n, 1], design[:n, 2] = src[:, 0], -src[:, 1], 1
+    design[n:, 0], design[n:, 1], design[n:, 3] = src[:, 1], src[:, 0], 1
+    (a, b, tx, ty), _, _, _ = np.linalg.lstsq(design, np.concatenate([dst[:, 0], dst[:, 1]]), rcond=None)
+    return np.array([[a, -b], [b, a]]), np.array([tx, ty])
+
+
+def vote_offset(det_xy, cat_xy, center, max_offset, max_rotation = 1., bin_size = 2.):
+    """
+    Rotation (degrees, about center) and shift (pixels) of the projected catalog positions cat_xy that lines them up with the detections det_xy best, by histogramming the pair offsets within max_offset pixels for a grid of trial rotations. Returns rotation, shift and the number of pairs in the winning bin.
+    """
+    from scipy.spatial import cKDTree
+    det_tree = cKDTree(det_xy)
+    r_max = max(np.max(np.hypot(*(cat_xy - center).T)), 1.)
+    # Rotation steps that move the outermost star by less than one bin
+    step = np.degrees(bin_size / r_max)
+    rotations = np.arange(-max_rotation, max_rotation + step/2, step) if max_rotation > 0 else np.zeros(1)
+    edges = np.arange(-max_offset, max_offset + bin_size, bin_size)
+
+    best = (0., np.zeros(2), 0)
+    for rotation in rotations:
+        A = np.array([[np.cos(np.radians(rotation)), -np.sin(np.radians(rotation))], [np.sin(np.radians(rotation)), np.cos(np.radians(rotation))]])
+        rotated = (cat_xy - center) @ A.T + center
+        neighbours = det_tree.query_ball_point(rotated, max_offset)
+        counts = np.array([len(x) for x in neighbours])
+        if counts.sum() == 0:
+            continue
+        offsets = det_xy[np.concatenate(neighbours).astype(int)] - np.repeat(rotated, counts, axis=0)
+        hist, _, _ = np.histogram2d(offsets[:, 0], offsets[:, 1], bins=[edges, edges])
+        peak = np.unravel_index(np.argmax(hist), hist.shape)
+        if hist[peak] > best[2]:
+            shift = np.array([edges[peak[0]], edges[peak[1]]]) + bin_size/2
+            best = (rotation, shift, int(hist[peak]))
+    return best
+
+
+def refine_wcs(header, x, y, ra, dec, max_offset = 15., max_rotation = 1., min_matches = 6, max_rms = 1., n_iter = 4, n_brightest = 300):
+    """
+    Header with the WCS refined by matching the detections at pixel positions x, y (1-based, as sextractor) to the reference stars at ra, dec, both ordered by brightness. max_offset (arcsec) and max_rotation (degrees) bound the search. Returns None if fewer than min_matches stars match or the residual rms exceeds max_rms pixels.
+    """
+    from astropy import wcs
+    from scipy.spatial import cKDTree
+    w = wcs.WCS(header)
+    pixscale = np.mean(wcs.utils.proj_plane_pixel_scales(w.celestial)) * 3600
+    nx, ny = header['NAXIS1'], header['NAXIS2']
+    center = np.array([(nx - 1) / 2., (ny - 1) / 2.])
+    max_offset_pix = max_offset / pixscale
+
+    det_xy = np.array([x, y], dtype=float).T[:n_brightest] - 1
+    cat_xy = np.array(w.all_world2pix(ra, dec, 0)).T
+    margin = max_offset_pix + np.radians(max_rotation) * np.hypot(nx, ny) / 2
+    on_image = (cat_xy[:, 0] > -margin) & (cat_xy[:, 0] < nx + margin) & (cat_xy[:, 1] > -margin) & (cat_xy[:, 1] < ny + margin)
+    cat_xy = cat_xy[on_image][:n_brightest]
+    if len(det_xy) < min_matches or len(cat_xy) < min_matches:
+        logger.warn("Too few detections (%i) or reference stars (%i) to refine the WCS", len(det_xy), len(cat_xy))
+        return None
+
+    rotation, shift, votes = vote_offset(det_xy, cat_xy, center, max_offset_pix, max_rotation)
+    if votes < min_matches:
+        logger.warn("No consistent offset found between detections and reference stars (%i votes)", votes)
+        return None
+
+    # Transform taking catalog pixel positions to detection pixel positions, refined with shrinking match tolerances
+    rot = np.radians(rotation)
+    A = np.array([[np.cos(rot), -np.sin(rot)], [np.sin(rot), np.cos(rot)]])
+    t = center - A @ center + shift
+    det_tree = cKDTree(det_xy)
+    tol = 2.5 * 2.
+    for ii in range(n_iter):
+        distance, idx = det_tree.query(cat_xy @ A.T + t, k=1, distance_upper_bound=tol)
+        matched = np.isfinite(distance)
+        if matched.sum() < min_matches:
+            logger.warn("Only %i matches within %.1f pixels when refining the WCS", matched.sum(), tol)
+            return None
+        A, t = similarity_fit(cat_xy[matched], det_xy[idx[matched]])
+        residual = det_xy[idx[matched]] - (cat_xy[matched] @ A.T + t)
+        rms = np.sqrt(np.mean(np.sum(residual**2, axis=1)))
+        tol = max(3 * rms, 1.)
+
+    if rms > max_rms:
+        logger.warn("WCS refinement residual of %.2f pixels too large", rms)
+        return None
+    logger.info("Refined WCS with %i stars: rotation %.3f deg, shift %.2f, %.2f pix, rms %.2f pix", matched.sum(),
+                np.degrees(np.arctan2(A[1, 0], A[0, 0])), t[0], t[1], rms)
+
+    # Fold the transform into the header: world(det) = world_old(A^-1 (det - t))
+    header = header.copy()
+    cd = w.celestial.pixel_scale_matrix @ np.linalg.inv(A)
+    crpix = A @ (w.wcs.crpix - 1) + t + 1
+    for key in list(header.keys()):
+        if key.startswith(('PC1_', 'PC2_', 'CD1_', 'CD2_', 'CDELT1', 'CDELT2')):
+            del header[key]
+    header['CRPIX1'], header['CRPIX2'] = crpix
+    for i in range(2):
+        for j in range(2):
+            header['CD%i_%i' % (i + 1, j + 1)] = cd[i, j]
+    header['ASTREFN'] = (int(matched.sum()), 'Stars used in the WCS refinement')
+    header['ASTRMS'] = (rms * pixscale, '[arcsec] rms of the WCS refinement')
+    return header
@@ -0,0 +1,203 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Sequence mode: calibrate every exposure of a sequence (e.g. an OB) separately, with cosmic rays found across the sequence.
+Usage: sequence.py options files
+Options:
+    -s  <catalog>               reference catalog passed to autocal (default PS)
+    -r  <nsigma>                cosmic-ray threshold in units of the expected noise (default 5)
+    -o                          group the files into OBs by the OB id in the header and run each OB as a sequence
+
+Instead of running astroscrappy on every exposure, each exposure is compared
+with the median of the sequence. The exposures are registered to the first one
+by the integer pixel shifts between their header WCSs, so cosmic rays are not
+smeared by interpolation. They are corrected for their sky level and scaled to
+the exposure time of the first one. A pixel is a cosmic ray if it exceeds the
+median by more than nsigma times the noise expected from gain and readnoise,
+plus a contrast fraction of the source signal that absorbs seeing changes and
+sub-pixel misregistration on stars. Cosmic-ray pixels are replaced with the
+median. Cosmic rays must also stand out from their 3x3 neighbourhood, which
+smooth excesses (stars in exposures with worse seeing) do not. The cube is worked through in row tiles, vectorized along the
+exposure axis, so memory stays bounded by the tile size. Pixels covered by
+fewer than three exposures (at the dither edges) are left alone, and sequences
+of fewer than three exposures fall back to astroscrappy.
+
+Unlike stack.py, the exposures are not combined: each one is calibrated by
+autocal with its own zero point and products, e.g. for light curves.
+"""
+
+import getopt
+import sys
+import os
+import warnings
+import numpy as np
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import stages
+
+# Masks of the last sequence, shared by the autocal runs of its exposures
+_sequence_cache = []
+
+
+def integer_shifts(headers):
+    """
+    Integer pixel shifts (dx, dy) that register each exposure to the first one, from the offsets of their header WCSs at the image center.
+    """
+    from astropy import wcs
+    ref_w = wcs.WCS(headers[0]).celestial
+    center = ((headers[0]['NAXIS1'] - 1) / 2., (headers[0]['NAXIS2'] - 1) / 2.)
+    shifts = []
+    for header in headers:
+        w = wcs.WCS(header).celestial
+        dx, dy = np.array(ref_w.world_to_pixel(w.pixel_to_world(*center))) - center
+        shifts.append((int(round(float(dx))), int(round(float(dy)))))
+    return shifts
+
+
+def sequence_cosmics(filenames, ext = 0, nsigma = 5, contrast = 0.5, tile_rows = 256):
+    """
+    Cosmic rays of every exposure of a sequence, found by comparison with the sequence median. Returns a list with, for
+    each exposure, the flat indices of its cosmic-ray pixels and the values (the median) to replace them with.
+    """
+    from astropy.io import fits
+    from autocal import chip_header, get_gain_ron
+    # Not memory-mapped, which cannot scale BZERO/BSCALE integer raw frames: the pixels are read through section access,
+    # tile by tile, so only the tiles are held in memory
+    fitsfiles = [fits.open(filename, memmap=False) for filename in filenames]
+    headers = [chip_header(fitsfile, ext) for fitsfile in fitsfiles]
+    sections = [fitsfile[ext].section for fitsfile in fitsfiles]
+    if len(set((fitsfile[ext].header['NAXIS2'], fitsfile[ext].header['NAXIS1']) for fitsfile in fitsfiles)) > 1:
+        raise ValueError("The exposures of a sequence must have the same shape")
+    gain, ron = get_gain_ron(headers[0])[:2]
+    shifts = integer_shifts(headers)
+    ny, nx = fitsfiles[0][ext].header['NAXIS2'], fitsfiles[0][ext].header['NAXIS1']
+    n = len(filenames)
+
+    # Sky level and exposure time scaling of each exposure, broadcast along the exposure axis
+    sky = np.array([np.nanmedian(section[::8, :][:, ::8]) for section in sections]).reshape(n, 1, 1)
+    exptime = headers[0].get("EXPTIME", 1.)
+    scale = np.array([exptime / header.get("EXPTIME", exptime) for header in headers]).reshape(n, 1, 1)
+
+    found = [([], []) for ii in range(n)]
+    for y0 in range(0, ny, tile_rows):
+        y1 = min(y0 + tile_rows, ny)
+        # Rows y0 to y1 of the grid of the first exposure, from all exposures
+        tile = np.full((n, y1 - y0, nx), np.nan, dtype=np.float32)
+        for ii, (section, (dx, dy)) in enumerate(zip(sections, shifts)):
+            r0, r1 = max(y0 - dy, 0), min(y1 - dy, ny)
+            c0, c1 = max(-dx, 0), min(nx - dx, nx)
+            if r1 > r0 and c1 > c0:
+                # Full rows are one contiguous read, a column range would be read row by row
+                tile[ii, r0 + dy - y0:r1 + dy - y0, c0 + dx:c1 + dx] = section[r0:r1, :][:, c0:c1]
+        tile = (tile - sky) * scale
+
+        valid = np.sum(np.isfinite(tile), axis=0) >= 3
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # all-NaN pixels outside the overlap
+            median = np.nanmedian(tile, axis=0)
+        # Expected value and noise of every exposure in its own units
+        model = median / scale + sky
+        noise = np.sqrt(np.clip(model, 0, None) / gain + (ron / gain)**2)
+        excess = np.nan_to_num((tile / scale + sky) - model)
+        with np.errstate(invalid='ignore'):
+            threshold = nsigma * noise + contrast * np.clip(model - sky, 0, None)
+            kk, yy, xx = np.nonzero(valid & (excess > threshold))
+
+        # Cosmic rays are sharper than the seeing: the excess must also stand out from the median of its 3x3
+        # neighbourhood, which a star in an exposure with different seeing does not. Only the candidates are checked.
+        oy, ox = [x.ravel() for x in np.mgrid[-1:2, -1:2]]
+        neighbours = excess[kk[:, None], np.clip(yy[:, None] + oy, 0, y1 - y0 - 1), np.clip(xx[:, None] + ox, 0, nx - 1)]
+        sharp = excess[kk, yy, xx] - np.median(neighbours, axis=1) > threshold[kk, yy, xx]
+        kk, yy, xx = kk[sharp], yy[sharp], xx[sharp]
+        values = model[kk, yy, xx]
+        for ii, (dx, dy) in enumerate(shifts):
+            sel = kk == ii
+            found[ii][0].append((yy[sel] + y0 - dy) * nx + (xx[sel] - dx))
+            found[ii][1].append(values[sel])
+
+    for fitsfile in fitsfiles:
+        fitsfile.close()
+    return [(np.concatenate(idx).astype(np.int64), np.concatenate(val).astype(np.float32)) for idx, val in found]
+
+
+def clean_in_sequence(filename, sequence, ext = 0, nsigma = 5, contrast = 0.5):
+    """
+    Clean stage of sequence mode (see autocal.clean_frame): data and header of filename with the cosmic rays found across
+    the sequence replaced, divided by the gain. Returns data, header, gain and readnoise. The masks of all exposures are
+    computed on the first call for a sequence and kept in memory for the others.
+    """
+    from astropy.io import fits
+    from autocal import chip_header, get_gain_ron
+    key = stages.stage_key('sequence', [stages.file_key(x) for x in sequence], ext, nsigma, contrast)
+    cached = [masks for cached_key, masks in _sequence_cache if cached_key == key]
+    if len(cached) > 0:
+        masks = cached[0]
+    else:
+        logger.info("Finding cosmic rays across a sequence of %i exposures", len(sequence))
+        masks = sequence_cosmics(sequence, ext, nsigma, contrast)
+        del _sequence_cache[:]
+        _sequence_cache.append((key, masks))
+
+    fitsfile = fits.open(filename)
+    header = chip_header(fitsfile, ext)
+    gain, ron = get_gain_ron(header)[:2]
+    data = fitsfile[ext].data.astype(np.float32)
+    fitsfile.close()
+    idx, values = masks[[os.path.abspath(x) for x in sequence].index(os.path.abspath(filename))]
+    data.flat[idx] = values
+    logger.info("Replaced %i cosmic-ray pixels of %s", len(idx), filename)
+    return data / gain, header, gain, ron
+
+
+def autocal_sequence(filenames, nsigma = 5, **kwargs):
+    """
+    Calibrate each exposure of a sequence with autocal, with the cosmic rays found across the sequence. Returns the list of autocal results.
+    """
+    from autocal import autocal
+    results = []
+    for filename in filenames:
+        results.append(autocal(filename = filename, sequence = filenames, sequence_nsigma = nsigma, **kwargs))
+    return results
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -s   <catalog>               reference catalog passed to autocal (default PS)
+    -r   <nsigma>                cosmic-ray threshold in units of the expected noise (default 5)
+    -o                           group the files into OBs by the OB id in the header and run each OB as a sequence
+    """
+    catalog, nsigma, by_ob = "PS", 5., False
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 's:r:o')
+        for o, v in optlist:
+            if o == '-s':
+                catalog = v.upper()
+            elif o == '-r':
+                nsigma = float(v)
+            elif o == '-o':
+                by_ob = True
+        if len(args) < 1:
+            raise getopt.GetoptError('no exposures given.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return catalog, nsigma, by_ob, args
+
+
+def main():
+
+    catalog, nsigma, by_ob, filenames = get_options()
+    from stack import group_obs
+    for obs in (group_obs(filenames) if by_ob else [filenames]):
+        for result in autocal_sequence(obs, nsigma = nsigma, catalog = catalog):
+            print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Sextractor detections as columns.
+
+A SourceList holds one NumPy array per quantity instead of one Python object per
+detection, so filtering, matching and writing work on whole columns. Positions
+are kept in double precision; photometry and shape parameters in single
+precision, which brings a detection to about 60 bytes.
+"""
+
+import numpy as np
+
+import refine
+
+
+class SourceList:
+    """
+    Detections as columns: pixel position x, y (1-based, as sextractor), ra and dec in degrees, instrumental magnitude and
+    error, ellipticity, fwhm in pixels and sextractor flags. cat_mag and cat_magerr hold the catalog (or calibrated)
+    magnitude of each detection and are NaN until set. Indexing with a slice, mask or index array returns a new list with
+    the selected rows (views for slices).
+    """
+
+    fields = (('x', np.float64), ('y', np.float64), ('ra', np.float64), ('dec', np.float64),
+              ('mag', np.float32), ('magerr', np.float32), ('ellip', np.float32), ('fwhm', np.float32),
+              ('flag', np.int16), ('cat_mag', np.float32), ('cat_magerr', np.float32))
+
+    def __init__(self, x=(), y=(), ra=(), dec=(), mag=(), magerr=(), ellip=(), fwhm=(), flag=None, cat_mag=None, cat_magerr=None):
+        n = len(x)
+        columns = dict(x=x, y=y, ra=ra, dec=dec, mag=mag, magerr=magerr, ellip=ellip, fwhm=fwhm,
+                       flag=np.zeros(n) if flag is None else flag,
+                       cat_mag=np.full(n, np.nan) if cat_mag is None else cat_mag,
+                       cat_magerr=np.full(n, np.nan) if cat_magerr is None else cat_magerr)
+        for name, dtype in self.fields:
+            setattr(self, name, columns[name])
+
+    def __setattr__(self, name, value):
+        # Columns keep their type when they are replaced, e.g. by the calibrated magnitudes
+        dtype = dict(self.fields).get(name)
+        object.__setattr__(self, name, value if dtype is None else np.asarray(value, dtype=dtype))
+
+    @classmethod
+    def from_sextractor(cls, catname):
+        """
+        Detections of a sextractor ASCII catalog with the columns x, y, ra, dec, mag, magerr, ellipticity, fwhm and optionally flags.
+        """
+        import warnings
+        with warnings.catch_warnings():
+            # An empty catalog is handled by the caller
+            warnings.simplefilter("ignore")
+            data = np.loadtxt(catname, comments='#', ndmin=2)
+        if data.shape[0] == 0:
+            return cls()
+        return cls(*data[:, :8].T, flag=data[:, 8] if data.shape[1] > 8 else None)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, idx):
+        return SourceList(**dict((name, getattr(self, name)[idx]) for name, dtype in self.fields))
+
+    def __repr__(self):
+        return "<SourceList: %i sources>" % len(self)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name, dtype in self.fields)
+
+    def coords(self):
+        """
+        (N, 2) array of ra, dec for k-d trees.
+        """
+        return np.array([self.ra, self.dec]).T
+
+    def rotate(self, dpa_deg, ra0, dec0):
+        """
+        Rotate all positions on the sky by dpa_deg about ra0, dec0, in place. This is only valid for small fields away from the pole.
+        """
+        self.ra, self.dec = refine.rotate_coords(self.ra, self.dec, dpa_deg, ra0, dec0)
@@ -0,0 +1,187 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Per-OB stacking: align and coadd the dithered exposures of an OB, then calibrate only the stack.
+Usage: stack.py options files
+Options:
+    -s  <catalog>               reference catalog passed to autocal (default PS)
+    -c  <combine>               median or mean (default median)
+    -r  <nsigma>                cosmic-ray rejection threshold across exposures (default 5)
+    -o                          group the files into OBs by the OB id in the header and stack each OB
+
+The first exposure is the reference. It is solved with astrometry.net. The other
+exposures are aligned to it with the shifts between their header WCS and the
+reference header WCS. Dither offsets are accurate relative to each other even
+when the absolute pointing is not. The aligned exposures are scaled to the
+exposure time of the reference. Pixels further than nsigma times the expected
+noise (from gain and readnoise) from the median across exposures are rejected.
+This takes the place of single-frame cosmic-ray cleaning. The stack keeps the
+units of one reference exposure, with the gain and readnoise keywords scaled to
+the number of combined exposures, and is calibrated with one autocal run.
+"""
+
+import getopt
+import sys
+import os
+import numpy as np
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from autocal import autocal, chip_header, get_gain_ron, solve_frame
+import tools
+
+
+def group_obs(filenames):
+    """
+    Group exposures into OBs by the OB id keyword (ESO OBS ID), or by object and filter if the header has none. Returns a list of lists of file names, in the order of the files.
+    """
+    from astropy.io import fits
+    groups = {}
+    for filename in filenames:
+        header = fits.getheader(filename)
+        key = header.get("HIERARCH ESO OBS ID", (header.get("OBJECT"), header.get("FILTER")))
+        groups.setdefault(key, []).append(filename)
+    return list(groups.values())
+
+
+def shift_image(data, dx, dy, subpixel = True):
+    """
+    data shifted by dx, dy pixels, with bilinear interpolation (subpixel) or by the nearest integer shift. Pixels shifted in from outside are NaN.
+    """
+    if subpixel:
+        from scipy.ndimage import shift
+        return shift(data, (dy, dx), order=1, mode='constant', cval=np.nan)
+    dx, dy = int(round(dx)), int(round(dy))
+    shifted = np.full(data.shape, np.nan, dtype=data.dtype)
+    ny, nx = data.shape
+    shifted[max(dy, 0):ny + min(dy, 0), max(dx, 0):nx + min(dx, 0)] = data[max(-dy, 0):ny + min(-dy, 0), max(-dx, 0):nx + min(-dx, 0)]
+    return shifted
+
+
+def stack_ob(filenames, stack_name = None, combine = "median", nsigma = 5, ext = 0, astrometry = True, subpixel = True):
+    """
+    Align the exposures of an OB to the first one and combine them with cosmic-ray rejection across exposures. The stack is written to stack_name (default <first file>_stack.fits) with the WCS of the solved reference exposure. Returns stack_name.
+    """
+    from astropy.io import fits
+    from astropy import wcs
+
+    if stack_name is None:
+        stack_name = filenames[0].replace(".fits", "") + "_stack.fits"
+
+    fitsfile = fits.open(filenames[0])
+    ref_header = chip_header(fitsfile, ext)
+    ref_data = fitsfile[ext].data.astype(np.float32)
+    fitsfile.close()
+    ref_w = wcs.WCS(ref_header)
+    gain, ron, gain_key, ron_key = get_gain_ron(ref_header)
+    ref_exptime = ref_header.get("EXPTIME", 1.)
+    ny, nx = ref_data.shape
+
+    # Align the other exposures to the reference with the offsets between the header WCSs
+    cube = np.empty((len(filenames), ny, nx), dtype=np.float32)
+    cube[0] = ref_data
+    center = np.array([(nx - 1) / 2., (ny - 1) / 2.])
+    corners = np.array([[0, 0], [nx - 1, 0], [0, ny - 1], [nx - 1, ny - 1]], dtype=float)
+    for ii, filename in enumerate(filenames[1:], 1):
+        fitsfile = fits.open(filename)
+        header = chip_header(fitsfile, ext)
+        w = wcs.WCS(header)
+        # Position of the pixels of this exposure on the reference grid
+        offsets = np.array(ref_w.world_to_pixel(w.pixel_to_world(corners[:, 0], corners[:, 1]))).T - corners
+        dx, dy = np.array(ref_w.world_to_pixel(w.pixel_to_world(center[0], center[1]))) - center
+        if np.max(np.abs(offsets - [dx, dy])) > 0.5:
+            logger.warn("%s is rotated or scaled with respect to %s, aligning with the shift at the image center only", filename, filenames[0])
+        logger.info("Shifting %s by %.2f, %.2f pixels", filename, dx, dy)
+        scale = ref_exptime / header.get("EXPTIME", ref_exptime)
+        cube[ii] = shift_image(fitsfile[ext].data.astype(np.float32) * scale, dx, dy, subpixel)
+        fitsfile.close()
+
+    # Reject pixels deviating by more than nsigma times the noise expected at the median level
+    median = np.nanmedian(cube, axis=0)
+    noise = np.sqrt(np.clip(median, 0, None) / gain + (ron / gain)**2)
+    rejected = np.abs(cube - median) > nsigma * noise
+    cube[rejected] = np.nan
+    logger.info("Rejected %i pixels across %i exposures", np.sum(rejected), len(filenames))
+    if combine == "median":
+        stack = np.nanmedian(cube, axis=0)
+    elif combine == "mean":
+        stack = np.nanmean(cube, axis=0)
+    else:
+        raise ValueError("combine must be median or mean")
+    ncombine = np.sum(np.isfinite(cube), axis=0)
+    del cube
+
+    # Solve the reference exposure and put its WCS on the stack
+    scratch_name = os.path.join(tools.scratch_dir(), os.path.basename(filenames[0]).replace(".fits", "") + ".stack.temp")
+    header, solved_name = solve_frame(scratch_name, ref_data, ref_header, astrometry)
+    for fl in (scratch_name, os.path.join(tools.scratch_dir(), solved_name)):
+        if os.path.exists(fl):
+            os.remove(fl)
+
+    # Noise properties of the stack in the units of one exposure
+    n_eff = np.median(ncombine)
+    if gain_key is not None:
+        header[gain_key] = gain * n_eff
+        header[ron_key] = ron * np.sqrt(n_eff)
+    header["NCOMBINE"] = (len(filenames), "Number of stacked exposures")
+    header["COMBINE"] = (combine, "Combination of the aligned exposures")
+    for ii, filename in enumerate(filenames):
+        header["IMCMB%03i" % (ii + 1)] = os.path.basename(filename)
+    hdulist = fits.HDUList([fits.PrimaryHDU(stack.astype(np.float32), header), fits.ImageHDU(ncombine.astype(np.int16), name='NCOMBINE')])
+    hdulist.writeto(stack_name, output_verify='fix', overwrite=True)
+    return stack_name
+
+
+def autocal_stack(filenames, combine = "median", nsigma = 5, ext = 0, astrometry = True, **kwargs):
+    """
+    Stack the exposures of an OB with stack_ob and calibrate the stack with one autocal run. Cosmic rays are rejected across the exposures and the stack carries the solved WCS, so autocal runs without its own cosmic-ray cleaning and astrometry. Returns the autocal result of the stack.
+    """
+    stack_name = stack_ob(filenames, combine = combine, nsigma = nsigma, ext = ext, astrometry = astrometry)
+    result = autocal(filename = stack_name, cosmic_rejection = False, astrometry = False, **kwargs)
+    result["NCOMBINE"] = len(filenames)
+    return result
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -s   <catalog>               reference catalog passed to autocal (default PS)
+    -c   <combine>               median or mean (default median)
+    -r   <nsigma>                cosmic-ray rejection threshold across exposures (default 5)
+    -o                           group the files into OBs by the OB id in the header and stack each OB
+    """
+    catalog, combine, nsigma, by_ob = "PS", "median", 5., False
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 's:c:r:o')
+        for o, v in optlist:
+            if o == '-s':
+                catalog = v.upper()
+            elif o == '-c':
+                combine = v.lower()
+            elif o == '-r':
+                nsigma = float(v)
+            elif o == '-o':
+                by_ob = True
+        if combine not in ("median", "mean"):
+            raise getopt.GetoptError('combine must be median or mean.')
+        if len(args) < 2:
+            raise getopt.GetoptError('at least two exposures must be given.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return catalog, combine, nsigma, by_ob, args
+
+
+def main():
+
+    catalog, combine, nsigma, by_ob, filenames = get_options()
+    for obs in (group_obs(filenames) if by_ob else [filenames]):
+        print(autocal_stack(obs, combine = combine, nsigma = nsigma, catalog = catalog))
+
+
+if __name__ == '__main__':
+    main()
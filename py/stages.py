@@ -0,0 +1,229 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Stage-level result cache for autocal.py.
+
+autocal() runs as a chain of stages (clean, solve, extract, catalog, match, fit,
+limits). The result of each stage is stored under a key that hashes the stage
+name, its parameters and the keys of the stages it depends on, so a re-run only
+recomputes the stages whose inputs changed: a new clipping threshold only redoes
+the zero-point fit and what follows it, a new catalog only the catalog and later
+stages. Input files enter the keys by path, size and modification time.
+
+Results are pickled to AUTOCAL_STAGE_CACHE (default ~/.cache/autocal/stages),
+one file per result, and can be removed at any time. Large results (images) are
+not pickled: the stage writes them as product files into the cache directory and
+its result holds their path. The cache is bounded to AUTOCAL_STAGE_CACHE_MB
+(default 2048): after each write the least recently used files are removed
+until it fits, and a cached result is only used if its products still exist.
+
+Besides the wall time, run() can record the memory use of each stage: the peak
+resident set size of the process during the stage (reset before each stage on
+Linux, otherwise the peak so far), the largest resident set size of the external
+tools run so far (sextractor, solve-field), and from tracemalloc the peak of the
+Python-level (including NumPy) allocations and the source lines whose
+allocations grew most over the stage. tracemalloc slows the calibration down
+noticeably, so this is off unless asked for, and it is only switched on for the
+duration of each stage, so a long-lived process (watch.py, batch.py) does not
+keep paying for it after one traced frame. tracemalloc traces all threads: the
+allocations of the catalog download running in the background (see
+autocal.prefetch_reference_catalog) are counted in whichever stage runs
+meanwhile.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+cache_dir = os.environ.get("AUTOCAL_STAGE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "autocal", "stages"))
+cache_size = float(os.environ.get("AUTOCAL_STAGE_CACHE_MB", 2048))
+# Part of every key; bump it when the type of a stage result changes, so results pickled by older code are not read back
+version = 5
+
+
+def file_key(filename):
+    """
+    Identity of an input file for stage keys: absolute path, size and modification time.
+    """
+    st = os.stat(filename)
+    return [os.path.abspath(filename), st.st_size, st.st_mtime]
+
+
+def array_key(*arrays):
+    """
+    Hash of the content of a set of arrays, for inputs that are not produced by a stage (e.g. a passed-in catalog).
+    """
+    sha = hashlib.sha1()
+    for arr in arrays:
+        sha.update(np.ascontiguousarray(arr).tobytes())
+    return sha.hexdigest()[:16]
+
+
+def stage_key(name, *inputs):
+    """
+    Key of a stage result from its name and inputs (parameters and the keys of upstream stages).
+    """
+    text = json.dumps([name, version, inputs], sort_keys=True, default=str)
+    return "%s-%s" % (name, hashlib.sha1(text.encode('utf8')).hexdigest()[:16])
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, which only Linux allows. Returns whether it was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except (OSError, IOError):
+        return False
+
+
+def peak_rss(who = "self"):
+    """
+    Peak resident set size in MB of this process (who = "self"), or of the largest child process so far (who = "children").
+    """
+    if who == "self":
+        try:
+            with open('/proc/self/status') as fp:
+                for line in fp:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024.
+        except (OSError, IOError):
+            pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 2.**20 if sys.platform == 'darwin' else peak / 1024.
+
+
+def start_memory_trace():
+    """
+    Start measuring the memory use of a stage, starting tracemalloc unless it is running already. Returns the state to
+    pass to stop_memory_trace.
+    """
+    import tracemalloc
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    reset = reset_peak_rss()
+    return reset, tracemalloc.take_snapshot(), started
+
+
+def end_memory_trace(state):
+    """
+    Stop tracemalloc if start_memory_trace started it.
+    """
+    import tracemalloc
+    if state[2]:
+        tracemalloc.stop()
+
+
+def stop_memory_trace(state, top = 5):
+    """
+    Memory use of a stage since start_memory_trace: peak RSS of the process and of its child processes, peak traced
+    allocations, and the top source lines by allocation growth. Sizes in MB. Ends the trace (see end_memory_trace).
+    """
+    import tracemalloc
+    reset, before = state[:2]
+    # The snapshots themselves are not part of the stage
+    own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    growth = tracemalloc.take_snapshot().filter_traces(own).compare_to(before.filter_traces(own), 'lineno')
+    growth.sort(key=lambda stat: -stat.size_diff)
+    usage = {"RSS_PEAK_MB": peak_rss(), "RSS_PEAK_RESET": reset, "CHILD_RSS_PEAK_MB": peak_rss("children"),
+             "TRACED_PEAK_MB": tracemalloc.get_traced_memory()[1] / 2.**20,
+             "TOP": ["%s: %+.1f MB" % (stat.traceback[0], stat.size_diff / 2.**20) for stat in growth[:top]]}
+    end_memory_trace(state)
+    return usage
+
+
+def prune(keep = ()):
+    """
+    Remove the least recently used files of the stage cache until it is smaller than cache_size, except the files in keep.
+    Files are used when they are written or read back (see run), which sets their modification time.
+    """
+    files = []
+    try:
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+    except OSError:
+        return  # removed by another worker meanwhile
+    total = sum(size for mtime, size, path in files)
+    keep = [os.path.abspath(fl) for fl in keep]
+    for mtime, size, path in sorted(files):
+        if total <= cache_size * 2**20:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def run(key, func, *args, timings=None, memory=None, cache=True, products=(), keep=None, **kwargs):
+    """
+    Result of func(*args, **kwargs) for the stage with the given key, read from the cache if it holds one. A cached
+    result is only used if all files in products (files the stage writes besides its result) exist; products in the
+    cache directory count towards its size and are evicted like results (see prune). The wall time
+    of the stage is stored in timings[stage name], with the stage name from the key, and if memory is a dictionary,
+    the memory use of the stage (see stop_memory_trace) in memory[stage name]. If keep is given, a new result is only
+    cached if keep(result) is true, e.g. not when it depends on a service being down.
+    """
+    name = key.split('-')[0]
+    path = os.path.join(cache_dir, key + '.pkl')
+    if memory is not None:
+        state = start_memory_trace()
+    t0 = time.time()
+    if cache and os.path.exists(path) and all(os.path.exists(fl) for fl in products):
+        try:
+            with open(path, 'rb') as fp:
+                result = pickle.load(fp)
+            # Mark the result and its products as recently used
+            for fl in [path] + [x for x in products if os.path.dirname(os.path.abspath(x)) == os.path.abspath(cache_dir)]:
+                os.utime(fl)
+            if timings is not None:
+                timings[name] = time.time() - t0
+            if memory is not None:
+                memory[name] = stop_memory_trace(state)
+            logger.info("Stage %s: cached", name)
+            return result
+        except (OSError, IOError, EOFError, pickle.UnpicklingError):
+            logger.warn("Could not read cached result %s, recomputing", path, exc_info=1)
+
+    try:
+        result = func(*args, **kwargs)
+    except BaseException:
+        # Failed stages (autocal exits on some failures) must not leave tracemalloc running either
+        if memory is not None:
+            end_memory_trace(state)
+        raise
+    if timings is not None:
+        timings[name] = time.time() - t0
+    if memory is not None:
+        memory[name] = stop_memory_trace(state)
+        logger.info("Stage %s: %.2f s, peak RSS %.0f MB", name, time.time() - t0, memory[name]["RSS_PEAK_MB"])
+    else:
+        logger.info("Stage %s: %.2f s", name, time.time() - t0)
+
+    if cache and (keep is None or keep(result)):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        # Write to a private file and rename, so parallel workers never read a half-written result
+        with open('%s.%i' % (path, os.getpid()), 'wb') as fp:
+            pickle.dump(result, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace('%s.%i' % (path, os.getpid()), path)
+        prune(keep = [path] + list(products))
+    return result
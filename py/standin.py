@@ -0,0 +1,220 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the catalog services, for offline tests and benchmarks.
+Usage: standin.py options
+Options:
+    -p  <port>                  port to listen on (default 8080)
+    -d  <cassette_dir>          serve the stars of recorded queries (see transport.py)
+    -n  <density>               otherwise serve synthetic stars, this many per square degree (default 5000)
+    -l  <latency_in_s>          fixed delay added to every response (default 0)
+
+Point gr_cat.py at it with AUTOCAL_CATALOG_SERVER=http://localhost:<port>. It answers
+    POST /panstarrs/search.php  with the same form fields and TSV output as MAST
+    GET  /sdss                  ra, dec, radius, band[, bright, faint] as csv
+    GET  /sdss/fields           ra, dec, radius as a run, camcol, field csv
+    GET  /vizier                ra, dec, radius, catalog, columns[, bright, faint] as csv
+Synthetic stars are generated deterministically per 0.1 degree cell, so repeated and
+overlapping queries see the same sky.
+"""
+
+import getopt
+import sys
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+cell_size = 0.1
+
+
+def band_of(column):
+    """
+    Band letter of a catalog magnitude column name, e.g. rMeanApMag, Hmag, R2mag, g'mag, <Gmag>.
+    """
+    return column.strip('<>')[0]
+
+
+def synthetic_mags(r, rng):
+    """
+    Magnitudes in all supported bands for stars with r magnitudes r, with plausible stellar colours.
+    """
+    gr = rng.normal(0.6, 0.3, len(r))
+    ri = 0.4*gr + rng.normal(0, 0.05, len(r))
+    iz = 0.5*ri + rng.normal(0, 0.03, len(r))
+    g, i = r + gr, r - ri
+    z = i - iz
+    J = i - 1.0 - ri
+    H = J - 0.5
+    return {'u': g + 1.2, 'g': g, 'r': r, 'i': i, 'z': z, 'y': z - 0.1,
+            'B': g + 0.3, 'V': g - 0.58*gr, 'R': r - 0.29*ri - 0.14, 'I': i - 0.38*iz - 0.40,
+            'J': J, 'H': H, 'K': H - 0.1, 'G': r - 0.2}
+
+
+def synthetic_stars(ra, dec, radius, band, density=5000):
+    """
+    Synthetic ra, dec, mag, magerr in band within radius (arcmin), from deterministic per-cell random fields.
+    """
+    rad_deg = radius / 60.
+    cos_dec = max(np.cos(np.radians(dec)), 1e-3)
+    ii = np.arange(np.floor((ra - rad_deg/cos_dec) / cell_size), np.floor((ra + rad_deg/cos_dec) / cell_size) + 1)
+    jj = np.arange(np.floor((dec - rad_deg) / cell_size), np.floor((dec + rad_deg) / cell_size) + 1)
+    columns = [[], [], [], []]
+    for i in ii.astype(int):
+        for j in jj.astype(int):
+            rng = np.random.default_rng([i % int(360/cell_size), j + int(90/cell_size)])
+            n = rng.poisson(density * cell_size**2 * np.cos(np.radians((j + 0.5) * cell_size)))
+            cell_ra = ((i + rng.uniform(0, 1, n)) * cell_size) % 360
+            cell_dec = (j + rng.uniform(0, 1, n)) * cell_size
+            # Number counts rising as 10^(0.3 m) between 12 and 23 mag
+            r = 12 + np.log10(1 + rng.uniform(0, 1, n) * (10**(0.3*11) - 1)) / 0.3
+            mag = synthetic_mags(r, rng)[band]
+            columns[0].append(cell_ra)
+            columns[1].append(cell_dec)
+            columns[2].append(mag)
+            columns[3].append(0.01 + 0.02 * 10**(0.4*(mag - 20)))
+    columns = [np.concatenate(column) for column in columns]
+    return select_cone(columns, ra, dec, radius)
+
+
+def recorded_stars(directory):
+    """
+    Stars per band from all recorded catalog queries in a cassette directory.
+    """
+    import transport
+    stars = {}
+    for record in transport.read_cassettes(directory):
+        if record["service"] not in ('PS', 'SDSS', 'Vizier'):
+            continue
+        band, result = record["args"][3], record["result"]
+        if record["service"] == 'PS':
+            result = result[0]
+        elif len(result) == 0:
+            continue
+        else:
+            result = [np.asarray(np.ma.filled(np.ma.asarray(result[col], dtype=float), np.nan)) for col in result.colnames[:4]]
+            if len(result) < 4:
+                result.append(np.full(len(result[0]), np.nan))
+        stars.setdefault(band, []).append(result)
+    for band in stars:
+        columns = [np.concatenate([page[i] for page in stars[band]]) for i in range(4)]
+        _, unique = np.unique(np.array(columns[:2]).T, axis=0, return_index=True)
+        stars[band] = [column[unique] for column in columns]
+    return stars
+
+
+def select_cone(columns, ra, dec, radius, maglim=None):
+    """
+    Rows of the ra, dec, mag, magerr columns within radius (arcmin) of ra, dec and within the magnitude range maglim.
+    """
+    ra1, dec1, ra2, dec2 = np.radians(ra), np.radians(dec), np.radians(columns[0]), np.radians(columns[1])
+    sep = 2*np.arcsin(np.sqrt(np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2))
+    keep = np.degrees(sep)*60 <= radius
+    if maglim is not None:
+        keep &= (columns[2] >= maglim[0]) & (columns[2] <= maglim[1])
+    return [column[keep] for column in columns]
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Answers the catalog queries of gr_cat.py from the stars of the server (recorded or synthetic).
+    """
+
+    def stars(self, ra, dec, radius, band, maglim=None):
+        if self.server.recorded is not None:
+            if band not in self.server.recorded:
+                return [np.array([])]*4
+            return select_cone(self.server.recorded[band], ra, dec, radius, maglim)
+        return select_cone(synthetic_stars(ra, dec, radius, band, self.server.density), ra, dec, radius, maglim)
+
+    def reply(self, lines, content_type='text/csv'):
+        time.sleep(self.server.latency)
+        body = ('\n'.join(lines) + '\n').encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/panstarrs/search.php':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf8')))
+        names = params['selectedColumnsCsv'].split(',')
+        maglim = None
+        if names[2] in params:
+            maglim = [float(x) for x in params[names[2]].split('..')]
+        columns = self.stars(float(params['RA']), float(params['DEC']), float(params['radius']), band_of(names[2]), maglim)
+        nrows = min(len(columns[0]), int(params.get('max_records', 50000)))
+        lines = ['\t'.join(names)] + ['%.7f\t%.7f\t%.4f\t%.4f' % tuple(column[ii] for column in columns) for ii in range(nrows)]
+        self.reply(lines, 'text/tab-separated-values')
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        ra, dec, radius = float(params['ra']), float(params['dec']), float(params['radius'])
+        maglim = None
+        if 'bright' in params:
+            maglim = (float(params['bright']), float(params['faint']))
+        if url.path == '/sdss/fields':
+            self.reply(['run,camcol,field', '1,1,1'])
+            return
+        if url.path == '/sdss':
+            band = params['band']
+            names = ['ra', 'dec', band, 'Err_'+band]
+        elif url.path == '/vizier':
+            band = band_of(params['columns'].split(',')[0])
+            names = ['_RAJ2000', '_DEJ2000'] + params['columns'].split(',')
+        else:
+            self.send_error(404)
+            return
+        columns = self.stars(ra, dec, radius, band, maglim)
+        lines = [','.join(names[:4])] + [','.join('%.7f' % column[ii] for column in columns[:len(names[:4])]) for ii in range(len(columns[0]))]
+        self.reply(lines)
+
+    def log_message(self, format, *args):
+        return
+
+
+def serve(port=8080, cassettes=None, density=5000, latency=0.):
+    """
+    Run the stand-in server until interrupted.
+    """
+    httpd = ThreadingHTTPServer(('localhost', port), StandinHandler)
+    httpd.recorded = recorded_stars(cassettes) if cassettes is not None else None
+    httpd.density = density
+    httpd.latency = latency
+    print('Serving catalog stand-in on http://localhost:%i' % port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        httpd.server_close()
+
+
+def main():
+
+    port, cassettes, density, latency = 8080, None, 5000, 0.
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'p:d:n:l:')
+        for o, v in optlist:
+            if o == '-p':
+                port = int(v)
+            elif o == '-d':
+                cassettes = v
+            elif o == '-n':
+                density = float(v)
+            elif o == '-l':
+                latency = float(v)
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    serve(port, cassettes, density, latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Strip-streamed image processing for images larger than memory.
+
+Images are read in row strips through section access, so only the rows of one
+strip are held in memory. The number of rows per strip follows from a memory
+budget. Statistics over the whole image are accumulated strip by strip in
+mergeable histograms, and outputs are written strip by strip with a streaming
+FITS writer, so the peak memory of a worker is bounded by the budget and not by
+the image size.
+"""
+
+import os
+import numpy as np
+import logging
+logger = logging.getLogger(__name__)
+
+# Approximate peak bytes per pixel of a strip while astroscrappy works on it (float32 working arrays)
+clean_bytes_per_pixel = 80
+# Bytes per pixel of a strip that is only read and converted
+copy_bytes_per_pixel = 16
+# Rows shared with the neighbouring strips when cleaning, so cosmic rays at strip edges are detected as in the full image
+clean_overlap = 32
+
+
+def strip_rows(shape, memory_budget, bytes_per_pixel = copy_bytes_per_pixel, overlap = 0):
+    """
+    Number of rows per strip of an image of the given shape for a memory budget in MB, with overlap extra rows on both sides.
+    """
+    rows = int(memory_budget * 2**20 / (shape[1] * bytes_per_pixel)) - 2*overlap
+    if rows < 16:
+        rows = 16
+        logger.warn("Memory budget of %i MB too small for strips of %i columns, using %i rows", memory_budget, shape[1], rows)
+    return min(rows, shape[0])
+
+
+def iter_strips(hdu, rows, overlap = 0):
+    """
+    Yield (y0, y1, lo, strip) for consecutive row strips of an image HDU. strip holds rows y0 - lo to y1 + overlap (clipped
+    to the image), read with section access; rows y0 to y1 of the image are strip[lo:lo + y1 - y0].
+    """
+    nrows = hdu.header['NAXIS2']
+    for y0 in range(0, nrows, rows):
+        y1 = min(y0 + rows, nrows)
+        r0, r1 = max(y0 - overlap, 0), min(y1 + overlap, nrows)
+        yield y0, y1, y0 - r0, hdu.section[r0:r1, :]
+
+
+def write_strips(filename, header, strips, dtype = np.float32):
+    """
+    Write an image strip by strip, replacing filename. header must describe the full image; strips is an iterable of row blocks in order.
+    """
+    from astropy.io import fits
+    header = header.copy()
+    header['BITPIX'] = {np.dtype(np.float32): -32, np.dtype(np.float64): -64}[np.dtype(dtype)]
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    if 'XTENSION' in header:
+        del header['XTENSION']
+        header.insert(0, ('SIMPLE', True))
+        for key in ('PCOUNT', 'GCOUNT'):
+            header.remove(key, ignore_missing=True)
+    # StreamingHDU appends to an existing file, so start from scratch
+    if os.path.exists(filename):
+        os.remove(filename)
+    out = fits.StreamingHDU(filename, header)
+    for strip in strips:
+        out.write(np.ascontiguousarray(strip, dtype=dtype))
+    out.close()
+
+
+def clean_image(hdu, filename, header, gain, ron, cosmic_rejection = True, sigclip = 50, objlim = 75, memory_budget = 1024):
+    """
+    Clean the image of hdu for cosmic rays with astroscrappy and divide by the gain (as autocal.clean_frame), strip by strip,
+    writing the result to filename with header. Strips overlap by clean_overlap rows, which are discarded after cleaning.
+    """
+    shape = (hdu.header['NAXIS2'], hdu.header['NAXIS1'])
+    overlap = clean_overlap if cosmic_rejection else 0
+    rows = strip_rows(shape, memory_budget, clean_bytes_per_pixel if cosmic_rejection else copy_bytes_per_pixel, overlap)
+    logger.info("Cleaning %i x %i image in strips of %i rows", shape[1], shape[0], rows)
+
+    def cleaned():
+        for y0, y1, lo, strip in iter_strips(hdu, rows, overlap):
+            strip = strip.astype(np.float32)
+            if cosmic_rejection:
+                import astroscrappy
+                crmask, strip = astroscrappy.detect_cosmics(strip, gain=gain, readnoise=ron, sigclip=sigclip, objlim=objlim, cleantype='medmask', sepmed=True, verbose=False)
+                strip = strip / gain
+            yield strip[lo:lo + y1 - y0]
+    write_strips(filename, header, cleaned())
+
+
+class Histogram:
+    """
+    Mergeable fixed-bin histogram, for quantiles and clipped means of data seen in strips. Unless given, the bin range is
+    set from the first values added, widened by their span on both sides; later values outside it count in the outer bins.
+    """
+
+    def __init__(self, nbins = 16384, range = None):
+        self.nbins = nbins
+        self.range = range
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.sums = np.zeros(nbins)
+        self.sums2 = np.zeros(nbins)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        if self.range is None:
+            lo, hi = values.min(), values.max()
+            span = max(hi - lo, 1e-6 * max(abs(hi), 1))
+            self.range = (lo - span, hi + span)
+        idx = np.clip(((values - self.range[0]) / (self.range[1] - self.range[0]) * self.nbins).astype(np.int64), 0, self.nbins - 1)
+        self.counts += np.bincount(idx, minlength=self.nbins)
+        self.sums += np.bincount(idx, weights=values, minlength=self.nbins)
+        self.sums2 += np.bincount(idx, weights=values**2, minlength=self.nbins)
+
+    def merge(self, other):
+        if other.range is None:
+            return
+        if self.range is None:
+            self.range = other.range
+        if self.range != other.range or self.nbins != other.nbins:
+            raise ValueError("Only histograms with the same bins can be merged")
+        self.counts += other.counts
+        self.sums += other.sums
+        self.sums2 += other.sums2
+
+    def percentile(self, q):
+        """
+        Percentiles q (in %, as np.percentile), interpolated within the bins.
+        """
+        edges = np.linspace(self.range[0], self.range[1], self.nbins + 1)
+        cumulative = np.concatenate([[0], np.cumsum(self.counts)]) / self.counts.sum()
+        return np.interp(np.asarray(q) / 100., cumulative, edges)
+
+    def clipped_mean(self, lo, hi):
+        """
+        Mean and standard deviation of the values between lo and hi (at the resolution of the bins).
+        """
+        centers = self.range[0] + (np.arange(self.nbins) + 0.5) * (self.range[1] - self.range[0]) / self.nbins
+        inside = (centers > lo) & (centers < hi)
+        n = self.counts[inside].sum()
+        mean = self.sums[inside].sum() / n
+        return mean, np.sqrt(max(self.sums2[inside].sum() / n - mean**2, 0))
+
+
+def image_histogram(filename, memory_budget = 1024, ext = 0):
+    """
+    Histogram of the pixel values of an image, read strip by strip.
+    """
+    from astropy.io import fits
+    hist = Histogram()
+    with fits.open(filename, memmap=True) as fitsfile:
+        hdu = fitsfile[ext]
+        for y0, y1, lo, strip in iter_strips(hdu, strip_rows((hdu.header['NAXIS2'], hdu.header['NAXIS1']), memory_budget)):
+            hist.add(strip)
+    return hist
+
+
+def copy_image(source, filename, header, memory_budget = 1024, ext = 0):
+    """
+    Copy the image of source to filename with a new header, strip by strip.
+    """
+    from astropy.io import fits
+    with fits.open(source, memmap=True) as fitsfile:
+        hdu = fitsfile[ext]
+        rows = strip_rows((hdu.header['NAXIS2'], hdu.header['NAXIS1']), memory_budget)
+        write_strips(filename, header, (strip for y0, y1, lo, strip in iter_strips(hdu, rows)))
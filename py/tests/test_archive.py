@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Detection archive (archive.py) with synthetic frames: cone queries, light curves with upper limits and frame catalogs.
+"""
+
+import os
+import sys
+import numpy as np
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, py_dir)
+
+import archive
+from sources import SourceList
+
+target = (150., 2.)
+
+
+def frame_header(mjd):
+    from astropy.io import fits
+    header = fits.Header()
+    header["NAXIS"], header["NAXIS1"], header["NAXIS2"] = 2, 1000, 1000
+    header["CTYPE1"], header["CTYPE2"] = "RA---TAN", "DEC--TAN"
+    header["CRVAL1"], header["CRVAL2"] = target
+    header["CRPIX1"], header["CRPIX2"] = 500.5, 500.5
+    header["CD1_1"], header["CD2_2"] = -0.4 / 3600, 0.4 / 3600
+    header["MJD-OBS"] = mjd
+    return header
+
+
+def add_frame(db_name, filename, mjd, zp, with_target):
+    ra = np.array([target[0] + 0.5 / 3600, target[0] + 0.02, target[0] - 0.02])
+    dec = np.array([target[1], target[1] + 0.01, target[1] - 0.03])
+    mag = np.array([18.0 + mjd - 59000, 17.5, 22.0])
+    magerr = np.array([0.02, 0.02, 9.99])
+    keep = slice(0 if with_target else 1, None)
+    sexlist = SourceList(x=np.arange(3.), y=np.arange(3.), ra=ra, dec=dec, mag=mag, magerr=magerr, ellip=np.zeros(3),
+                         fwhm=np.full(3, 3.), cat_mag=mag, cat_magerr=magerr)[keep]
+    result = {"FILENAME": filename, "FILTER": "r", "CATALOG": "PS", "ZP": zp, "ZP_ERR": 0.01, "FWHM": 3., "SEEING": 1.2,
+              "BACK_RMS": 10., "LIMMAG": 21.5, "N_CALIB": 50}
+    return archive.add_frame(db_name, result, frame_header(mjd), sexlist)
+
+
+def make_archive(tmpdir):
+    db_name = str(tmpdir.join("archive.db"))
+    add_frame(db_name, "a.fits", 59000.2, 25.0, True)
+    add_frame(db_name, "b.fits", 59001.2, 25.1, False)
+    add_frame(db_name, "c.fits", 59002.2, 24.9, True)
+    return db_name
+
+
+def test_cone(tmpdir):
+    db_name = make_archive(tmpdir)
+    sources = archive.cone(db_name, target[0], target[1], radius=2.)
+    assert len(sources["mjd"]) == 2
+    np.testing.assert_allclose(sources["mjd"], [59000.2, 59002.2])
+    np.testing.assert_allclose(sources["separation"], 0.5, atol=0.01)
+    assert list(sources["filter"]) == ["r", "r"]
+    assert len(archive.cone(db_name, target[0], target[1], radius=2., mjd_range=(59002, 59003))["mjd"]) == 1
+    assert len(archive.cone(db_name, target[0], target[1] + 1., radius=2.)["mjd"]) == 0
+
+
+def test_replace_frame(tmpdir):
+    db_name = make_archive(tmpdir)
+    add_frame(db_name, "a.fits", 59000.2, 25.0, True)
+    assert len(archive.frame_list(db_name)) == 3
+    assert len(archive.cone(db_name, target[0], target[1], radius=2.)["mjd"]) == 2
+
+
+def test_light_curve(tmpdir):
+    db_name = make_archive(tmpdir)
+    curve = archive.light_curve(db_name, target[0], target[1], radius=2.)
+    assert [row[0] for row in curve] == [59000.2, 59001.2, 59002.2]
+    assert [row[4] for row in curve] == [0, 1, 0]
+    np.testing.assert_allclose([row[2] for row in curve], [18.2, 21.5, 20.2], atol=1e-4)
+    assert curve[1][5] == os.path.abspath("b.fits")
+
+
+def test_frame_catalog(tmpdir):
+    db_name = make_archive(tmpdir)
+    frames = archive.frame_list(db_name, mjd_range=(59001, 59002))
+    assert [x["filename"] for x in frames] == [os.path.abspath("b.fits")]
+    cat = archive.frame_catalog(db_name, frames[0]["frame_id"])
+    # The upper limit is left out, and the zero point taken off the calibrated magnitude
+    assert cat.shape == (1, 4)
+    np.testing.assert_allclose(cat[0, 2], 17.5 - 25.1, atol=1e-4)
+    np.testing.assert_allclose(cat[0, 3], np.sqrt(0.02**2 - 0.01**2), atol=1e-4)
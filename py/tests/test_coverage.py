@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""
+Coverage maps (coverage.MOC): the IVOA ASCII round trip and position tests on synthetic maps.
+"""
+
+import os
+import sys
+import numpy as np
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, py_dir)
+
+from coverage import MOC
+
+
+def test_ascii_round_trip():
+    moc = MOC.from_ascii("3/12-15 4/70\n5/1000")
+    assert moc.order == 5
+    # The four pixels 3/12-15 are the pixel 2/3
+    assert moc.to_ascii() == "2/3\n4/70\n5/1000\n"
+    again = MOC.from_ascii(moc.to_ascii())
+    np.testing.assert_array_equal(again.ranges, moc.ranges)
+    assert again.order == moc.order
+
+
+def test_ascii_merges_adjacent_pixels():
+    moc = MOC.from_ascii("1/0 1/1-3")
+    np.testing.assert_array_equal(moc.ranges, [[0, 4]])
+    assert moc.to_ascii() == "0/0\n"
+
+
+def test_contains():
+    band = MOC.dec_band(-30, 90, order=5)
+    assert band.contains(10., 0.)
+    assert band.contains(200., 85.)
+    assert not band.contains(10., -60.)
+    np.testing.assert_array_equal(band.contains(np.array([10., 10.]), np.array([0., -60.])), [True, False])
+    assert 0.74 < band.sky_fraction < 0.78
+    assert np.all(MOC.all_sky().contains(np.array([0., 359.9]), np.array([-89.9, 89.9])))
+
+
+def test_cones():
+    moc = MOC.from_cones([150., 30.], [2., -40.], [20., 20.], order=9)
+    assert np.all(moc.contains(np.array([150., 150.2, 30.]), np.array([2., 2.1, -40.])))
+    assert not moc.contains(150., 3.)
+    assert not moc.contains(90., 2.)
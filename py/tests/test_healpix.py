@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+Nested HEALPix indexing (healpix.py) on synthetic positions: base pixels, the nested hierarchy, equal areas and cone coverage.
+"""
+
+import os
+import sys
+import numpy as np
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, py_dir)
+
+import healpix
+
+
+def random_positions(n, seed = 1):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(0, 360, n), np.degrees(np.arcsin(rng.uniform(-1, 1, n)))
+
+
+def test_base_pixels():
+    # Face centers of the northern, equatorial and southern base pixels
+    assert healpix.ang2pix(0, 45., 41.8) == 0
+    assert healpix.ang2pix(0, 135., 41.8) == 1
+    assert healpix.ang2pix(0, 0., 0.) == 4
+    assert healpix.ang2pix(0, 90., 0.) == 5
+    assert healpix.ang2pix(0, 45., -41.8) == 8
+    assert healpix.ang2pix(0, 315., -41.8) == 11
+
+
+def test_nested_hierarchy():
+    ra, dec = random_positions(10000)
+    for order in range(1, 17):
+        np.testing.assert_array_equal(healpix.ang2pix(order, ra, dec) >> 2, healpix.ang2pix(order - 1, ra, dec))
+
+
+def test_equal_area():
+    ra, dec = random_positions(192000)
+    counts = np.bincount(healpix.ang2pix(2, ra, dec), minlength=healpix.npix(2))
+    assert len(counts) == healpix.npix(2)
+    # About 1000 +- 32 positions per pixel
+    assert np.all(np.abs(counts - 1000) < 150), "pixel counts range from %i to %i" % (counts.min(), counts.max())
+
+
+def test_query_disc():
+    order, ra0, dec0, radius = 10, 150., 60., 0.2
+    pixels = healpix.query_disc(order, ra0, dec0, radius)
+    rng = np.random.RandomState(2)
+    # Positions in the cone, drawn in a box around it
+    ra = ra0 + rng.uniform(-radius, radius, 20000) / np.cos(np.radians(dec0))
+    dec = dec0 + rng.uniform(-radius, radius, 20000)
+    inside = np.hypot((ra - ra0) * np.cos(np.radians(dec0)), dec - dec0) < radius * 0.99
+    assert np.all(np.isin(healpix.ang2pix(order, ra[inside], dec[inside]), pixels))
+    # Padded by about one pixel, not more
+    padded_area = np.pi * (radius + 2 * healpix.pixel_size(order))**2
+    assert len(pixels) * healpix.pixel_size(order)**2 < padded_area
+
+
+def test_pixel_ranges():
+    ranges = healpix.pixel_ranges([3, 4, 5, 9], 1, 2)
+    np.testing.assert_array_equal(ranges, [[12, 24], [36, 40]])
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""
+Import-time budget of autocal: the heavy dependencies are imported by the stages that use them, so that importing
+autocal (e.g. for watch.py or batch.py workers) stays fast. Measured in a fresh interpreter.
+"""
+
+import os
+import ast
+import sys
+import time
+import subprocess
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Wall time of a fresh interpreter importing autocal, in seconds (about 0.2 s today with the interpreter start-up; importing
+# scipy.stats alone takes it over 1 s)
+import_budget = float(os.environ.get("AUTOCAL_IMPORT_BUDGET", 0.5))
+heavy_modules = ['scipy', 'astroscrappy', 'matplotlib', 'astropy.io.fits']
+
+
+def import_autocal():
+    t0 = time.time()
+    output = subprocess.check_output([sys.executable, '-c', 'import autocal; import sys; print(sorted(sys.modules))'], cwd=py_dir)
+    return time.time() - t0, ast.literal_eval(output.decode().strip().splitlines()[-1])
+
+
+def test_import_time():
+    # Best of three, so one slow start (cold disk cache) does not fail the test
+    elapsed = min(import_autocal()[0] for ii in range(3))
+    assert elapsed < import_budget, "importing autocal took %.2f s, budget %.2f s" % (elapsed, import_budget)
+
+
+def test_no_heavy_imports():
+    modules = import_autocal()[1]
+    loaded = [x for x in heavy_modules if x in modules]
+    assert loaded == [], "importing autocal loads %s" % ", ".join(loaded)
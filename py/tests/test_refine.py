@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""
+WCS refinement (refine.refine_wcs) on a synthetic star field with a header WCS that is off by a few arcseconds.
+"""
+
+import os
+import sys
+import numpy as np
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, py_dir)
+
+import refine
+
+
+def tan_header(crval, rotation = 0., pixscale = 0.4, size = 1000):
+    from astropy.io import fits
+    header = fits.Header()
+    header["NAXIS"], header["NAXIS1"], header["NAXIS2"] = 2, size, size
+    header["CTYPE1"], header["CTYPE2"] = "RA---TAN", "DEC--TAN"
+    header["CRVAL1"], header["CRVAL2"] = crval
+    header["CRPIX1"], header["CRPIX2"] = (size + 1) / 2., (size + 1) / 2.
+    rot = np.radians(rotation)
+    scale = pixscale / 3600
+    header["CD1_1"], header["CD1_2"] = -scale * np.cos(rot), scale * np.sin(rot)
+    header["CD2_1"], header["CD2_2"] = scale * np.sin(rot), scale * np.cos(rot)
+    return header
+
+
+def star_field(header, n = 200, seed = 1):
+    """
+    Reference stars on the image, and their detections (1-based pixel positions) through the true header.
+    """
+    from astropy import wcs
+    rng = np.random.RandomState(seed)
+    x, y = rng.uniform(20, header["NAXIS1"] - 20, n), rng.uniform(20, header["NAXIS2"] - 20, n)
+    ra, dec = wcs.WCS(header).all_pix2world(x, y, 1)
+    return x, y, ra, dec
+
+
+def offset_arcsec(header, x, y, ra, dec):
+    from astropy import wcs
+    from gr_cat import dist
+    world = wcs.WCS(header).all_pix2world(x, y, 1)
+    return dist(world[0], world[1], ra, dec) * 3600
+
+
+def test_refine_shift():
+    true_header = tan_header((150., 2.))
+    x, y, ra, dec = star_field(true_header)
+    header = tan_header((150., 2. + 4.4 / 3600))
+    assert np.median(offset_arcsec(header, x, y, ra, dec)) > 4.3
+    refined = refine.refine_wcs(header, x, y, ra, dec)
+    assert refined is not None
+    assert np.max(offset_arcsec(refined, x, y, ra, dec)) < 0.01
+    assert refined["ASTREFN"] >= 100
+
+
+def test_refine_rotation():
+    true_header = tan_header((150., 2.), rotation=0.3)
+    x, y, ra, dec = star_field(true_header, seed=2)
+    header = tan_header((150. + 3. / 3600, 2. - 2. / 3600))
+    refined = refine.refine_wcs(header, x, y, ra, dec)
+    assert refined is not None
+    assert np.max(offset_arcsec(refined, x, y, ra, dec)) < 0.01
+
+
+def test_refine_too_far_off():
+    true_header = tan_header((150., 2.))
+    x, y, ra, dec = star_field(true_header)
+    header = tan_header((150., 2. + 60. / 3600))
+    assert refine.refine_wcs(header, x, y, ra, dec, max_offset=15.) is None
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cosmic rays found across a sequence (sequence.sequence_cosmics) on synthetic dithered exposures of one star field.
+"""
+
+import os
+import sys
+import numpy as np
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, py_dir)
+
+import sequence
+
+size = 100
+dithers = [(0, 0), (3, 0), (0, 4), (-2, -3), (5, 2)]
+cosmic = (3, 50, 40)  # exposure, row, column
+
+
+def scene(seed = 1):
+    """
+    Sky of 200 electrons with a few stars, large enough to cut the dithered exposures from.
+    """
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[:size + 20, :size + 20]
+    sky = np.full(yy.shape, 200.)
+    for x0, y0, flux in zip(rng.uniform(15, size + 5, 8), rng.uniform(15, size + 5, 8), rng.uniform(2e3, 2e4, 8)):
+        sky += flux / (2 * np.pi * 1.5**2) * np.exp(-((xx - x0)**2 + (yy - y0)**2) / (2 * 1.5**2))
+    return sky
+
+
+def write_sequence(tmpdir):
+    from astropy.io import fits
+    rng = np.random.RandomState(2)
+    sky = scene()
+    filenames = []
+    for ii, (dx, dy) in enumerate(dithers):
+        # Exposure ii sees the sky shifted by dx, dy pixels
+        data = rng.poisson(sky[10 - dy:10 - dy + size, 10 - dx:10 - dx + size]).astype(np.float32)
+        if ii == cosmic[0]:
+            data[cosmic[1], cosmic[2]] += 3000.
+        header = fits.Header()
+        header["CTYPE1"], header["CTYPE2"] = "RA---TAN", "DEC--TAN"
+        header["CRVAL1"], header["CRVAL2"] = 150., 2.
+        header["CRPIX1"], header["CRPIX2"] = 50.5 + dx, 50.5 + dy
+        header["CD1_1"], header["CD2_2"] = -0.4 / 3600, 0.4 / 3600
+        header["GAIN"], header["RDNOISE"], header["EXPTIME"] = 1., 5., 60.
+        filename = str(tmpdir.join("seq%i.fits" % ii))
+        fits.PrimaryHDU(data, header).writeto(filename)
+        filenames.append(filename)
+    return filenames
+
+
+def test_integer_shifts(tmpdir):
+    from astropy.io import fits
+    headers = [fits.getheader(x) for x in write_sequence(tmpdir)]
+    # The shifts register the exposures to the first one, so they undo the dithers
+    assert sequence.integer_shifts(headers) == [(-dx, -dy) for dx, dy in dithers]
+
+
+def test_sequence_cosmics(tmpdir):
+    masks = sequence.sequence_cosmics(write_sequence(tmpdir), tile_rows=32)
+    assert len(masks) == len(dithers)
+    idx, values = masks[cosmic[0]]
+    flat = cosmic[1] * size + cosmic[2]
+    assert flat in idx
+    # Replaced with the sequence median, about the sky there
+    assert abs(values[list(idx).index(flat)] - 200.) < 100.
+    # Noise and stars are left alone
+    assert all(len(x[0]) <= 2 for ii, x in enumerate(masks) if ii != cosmic[0])
+    assert len(idx) <= 3
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+Joint zero-point solution (ubercal.py) on synthetic overlapping frames with known zero points.
+"""
+
+import os
+import sys
+import numpy as np
+
+py_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, py_dir)
+
+import ubercal
+
+zero_points = [25.0, 25.3, 24.8, 25.1]
+
+
+def star_field(n = 300, seed = 1):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(150., 150.2, n), rng.uniform(2., 2.1, n), rng.uniform(15, 19, n)
+
+
+def frame_catalogs(ra, dec, mag, seed = 2):
+    """
+    Instrumental (ra, dec, mag, magerr) catalogs of overlapping frames, each covering part of the field.
+    """
+    rng = np.random.RandomState(seed)
+    catalogs = []
+    for ii, zp in enumerate(zero_points):
+        on_frame = (ra >= 150. + 0.04 * ii) & (ra < 150.08 + 0.04 * ii)
+        n = np.sum(on_frame)
+        catalogs.append(np.array([ra[on_frame] + rng.normal(0, 0.1, n) / 3600, dec[on_frame],
+                                  mag[on_frame] - zp + rng.normal(0, 0.01, n), np.full(n, 0.01)]).T)
+    return catalogs
+
+
+def test_ubercal():
+    ra, dec, mag = star_field()
+    # Only the stars on the first frame are in the reference catalog: the others are anchored through the overlaps
+    ref = np.array([ra, dec, mag, np.full(len(ra), 0.01)]).T[ra < 150.05]
+    zp, zp_err, n_meas, star_mag = ubercal.ubercal(frame_catalogs(ra, dec, mag), ref)[:4]
+    np.testing.assert_allclose(zp, zero_points, atol=0.005)
+    assert np.all(zp_err < 0.01)
+    assert np.all(n_meas > 0)
+    # A few random stars closer than the match radius are merged or left out
+    assert len(ra) - 5 < len(star_mag) <= len(ra)
+
+
+def test_unanchored_frame():
+    ra, dec, mag = star_field()
+    catalogs = frame_catalogs(ra, dec, mag)
+    # A frame elsewhere on the sky shares no stars with the others or with the reference
+    catalogs.append(np.array([[10., -5., 3., 0.01], [10.01, -5., 4., 0.01]]))
+    ref = np.array([ra, dec, mag, np.full(len(ra), 0.01)]).T
+    zp = ubercal.ubercal([lambda cat=cat: cat for cat in catalogs], ref)[0]
+    np.testing.assert_allclose(zp[:-1], zero_points, atol=0.005)
+    assert np.isnan(zp[-1])
+
+
+def test_match_stars_same_frame_chain():
+    # Two detections on frame 0, 1.6 arcsec apart, linked through a detection on frame 1 between them
+    ra = np.array([10., 10. + 0.8 / 3600, 10. + 1.6 / 3600, 20., 20.])
+    dec = np.zeros(5)
+    frame = np.array([0, 1, 0, 0, 1])
+    star, n_star = ubercal.match_stars(ra, dec, frame, tol=1.0)
+    assert n_star == 1
+    np.testing.assert_array_equal(star, [-1, -1, -1, 0, 0])
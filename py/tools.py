@@ -0,0 +1,108 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Runner for the external tools used by autocal.py.
+
+Configuration files are written once per content hash into a cache directory
+(AUTOCAL_CONFIG_DIR, default ~/.cache/autocal) and then reused by every call and
+every process. Per-call settings are passed as command-line overrides, never by
+rewriting a config file. Scratch output goes to a per-process directory on tmpfs:
+AUTOCAL_SCRATCH if set, else /dev/shm, else the system temporary directory. This
+keeps the many small writes and deletes of a calibration off shared filesystems.
+tmpfs is memory, so the streaming mode for images larger than memory asks for
+an on-disk scratch directory instead: AUTOCAL_DISK_SCRATCH if set, else
+the scratch directory under AUTOCAL_CONFIG_DIR.
+
+The tools run with a timeout (AUTOCAL_SEX_TIMEOUT and AUTOCAL_SOLVE_TIMEOUT, in
+seconds), after which they are killed together with any processes they started,
+so a hanging solve-field cannot stall a worker indefinitely.
+"""
+
+import os
+import sys
+import shutil
+import signal
+import atexit
+import hashlib
+import tempfile
+import subprocess
+import logging
+logger = logging.getLogger(__name__)
+
+config_dir = os.environ.get("AUTOCAL_CONFIG_DIR", os.path.join(os.path.expanduser("~"), ".cache", "autocal"))
+scratch_root = os.environ.get("AUTOCAL_SCRATCH")
+disk_scratch_root = os.environ.get("AUTOCAL_DISK_SCRATCH", os.path.join(config_dir, "scratch"))
+sextractor_timeout = float(os.environ.get("AUTOCAL_SEX_TIMEOUT", 300))
+solve_timeout = float(os.environ.get("AUTOCAL_SOLVE_TIMEOUT", 300))
+
+# Scratch directories of this process: tmpfs (False) and on disk (True)
+_scratch_dirs = {}
+
+
+def cached_file(content, suffix=''):
+    """
+    Path of a file in config_dir holding content. The file is named after the hash of its content, so it is only
+    written the first time and is never changed afterwards.
+    """
+    name = os.path.join(config_dir, hashlib.sha1(content.encode('utf8')).hexdigest()[:16] + suffix)
+    if not os.path.exists(name):
+        if not os.path.exists(config_dir):
+            os.makedirs(config_dir, exist_ok=True)
+        # Write to a private file and rename, so parallel workers never read a half-written config
+        with open('%s.%i' % (name, os.getpid()), 'w') as fp:
+            fp.write(content)
+        os.replace('%s.%i' % (name, os.getpid()), name)
+    return name
+
+
+def scratch_dir(on_disk = False):
+    """
+    Scratch directory of this process, created on first use and removed at exit. With on_disk, a directory on disk
+    rather than on tmpfs, for files that must not take up memory.
+    """
+    if on_disk not in _scratch_dirs:
+        if on_disk:
+            root = disk_scratch_root
+            os.makedirs(root, exist_ok=True)
+        else:
+            root = scratch_root
+            if root is None:
+                root = '/dev/shm' if os.access('/dev/shm', os.W_OK) else tempfile.gettempdir()
+        _scratch_dirs[on_disk] = tempfile.mkdtemp(prefix='autocal-%i-' % os.getpid(), dir=root)
+        atexit.register(shutil.rmtree, _scratch_dirs[on_disk], True)
+    return _scratch_dirs[on_disk]
+
+
+def run(args, timeout = None):
+    """
+    Run the command args and return its exit code. If it runs for more than timeout seconds, it is killed with all the
+    processes it started (solve-field runs the solver as a child process) and subprocess.TimeoutExpired is raised.
+    """
+    process = subprocess.Popen(args, start_new_session=True)
+    try:
+        return process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        raise
+
+
+def run_sextractor(image, config, catalog_name, **overrides):
+    """
+    Run SExtractor on image with the config file config, writing the catalog to catalog_name. Keyword arguments are
+    passed as command-line overrides of config parameters, e.g. SATUR_LEVEL=30000; list values are joined with commas.
+    """
+    args = ['sex', image, '-c', config, '-CATALOG_NAME', catalog_name]
+    for key, value in overrides.items():
+        if isinstance(value, (list, tuple)):
+            value = ','.join(str(x) for x in value)
+        args += ['-' + key, str(value)]
+    try:
+        run(args, sextractor_timeout)
+    except (OSError, IOError):
+        logger.warn("Sextractor failed to be executed.", exc_info=1)
+        sys.exit(1)
+    except subprocess.TimeoutExpired:
+        logger.warn("Sextractor did not finish within %i s.", sextractor_timeout)
+        sys.exit(1)
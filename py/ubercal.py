@@ -0,0 +1,255 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Joint zero-point solution (ubercal) for many overlapping exposures.
+Usage: ubercal.py options [catalog_1 catalog_2 ...]
+Options:
+    -r  <reference_file>        reference catalog (ra,dec,mag,e_mag csv as written by gr_cat.py)
+    -d  <archive_db>            take the frames from this detection archive (see archive.py)
+    -f  <filter>                only the archived frames in this filter
+    -o  <output_file>           output file for the per-frame zero points (default is standard output)
+    -s  <star_file>             optional output file for the per-star magnitudes
+    -t  <tol_in_arcsec>         cross-match radius in arcseconds (default 1.0)
+
+autocal.py removes its sextractor catalogs, so the frames usually come from the
+detection archive that autocal(archive=...) appends to: the detections of each
+archived frame, with its zero point taken off their calibrated magnitudes. Give
+one filter per run. Catalog files can be given as well, as sextractor ASCII_HEAD
+catalogs with ALPHA_J2000, DELTA_J2000, MAG_AUTO and MAGERR_AUTO in columns 3-6.
+Stars are cross-matched between all frames, and the per-frame zero points and
+per-star magnitudes are solved for together in one sparse, weighted least-squares
+system, anchored to the reference catalog. Output columns are:
+frame\tzp\te_zp\tn_meas
+"""
+
+import getopt
+import sys
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import lsqr
+from scipy.spatial import cKDTree
+
+
+def radec2xyz(ra, dec):
+    """
+    Unit vectors for ra, dec in degrees. Chord distances on the unit sphere avoid the RA wrap and the cos(dec) squeeze in the k-d tree.
+    """
+    ra_rad, dec_rad = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec_rad)
+    return np.array([cos_dec * np.cos(ra_rad), cos_dec * np.sin(ra_rad), np.sin(dec_rad)]).T
+
+
+def read_instrumental_catalog(filename, usecols=(2, 3, 4, 5)):
+    """
+    Read ra, dec, mag and magerr from a sextractor ASCII_HEAD catalog. Unmeasured sources (mag 99) are dropped.
+    """
+    cat = np.loadtxt(filename, usecols=usecols, ndmin=2, dtype=np.float64)
+    good = (cat[:, 2] < 90) & (cat[:, 3] > 0) & (cat[:, 3] < 90)
+    return cat[good]
+
+
+def stack_measurements(catalogs):
+    """
+    Concatenate per-frame (ra, dec, mag, magerr) arrays into flat measurement arrays. Catalogs can be
+    arrays, filenames, or functions returning an array (e.g. reading an archived frame); they are read one at a time
+    so only the compact stacked arrays are held.
+    """
+    ra, dec, mag, magerr, frame = [], [], [], [], []
+    for ii, cat in enumerate(catalogs):
+        if isinstance(cat, str):
+            cat = read_instrumental_catalog(cat)
+        elif callable(cat):
+            cat = cat()
+        cat = np.asarray(cat)
+        ra.append(cat[:, 0])
+        dec.append(cat[:, 1])
+        mag.append(cat[:, 2].astype(np.float32))
+        magerr.append(cat[:, 3].astype(np.float32))
+        frame.append(np.full(len(cat), ii, dtype=np.int32))
+    return np.concatenate(ra), np.concatenate(dec), np.concatenate(mag), np.concatenate(magerr), np.concatenate(frame)
+
+
+def match_stars(ra, dec, frame, tol=1.0):
+    """
+    Group detections from all frames into stars. Detections closer than tol (arcsec) are linked, and each
+    connected group is one star. Groups with two detections on the same frame are left out. Returns the star index
+    of every detection (-1 for the left out ones) and the number of stars.
+    """
+    xyz = radec2xyz(ra, dec)
+    chord = 2 * np.sin(np.radians(tol / 3600.) / 2)
+    tree = cKDTree(xyz)
+    pairs = tree.query_pairs(chord, output_type='ndarray')
+    # Detections on the same frame are never the same star
+    pairs = pairs[frame[pairs[:, 0]] != frame[pairs[:, 1]]]
+    n = len(ra)
+    graph = sparse.coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    n_star, star = csgraph.connected_components(graph, directed=False)
+
+    # Linking is transitive, so a chain through other frames can still join two detections on one frame: these groups
+    # are blends or crowded neighbours, not one star
+    n_frame = int(frame.max()) + 1 if n else 1
+    key, count = np.unique(star.astype(np.int64) * n_frame + frame, return_counts=True)
+    reject = np.isin(star, key[count > 1] // n_frame)
+    if np.any(reject):
+        logger.info("%i detections in groups with two detections on one frame left out", np.sum(reject))
+    star = np.where(reject, -1, star)
+    kept, star[~reject] = np.unique(star[~reject], return_inverse=True)
+    return star.astype(np.int32), len(kept)
+
+
+def ubercal(catalogs, ref_cat, tol=1.0, sys_err=0.01, sigma_mask=3, n_iter=3, atol=1e-8, btol=1e-8):
+    """
+    Solve for per-frame zero points and per-star magnitudes of overlapping frames. catalogs is a list of
+    (ra, dec, mag, magerr) arrays or catalog filenames, ref_cat is the reference catalog as an (ra, dec, mag, magerr)
+    array, e.g. from ReferenceCatalog.to_array(band). Every measurement i of star s on frame f adds one row
+    (m_s - zp_f = mag_i) / sigma_i, and every star matched to the reference adds (m_s = mag_ref) / sigma_ref.
+    The system is solved with the iterative sparse solver lsqr, so memory only grows with the number of
+    non-zeros (two per measurement). Measurements deviating more than sigma_mask sigma are clipped and the
+    system is solved again, n_iter times in total.
+
+    Returns zp, zp_err, n_meas per frame and star_mag, star_magerr, star_ra, star_dec per star. Frames that
+    are not connected to any reference star through overlapping stars get NaN zero points.
+    """
+    ra, dec, mag, magerr, frame = stack_measurements(catalogs)
+    n_frame = len(catalogs)
+    star, n_star = match_stars(ra, dec, frame, tol=tol)
+    matched = star >= 0
+    ra, dec, mag, magerr, frame, star = ra[matched], dec[matched], mag[matched], magerr[matched], frame[matched], star[matched]
+    logger.info("%i measurements of %i stars on %i frames", len(mag), n_star, n_frame)
+
+    # Mean star positions
+    n_per_star = np.bincount(star, minlength=n_star)
+    star_ra = np.bincount(star, weights=ra, minlength=n_star) / n_per_star
+    star_dec = np.bincount(star, weights=dec, minlength=n_star) / n_per_star
+    del ra, dec
+
+    # Anchor to the reference catalog
+    ref_cat = np.asarray(ref_cat)
+    ref_cat = ref_cat[np.isfinite(ref_cat[:, 2]) & np.isfinite(ref_cat[:, 3])]
+    tree = cKDTree(radec2xyz(ref_cat[:, 0], ref_cat[:, 1]))
+    chord = 2 * np.sin(np.radians(tol / 3600.) / 2)
+    distance, indice = tree.query(radec2xyz(star_ra, star_dec), k=1, distance_upper_bound=chord)
+    ref_star = np.where(np.isfinite(distance))[0]
+    ref_mag = ref_cat[indice[ref_star], 2]
+    ref_magerr = np.sqrt(ref_cat[indice[ref_star], 3]**2 + sys_err**2)
+    if len(ref_star) == 0:
+        logger.warn("No stars matched to the reference catalog: the zero points cannot be anchored.")
+        sys.exit(1)
+    logger.info("%i stars matched to the reference catalog", len(ref_star))
+
+    # Frames only anchored if they share stars (possibly through other frames) with the reference
+    bipartite = sparse.coo_matrix((np.ones(len(mag), dtype=np.int8), (frame, n_frame + star)), shape=(n_frame + n_star, n_frame + n_star))
+    _, component = csgraph.connected_components(bipartite, directed=False)
+    anchored = np.isin(component[:n_frame], component[n_frame + ref_star])
+
+    sigma = np.sqrt(magerr.astype(np.float64)**2 + sys_err**2)
+    use = anchored[frame]
+    n_meas, n_ref = len(mag), len(ref_star)
+    rows_meas = np.arange(n_meas, dtype=np.int32)
+    for it in range(n_iter):
+        # Rows for the measurements (m_s - zp_f) followed by rows for the reference stars (m_s)
+        w = np.where(use, 1. / sigma, 0.)
+        A = sparse.csr_matrix(
+            (np.concatenate([w, -w, 1. / ref_magerr]),
+             (np.concatenate([rows_meas, rows_meas, n_meas + np.arange(n_ref)]),
+              np.concatenate([n_frame + star, frame, n_frame + ref_star]))),
+            shape=(n_meas + n_ref, n_frame + n_star))
+        b = np.concatenate([w * mag, ref_mag / ref_magerr])
+
+        # Column scaling keeps lsqr well conditioned when stars and frames have very different numbers of rows
+        col_norm = np.sqrt(np.asarray(A.multiply(A).sum(axis=0)).ravel())
+        col_norm[col_norm == 0] = 1.
+        A = A @ sparse.diags(1. / col_norm)
+        out = lsqr(A, b, atol=atol, btol=btol, iter_lim=10 * (n_frame + n_star), calc_var=True)
+        x, var = out[0] / col_norm, out[9] / col_norm**2
+        zp, star_mag = x[:n_frame], x[n_frame:]
+
+        # Clip outliers in the normalised residuals
+        resid = (mag + zp[frame] - star_mag[star]) / sigma
+        clip = np.abs(resid) > sigma_mask
+        logger.info("Iteration %i: chi2/dof = %.2f, %i measurements clipped", it, np.sum(resid[use & ~clip]**2) / max(np.sum(use & ~clip) + n_ref - n_frame - n_star, 1), np.sum(use & clip))
+        if not np.any(use & clip):
+            break
+        use = use & ~clip
+
+    zp_err, star_magerr = np.sqrt(var[:n_frame]), np.sqrt(var[n_frame:])
+    zp[~anchored], zp_err[~anchored] = np.nan, np.nan
+    if np.any(~anchored):
+        logger.warn("%i frames do not overlap with any reference star and are left uncalibrated.", np.sum(~anchored))
+    n_meas = np.bincount(frame[use], minlength=n_frame)
+    return zp, zp_err, n_meas, star_mag, star_magerr, star_ra, star_dec
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -r   <reference_file>        reference catalog (ra,dec,mag,e_mag csv as written by gr_cat.py)
+    -d   <archive_db>            take the frames from this detection archive (see archive.py)
+    -f   <filter>                only the archived frames in this filter
+    -o   <output_file>           output file for the per-frame zero points (default is standard output)
+    -s   <star_file>             optional output file for the per-star magnitudes
+    -t   <tol_in_arcsec>         cross-match radius in arcseconds (default 1.0)
+    """
+    refname = starname = archive = filter_name = None
+    outname = sys.stdout
+    tol = 1.0
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'r:d:f:o:s:t:')
+        for o, v in optlist:
+            if o == '-r':
+                refname = v
+            elif o == '-d':
+                archive = v
+            elif o == '-f':
+                filter_name = v
+            elif o == '-o':
+                outname = open(v, 'w')
+            elif o == '-s':
+                starname = open(v, 'w')
+            elif o == '-t':
+                tol = float(v)
+        if refname is None:
+            raise getopt.GetoptError('reference catalog must be specified.')
+        if len(args) == 0 and archive is None:
+            raise getopt.GetoptError('no instrumental catalogs or archive given.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return refname, archive, filter_name, outname, starname, tol, args
+
+
+def main():
+
+    refname, archive, filter_name, outname, starname, tol, filelist = get_options()
+    ref_cat = np.genfromtxt(refname, delimiter=',', skip_header=1, usecols=(0, 1, 2, 3))
+    catalogs = list(filelist)
+    if archive is not None:
+        import functools
+        import archive as detection_archive
+        frames = detection_archive.frame_list(archive, filter_name=filter_name)
+        logger.info("%i frames in %s", len(frames), archive)
+        filelist = filelist + ["%s[%i]" % (x["filename"], x["ext"]) for x in frames]
+        catalogs += [functools.partial(detection_archive.frame_catalog, archive, x["frame_id"]) for x in frames]
+    zp, zp_err, n_meas, star_mag, star_magerr, star_ra, star_dec = ubercal(catalogs, ref_cat, tol=tol)
+
+    outname.write('frame\tzp\te_zp\tn_meas\n')
+    for ii, fl in enumerate(filelist):
+        outname.write('%s\t%.4f\t%.4f\t%i\n' % (fl, zp[ii], zp_err[ii], n_meas[ii]))
+    outname.flush()
+
+    if starname is not None:
+        starname.write('ra,dec,mag,e_mag\n')
+        for ii in range(len(star_mag)):
+            starname.write('%.7f,%.7f,%.4f,%.4f\n' % (star_ra[ii], star_dec[ii], star_mag[ii], star_magerr[ii]))
+        starname.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -61,9 +61,23 @@ def limiting_magnitude(img_rms = 100, img_fwhm = 5, img_zp = 30, sigma_limit = 5
         return magnitude_limit
 
 
+def limiting_magnitude_map(rms_map, img_fwhm = 5, img_zp = 30, sigma_limit = 5, profile = "Moffat"):
+    """
+    Limiting magnitude of every cell of a background RMS map, e.g. sextractor's MINIBACK_RMS mesh. The limit scales as -2.5 log10(rms), so the simulation of limiting_magnitude only runs once, for unit RMS. Cells without a valid RMS are NaN.
+    """
+    import numpy as np
+    unit_limit = limiting_magnitude(img_rms = 1, img_fwhm = img_fwhm, img_zp = img_zp, sigma_limit = sigma_limit, profile = profile)[0]
+    rms_map = np.asarray(rms_map, dtype=float)
+    lim_map = np.full(rms_map.shape, np.nan)
+    good = np.isfinite(rms_map) & (rms_map > 0)
+    lim_map[good] = unit_limit - 2.5*np.log10(rms_map[good])
+    return lim_map
+
+
 
 def main():
 
+    import matplotlib.pyplot as pl
     FORSz = limiting_magnitude(img_rms = 40.74, img_fwhm = 2.74, img_zp = 32.36, sigma_limit=5, profile="Gaussian", return_image=True)
 
     pl.imshow(FORSz, cmap = "viridis")
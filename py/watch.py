@@ -0,0 +1,174 @@
+#!/usr/local/anaconda3/envs/py36 python
+# -*- coding: utf-8 -*-
+
+"""
+Streaming mode: calibrate frames as they are written to an incoming directory.
+Usage: watch.py options
+Options:
+    -i  <incoming_dir>          directory to watch for new FITS files
+    -o  <output_dir>            directory to publish one <frame>.json result per frame
+    -u  <socket_path>           unix socket to publish one json line per frame
+    -s  <catalog>               reference catalog passed to autocal (default PS)
+    -p  <pattern>               file pattern to watch for (default *.fits)
+    -q  <queue_size>            maximum number of frames waiting for calibration (default 16)
+    -d  <archive_db>            append the calibrated objects to this detection archive (see archive.py)
+
+The service runs in one long-lived process, so imports, the in-memory reference
+catalogs and their k-d trees, and the sextractor configuration stay warm between
+frames. A file is queued once its size and modification time have been stable for
+a short settling time, so frames still being written are not picked up. When the
+queue is full the watcher waits, which keeps memory bounded if frames arrive faster
+than they can be calibrated.
+"""
+
+import getopt
+import sys
+import os
+import glob
+import json
+import time
+import socket
+import threading
+import queue
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+from autocal import autocal
+
+# Images written by autocal() next to the input frame, never queued themselves
+products = ('_calibrated.fits', '_aper.fits', '_backrms.fits', '_objfree.fits', '_stack.fits')
+
+
+def publish(result, outdir=None, socket_path=None):
+    """
+    Publish a result dictionary as <outdir>/<frame>.json (written atomically) and/or as one json line on a unix socket.
+    """
+    line = json.dumps(result, default=float)
+    if outdir is not None:
+        name = os.path.join(outdir, os.path.basename(result["FILENAME"]) + ".json")
+        with open(name + ".part", 'w') as fp:
+            fp.write(line + '\n')
+        os.replace(name + ".part", name)
+    if socket_path is not None:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socket_path)
+            sock.sendall((line + '\n').encode('utf8'))
+            sock.close()
+        except (OSError, IOError):
+            logger.warn("Could not publish %s to %s", result["FILENAME"], socket_path, exc_info=1)
+
+
+def worker(frames, outdir=None, socket_path=None, **kwargs):
+    """
+    Calibrate frames from the queue until a None is received. Failures are published as results with an ERROR entry.
+    """
+    while True:
+        filename = frames.get()
+        if filename is None:
+            frames.task_done()
+            return
+        t0 = time.time()
+        try:
+            result = autocal(filename=filename, **kwargs)
+        except (Exception, SystemExit) as e:
+            logger.warn("Calibration of %s failed", filename, exc_info=1)
+            result = {"FILENAME": filename, "ERROR": repr(e)}
+        result["WALLTIME"] = time.time() - t0
+        publish(result, outdir=outdir, socket_path=socket_path)
+        frames.task_done()
+
+
+def watch(indir, outdir=None, socket_path=None, pattern="*.fits", queue_size=16, poll=1.0, settle=2.0, cache=False, **kwargs):
+    """
+    Watch indir for new files matching pattern and calibrate them one by one with autocal(filename, **kwargs) in a
+    background worker. Files that already have a published result in outdir are skipped, so the service can be restarted.
+    Every frame is calibrated once, so the stage cache (see stages.py) is off unless cache is set.
+    """
+    frames = queue.Queue(maxsize=queue_size)
+    thread = threading.Thread(target=worker, args=(frames,), kwargs=dict(outdir=outdir, socket_path=socket_path, cache=cache, **kwargs))
+    thread.daemon = True
+    thread.start()
+
+    seen, pending = set(), {}
+    try:
+        while True:
+            for fl in sorted(glob.glob(os.path.join(indir, pattern))):
+                if fl in seen or fl.endswith(products):
+                    continue
+                if outdir is not None and os.path.exists(os.path.join(outdir, os.path.basename(fl) + ".json")):
+                    seen.add(fl)
+                    continue
+                try:
+                    st = os.stat(fl)
+                except OSError:
+                    continue
+                # Only queue files that have stopped changing
+                stamp = (st.st_size, st.st_mtime)
+                if fl not in pending or pending[fl][0] != stamp:
+                    pending[fl] = (stamp, time.time())
+                elif time.time() - pending[fl][1] >= settle:
+                    logger.info("Queueing %s", fl)
+                    frames.put(fl)
+                    seen.add(fl)
+                    del pending[fl]
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        logger.info("Stopping, finishing queued frames")
+        frames.put(None)
+        thread.join()
+
+
+def get_options():
+    """Parse options. As a reminder, they are:
+    Options:
+    -i   <incoming_dir>          directory to watch for new FITS files
+    -o   <output_dir>            directory to publish one <frame>.json result per frame
+    -u   <socket_path>           unix socket to publish one json line per frame
+    -s   <catalog>               reference catalog passed to autocal (default PS)
+    -p   <pattern>               file pattern to watch for (default *.fits)
+    -q   <queue_size>            maximum number of frames waiting for calibration (default 16)
+    -d   <archive_db>            append the calibrated objects to this detection archive (see archive.py)
+    """
+    indir = outdir = socket_path = archive = None
+    catalog, pattern, queue_size = "PS", "*.fits", 16
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'i:o:u:s:p:q:d:')
+        for o, v in optlist:
+            if o == '-i':
+                indir = v
+            elif o == '-o':
+                outdir = v
+            elif o == '-u':
+                socket_path = v
+            elif o == '-s':
+                catalog = v.upper()
+            elif o == '-p':
+                pattern = v
+            elif o == '-q':
+                queue_size = int(v)
+            elif o == '-d':
+                archive = v
+        if indir is None:
+            raise getopt.GetoptError('incoming directory must be specified.')
+        if outdir is None and socket_path is None:
+            raise getopt.GetoptError('an output directory or socket must be specified.')
+    except (getopt.GetoptError, ValueError):
+        print(__doc__)
+        t, v = sys.exc_info()[:2]
+        sys.stderr.write('ERROR: %s: %s\n' % (t, v))
+        sys.exit(2)
+    return indir, outdir, socket_path, catalog, pattern, queue_size, archive
+
+
+def main():
+
+    indir, outdir, socket_path, catalog, pattern, queue_size, archive = get_options()
+    if outdir is not None and not os.path.exists(outdir):
+        os.makedirs(outdir)
+    watch(indir, outdir=outdir, socket_path=socket_path, pattern=pattern, queue_size=queue_size, catalog=catalog, archive=archive)
+
+
+if __name__ == '__main__':
+    main()